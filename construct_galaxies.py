@@ -0,0 +1,222 @@
+#!/software/anaconda3/bin/python
+
+# --- Import standard modules to the python path.
+import os
+import argparse
+import time
+import traceback
+
+import multiprocessing
+from functools import partial
+
+from kickIT.lazy import lazy_import
+
+# --- the science modules are only loaded once they are used, so that parsing the arguments is fast
+galaxy_history = lazy_import('kickIT.galaxy_history')
+cache = lazy_import('kickIT.cache')
+baryons = lazy_import('kickIT.galaxy_history.baryons')
+halos = lazy_import('kickIT.galaxy_history.halos')
+disks = lazy_import('kickIT.galaxy_history.disks')
+
+# --- Specify arguments for the batch construction of galaxy models
+def parse_commandline():
+    """
+    Parse the arguments given on the command-line.
+    """
+    parser = argparse.ArgumentParser()
+
+    # default information
+    parser.add_argument('--sgrb-path', type=str, help="Path to the table with sGRB host galaxy information.")
+    parser.add_argument('-g', '--grbs', type=str, nargs='+', default=None, help="GRBs whose hosts we want to construct. Default is every GRB in the sGRB table.")
+    parser.add_argument('--smhm-sigmas', type=float, nargs='+', default=[0.0], help="Deviations from the stellar mass-halo mass relation to construct each host with. Default is 0.0.")
+    parser.add_argument('-mp', '--multiproc', type=str, default=None, help="If specified, will construct the galaxies in parallel over the number of cores provided as an argument. Can also use the string 'max' to parallelize over all available cores. Default is None.")
+    parser.add_argument('--output-dirpath', type=str, default='./gal_files/', help="Path to the output directory. Each galaxy is saved in a subdirectory named after its GRB, as <grb>_sigma<sigma>_hostgal. Default is './gal_files/'.")
+    parser.add_argument('--gal-format', type=str, default='pkl', help="Format for saving the galaxy realizations, either 'pkl' or 'hdf5' (see run.py). Default is 'pkl'.")
+    parser.add_argument('--ensemble', action='store_true', help="Constructs the realizations of each host for all SMHM sigmas together, sharing the SFR history and baryonic potentials, and saves them in a single HDF5 file <grb>/<grb>_ensemble.hdf5. Only caches the SFR history solutions. Default=False.")
+    parser.add_argument('--cache-dirpath', type=str, default=None, help="Path to a cache of galaxy realizations and SFR history solutions (see run.py). Cached galaxies are reused, and newly constructed ones are added to the cache. With --ensemble, only the SFR history solutions are cached. Default is None.")
+    parser.add_argument('--table-dirpath', type=str, default=None, help="Directory in which the Monte Carlo tables of the scaling relations are saved and reused (see run.py). Default is the KICKIT_TABLE_DIRPATH environment variable; if neither is set, the tables are recalculated in every run.")
+
+    # galaxy arguments
+    parser.add_argument('--disk-profile', type=str, default='DoubleExponential', help="Profile for the galactic disk (see run.py). Default is 'DoubleExponential'.")
+    parser.add_argument('--bulge-profile', type=str, default=None, help="Profile for the galactic bulge, named according to Galpy potentials. Default is None.")
+    parser.add_argument('--dm-profile', type=str, default='NFW', help="Profile for the DM, named according to Galpy potentials. Default is NFW.")
+    parser.add_argument('--z-scale', type=float, default=0.05, help="Fraction of the galactic scale radius for the scale height above/below the disk. Default=0.05.")
+    parser.add_argument('--differential-prof', action='store_true', help="Uses a differential stellar profile (see run.py). Default=False.")
+    parser.add_argument('--collapse-shells', action='store_true', help="With --differential-prof, collapses the accumulated stellar shells at each timestep (see run.py). Requires --disk-profile DoubleExponential or MNExponential. Default=False.")
+    parser.add_argument('--coarsen-tol', type=float, default=None, help="Force tolerance for merging timesteps into potential epochs (see run.py). Default=None (no coarsening).")
+    parser.add_argument('--smhm-relation', type=str, default='Guo', help="Chooses a stellar mass-halo mass relation, either 'Guo' or 'Moster'. Default is 'Guo'.")
+
+    args = parser.parse_args()
+
+    if args.collapse_shells and (args.disk_profile not in galaxy_history.COLLAPSE_DISK_PROFILES):
+        parser.error('--collapse-shells fits the stellar shells as double exponential disks, so it requires --disk-profile {0:s}, not {1:s}'.format(' or '.join(galaxy_history.COLLAPSE_DISK_PROFILES), args.disk_profile))
+
+    return args
+
+
+
+def main(args):
+    """
+    Main function.
+    """
+    start = time.time()
+
+    if args.table_dirpath is not None:
+        cache.TABLE_DIRPATH = args.table_dirpath
+
+    # --- read the sgrb hostprops table once, and choose the hosts
+    sgrb_host_properties = galaxy_history.read_sgrb_hosts(args.sgrb_path)
+    grbs = args.grbs if args.grbs else list(sgrb_host_properties['GRB'])
+    missing = [grb for grb in grbs if grb not in set(sgrb_host_properties['GRB'])]
+    if missing:
+        raise ValueError('GRBs {0:s} are not in the sGRB table {1:s}!'.format(', '.join(missing), args.sgrb_path))
+
+    host_infos = [sgrb_host_properties.loc[sgrb_host_properties['GRB'] == grb].iloc[0] for grb in grbs]
+    if args.ensemble:
+        tasks = host_infos
+        func = partial(construct_host_ensemble, args=args)
+    else:
+        tasks = [(gal_info, sigma) for gal_info in host_infos for sigma in args.smhm_sigmas]
+        func = partial(construct_galaxy, args=args)
+    print('Constructing {0:d} galaxies ({1:d} hosts, {2:d} SMHM sigmas)...\n'.format(len(grbs)*len(args.smhm_sigmas), len(grbs), len(args.smhm_sigmas)))
+
+    # --- build the host-independent tables before forking, so the workers share them
+    warm_tables(args)
+
+    if args.multiproc:
+        if args.multiproc=='max':
+            mp = multiprocessing.cpu_count()
+        else:
+            mp = int(args.multiproc)
+
+        print('Parallelizing over {0:d} cores...\n'.format(mp))
+        pool = multiprocessing.Pool(mp)
+        results = list(pool.imap_unordered(func, tasks))
+        pool.close()
+        pool.join()
+    else:
+        results = [func(task) for task in tasks]
+
+    # --- report any hosts that failed, after the others have finished
+    failed = [(label, err) for label, err in results if err is not None]
+    for label, err in failed:
+        print('Constructing {0:s} failed:\n{1:s}'.format(label, err))
+
+    print('Finished {0:d} of {1:d} {2:s}! It took {3:0.2f}s\n'.format(len(tasks)-len(failed), len(tasks), 'hosts' if args.ensemble else 'galaxies', time.time()-start))
+
+    return
+
+
+
+def warm_tables(args):
+    """Constructs the tables shared by every host.
+    """
+    baryons.sfr_ms_speagle()
+    if args.smhm_relation=='Moster':
+        halos.moster_1205_5807()
+    if args.disk_profile=='MNExponential' or args.collapse_shells:
+        disks.fit_miyamoto_nagai(args.z_scale)
+
+    return
+
+
+
+def construct_galaxy(task, args):
+    """Constructs and saves the galaxy model of a single host and SMHM sigma.
+
+    Returns the label of the galaxy, and the traceback if it could not be constructed (otherwise None).
+    """
+    gal_info, sigma = task
+    grb = gal_info['GRB']
+    label = '{0:s}_sigma{1:g}_hostgal'.format(grb, sigma)
+
+    try:
+        start = time.time()
+        outdir = os.path.join(args.output_dirpath, grb)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir, exist_ok=True)
+
+        gal = None
+        if args.cache_dirpath:
+            gal_inputs = cache.galaxy_inputs(gal_info, \
+                            disk_profile = args.disk_profile, \
+                            dm_profile = args.dm_profile, \
+                            smhm_relation = args.smhm_relation, \
+                            smhm_sigma = sigma, \
+                            bulge_profile = args.bulge_profile, \
+                            z_scale = args.z_scale, \
+                            differential_prof = args.differential_prof, \
+                            collapse_shells = args.collapse_shells, \
+                            coarsen_tol = args.coarsen_tol)
+            _, gal = cache.load_galaxy(args.cache_dirpath, gal_inputs)
+
+        if gal is None:
+            gal = galaxy_history.GalaxyHistory(\
+                            obs_props = galaxy_history.host_obs_props(gal_info),\
+                            disk_profile = args.disk_profile,\
+                            dm_profile = args.dm_profile,\
+                            smhm_relation = args.smhm_relation,\
+                            smhm_sigma = sigma,\
+                            bulge_profile = args.bulge_profile,\
+                            z_scale = args.z_scale,\
+                            differential_prof = args.differential_prof,\
+                            collapse_shells = args.collapse_shells,\
+                            coarsen_tol = args.coarsen_tol,\
+                            sfr_cache_dirpath = args.cache_dirpath,\
+                            )
+            if args.cache_dirpath:
+                cache.save_galaxy(args.cache_dirpath, gal_inputs, gal)
+
+        gal.write(outdir, label, fmt=args.gal_format)
+        print('   constructed {0:s} in {1:0.2f}s...\n'.format(label, time.time()-start))
+
+    except Exception:
+        return label, traceback.format_exc()
+
+    return label, None
+
+
+
+def construct_host_ensemble(gal_info, args):
+    """Constructs and saves the realizations of a single host for every SMHM sigma (see galaxy_history.construct_ensemble).
+
+    Returns the label of the ensemble, and the traceback if it could not be constructed (otherwise None).
+    """
+    grb = gal_info['GRB']
+    label = '{0:s}_ensemble'.format(grb)
+
+    try:
+        start = time.time()
+        outdir = os.path.join(args.output_dirpath, grb)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir, exist_ok=True)
+
+        ensemble = galaxy_history.construct_ensemble(\
+                        obs_props = galaxy_history.host_obs_props(gal_info),\
+                        smhm_sigmas = args.smhm_sigmas,\
+                        disk_profile = args.disk_profile,\
+                        dm_profile = args.dm_profile,\
+                        smhm_relation = args.smhm_relation,\
+                        bulge_profile = args.bulge_profile,\
+                        z_scale = args.z_scale,\
+                        differential_prof = args.differential_prof,\
+                        collapse_shells = args.collapse_shells,\
+                        coarsen_tol = args.coarsen_tol,\
+                        sfr_cache_dirpath = args.cache_dirpath,\
+                        )
+
+        galaxy_history.write_ensemble(ensemble, outdir, label)
+        print('   constructed {0:s} in {1:0.2f}s...\n'.format(label, time.time()-start))
+
+    except Exception:
+        return label, traceback.format_exc()
+
+    return label, None
+
+
+
+# MAIN FUNCTINON
+if __name__ == '__main__':
+    args = parse_commandline()
+
+    main(args)
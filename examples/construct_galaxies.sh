@@ -0,0 +1,20 @@
+#!/bin/bash
+
+# Constructs the galaxy models of every host in the sGRB table, for SMHM sigmas of -1, 0, and 1.
+# Usage: construct_galaxies.sh <sgrb_path> <output_dirpath>
+# The models are saved as <output_dirpath>/<grb>/<grb>_sigma<sigma>_hostgal.pkl, which can then be used with
+# run.py --gal-path <output_dirpath>/<grb>/<grb>_sigma<sigma>_hostgal.pkl --output-dirpath <output_dirpath>/<grb>/
+
+sgrb_path=$1
+output_dirpath=$2
+
+python $(dirname $0)/../construct_galaxies.py \
+--sgrb-path ${sgrb_path} \
+--output-dirpath ${output_dirpath} \
+--smhm-sigmas -1 0 1 \
+--multiproc max \
+--disk-profile DoubleExponential \
+--dm-profile NFW \
+--z-scale 0.05 \
+--differential-prof \
+--smhm-relation Moster \
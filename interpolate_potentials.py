@@ -18,10 +18,9 @@ from functools import partial
 import astropy.units as u
 import astropy.constants as C
 
-from galpy.potential import RazorThinExponentialDiskPotential, DoubleExponentialDiskPotential, NFWPotential
-from galpy.potential import interpRZPotential
-
 from kickIT import utils
+from kickIT import interpolate
+from kickIT import galaxy_history
 
 # --- Specify arguments for the interpolation function
 def parse_commandline():
@@ -31,15 +30,18 @@ def parse_commandline():
     parser = argparse.ArgumentParser()
 
     # default information
-    parser.add_argument('-g', '--gal-path', type=str, help="Path to pickled gal file that we want to create interpolants for.")
+    parser.add_argument('-g', '--gal-path', type=str, help="Path to the gal file that we want to create interpolants for, either pickled or in the HDF5 format.")
     parser.add_argument('-mp', '--multiproc', type=str, default=None, help="If specified, will parallelize over the number of cores provided as an argument. Can also use the string 'max' to parallelize over all available cores. Default is None.")
     parser.add_argument('--interp-path', type=str, default='./interp.pkl', help="Path to where the interpolation file will be saved. Default is '/.interp.pkl'.")
+    parser.add_argument('--interp-dirpath', type=str, default=None, help="If specified, saves the interpolations as separate per-timestep files in this directory (for use with run.py --interp-dirpath) rather than a single file at --interp-path. Default is None.")
+    parser.add_argument('--timesteps', type=int, nargs='+', default=None, help="Only interpolate these timesteps; requires --interp-dirpath. Default is all timesteps.")
 
     # defining grid properties for interpolations
     parser.add_argument('-rg', '--Rgrid', type=int, default=100, help="Number of gridpoints for the Z-component of the interpolation model. Default is 100.")
     parser.add_argument('-zg', '--Zgrid', type=int, default=50, help="Number of gridpoints for the Z-component of the interpolation model. Default is 50.") 
     parser.add_argument('--Rgrid-max', type=float, default=1e3, help="Maximum R value for interpolated potentials. Default is 1e3.")
     parser.add_argument('--Zgrid-max', type=float, default=1e2, help="Maximum Z value for interpolated potentials. Default is 1e2.")
+    parser.add_argument('--force-rtol', type=float, default=None, help="Target fractional force error of the interpolated potentials. If specified, the number of R and Z gridpoints are chosen adaptively to meet this tolerance, and the values of --Rgrid and --Zgrid are ignored. Default is None.")
 
     args = parser.parse_args()
 
@@ -56,42 +58,68 @@ def main(args):
 
 
     # --- read galaxy file
-    gal = pickle.load(open(args.gal_path, 'rb'))
+    gal = galaxy_history.read_galaxy(args.gal_path)
+
+    # --- choose the grid adaptively, if a force tolerance is specified
+    Rgrid, Zgrid = args.Rgrid, args.Zgrid
+    if args.force_rtol:
+        Rgrid, Zgrid, _ = interpolate.select_grid(gal, args.force_rtol, \
+                    Rgrid_max = args.Rgrid_max, \
+                    Zgrid_max = args.Zgrid_max)
+
+    # --- if saving per-timestep files, build (or reuse) only the interpolants that are missing
+    if args.interp_dirpath:
+        provider = interpolate.InterpolantProvider(gal, args.interp_dirpath, \
+                    Rgrid = Rgrid, \
+                    Zgrid = Zgrid, \
+                    Rgrid_max = args.Rgrid_max, \
+                    Zgrid_max = args.Zgrid_max)
+        steps = args.timesteps if args.timesteps else range(len(gal.times))
+        construct_provider_interpolants(provider, steps, multiproc=args.multiproc)
+        interps = provider
+        # only validate interpolants that were built, so that validation does not build any others
+        built = sorted(set(provider.epoch(step) for step in steps))
+        validate_steps = [step for step in interpolate.test_steps(gal) if provider.epoch(step) in built] or built
 
     # --- create interpolatnts for the potentials in gal class
-    interps = construct_interpolants(gal, \
+    else:
+        interps = construct_interpolants(gal, \
                     multiproc = args.multiproc, \
-                    Rgrid = args.Rgrid, \
-                    Zgrid = args.Zgrid, \
+                    Rgrid = Rgrid, \
+                    Zgrid = Zgrid, \
                     Rgrid_max = args.Rgrid_max, \
                     Zgrid_max = args.Zgrid_max)
+        validate_steps = None
 
-    pickle.dump(interps, open(args.interp_path, 'wb'))
+    # --- report the achieved accuracy against direct evaluation of the potentials
+    if args.force_rtol:
+        print('Validating interpolated potentials against direct evaluation...\n')
+        interpolate.validate_interpolants(gal, interps, *interpolate.interp_grids(Rgrid, Zgrid, args.Rgrid_max, args.Zgrid_max), steps=validate_steps)
+
+    if not args.interp_dirpath:
+        pickle.dump(interps, open(args.interp_path, 'wb'))
 
 
 
 def construct_interpolants(gal, multiproc=None, Rgrid=500, Zgrid=100, Rgrid_max=1000, Zgrid_max=100, ro=8*u.kpc, vo=220*u.km/u.s):
     """Creates interpolants for combined potentials specified in gal class. 
     To implement multiprocessing, specify an int for the argument 'multiproc'.
+    If the potential time grid of the gal class was coarsened, only the first timestep of each epoch is interpolated, and the other timesteps of the epoch share its interpolant.
     """
     
     print('Creating interpolation models of combined galactic potentials at each redshift...\n')
 
-    # --- create the grid of rads and heights we will be using
-    rad_range = np.asarray([1e-4, Rgrid_max])*u.kpc
-    height_range = np.asarray([0, Zgrid_max])*u.kpc
-
-    # need to convert Rs and Zs to natural units
-    rads = (rad_range / ro).value
-    heights = (height_range / ro).value
-
-    rs = (*rads, Rgrid)
-    logrs = (*np.log10(rads), Rgrid)
-    zs = (*heights, Zgrid)
-            
+    # --- create the grid of rads and heights we will be using, in natural units
+    logrs, zs = interpolate.interp_grids(Rgrid, Zgrid, Rgrid_max, Zgrid_max, ro=ro)
 
     # --- set up the interpolation function
-    func = partial(interp_func, rgrid=logrs, zgrid=zs)
+    func = partial(interpolate.interp_func, rgrid=logrs, zgrid=zs, ro=ro, vo=vo)
+
+    # --- timesteps whose potentials need to be interpolated
+    epochs = getattr(gal, 'potential_epochs', None)
+    if epochs is None:
+        epochs = np.arange(len(gal.full_potentials_natural))
+    steps = np.unique(epochs)
 
     # --- enable multiprocessing, if specified
     if multiproc:
@@ -101,11 +129,10 @@ def construct_interpolants(gal, multiproc=None, Rgrid=500, Zgrid=100, Rgrid_max=
             mp = int(multiproc)
 
         pool = multiprocessing.Pool(mp)
-        func = partial(interp_func, rgrid=logrs, zgrid=zs)
 
         start = time.time()
         print('Parallelizing interpolations over {0:d} cores...\n'.format(mp))
-        interpolated_potentials = pool.map(func, gal.full_potentials_natural)
+        interpolated_potentials = pool.map(func, [gal.full_potentials_natural[ii] for ii in steps])
         stop = time.time()
         print('   finished! It took {0:0.2f}s\n'.format(stop-start))
         
@@ -114,28 +141,62 @@ def construct_interpolants(gal, multiproc=None, Rgrid=500, Zgrid=100, Rgrid_max=
     else:
         print('Interpolating potentials in serial...\n')
         interpolated_potentials=[]
-        for ii, data in enumerate(gal.full_potentials_natural):
+        for ii in steps:
 
             start = time.time()
-            ip = func(data)
+            ip = func(gal.full_potentials_natural[ii])
             end = time.time()
             print('   interpolated potential for step {0:d} (z={1:0.2f}) created in {2:0.2f}s...'.format(ii,gal.redz[ii],end-start))
 
             interpolated_potentials.append(ip)
 
+    # --- every timestep gets the interpolant of its epoch
+    interpolated_potentials = dict(zip(steps, interpolated_potentials))
+    interpolated_potentials = [interpolated_potentials[ii] for ii in epochs]
+
     return interpolated_potentials
 
 
-# --- define interpolating function
-def interp_func(potentials, rgrid, zgrid, ro=8*u.kpc, vo=220*u.km/u.s):
-    ip = interpRZPotential(potentials, rgrid=rgrid, zgrid=zgrid, logR=True, interpRforce=True, interpzforce=True, zsym=True, ro=ro, vo=vo)
-    return ip
 
 
 
 
 
 
+def construct_provider_interpolants(provider, steps, multiproc=None):
+    """Builds the interpolants of an InterpolantProvider at the specified timesteps, skipping any that already exist.
+    To implement multiprocessing, specify an int for the argument 'multiproc'.
+    """
+    steps = sorted(set(provider.epoch(step) for step in steps))
+    steps = [step for step in steps if not provider.exists(step)]
+    print('Creating interpolation models for {0:d} timesteps in {1:s}...\n'.format(len(steps), provider.dirpath))
+
+    start = time.time()
+    if multiproc:
+        if multiproc=='max':
+            mp = multiprocessing.cpu_count()
+        else:
+            mp = int(multiproc)
+
+        print('Parallelizing interpolations over {0:d} cores...\n'.format(mp))
+        pool = multiprocessing.Pool(mp)
+        pool.map(partial(build_step, provider=provider), steps)
+        pool.close()
+        pool.join()
+    else:
+        for step in steps:
+            build_step(step, provider)
+    stop = time.time()
+    print('   finished! It took {0:0.2f}s\n'.format(stop-start))
+
+    return
+
+
+def build_step(step, provider):
+    provider.build(step)
+    return
+
+
 # MAIN FUNCTINON
 if __name__ == '__main__':
     args = parse_commandline()
@@ -0,0 +1,228 @@
+"""Mergeable streaming aggregates of the tracer results.
+
+Most analyses only need distributions of the results, e.g. of the projected offsets of the tracers born at each timestep, the merger redshifts, and the fraction of tracers that escape their host. The aggregates are updated with blocks of tracers as their orbits are integrated, so the per-tracer results need not be kept, and are sums over the tracers, so the aggregates of separate workers or runs are combined exactly with merge. They are saved to the 'aggregates' group of the output file.
+"""
+import json
+
+import numpy as np
+
+from . import __version__
+from .lazy import lazy_import
+
+h5py = lazy_import('h5py')
+
+
+FORMAT_NAME = 'kickIT-aggregates'
+FORMAT_VERSION = 1
+GROUP = 'aggregates'
+
+# Default bin edges of the systemic velocity [km/s], projected offset [kpc], and merger redshift
+VSYS_EDGES = np.linspace(0, 1000, 11)
+OFFSET_EDGES = np.logspace(-2, 4, 61)
+REDZ_EDGES = np.linspace(0, 10, 101)
+
+# Relative accuracy of the quantiles of the projected offsets, and the range of offsets [kpc] the sketches cover
+SKETCH_ACCURACY = 0.01
+SKETCH_MIN = 1e-3
+SKETCH_MAX = 1e5
+
+# Tracer counts kept per key: every tracer, those disrupted by the SN, those that merged before the sGRB, and those born unbound (Vpost > Vesc)
+COUNTS = ['total', 'disrupted', 'merged', 'escaped']
+
+
+class WeightedHistogram:
+    """Weighted histograms of a quantity, one for each of nkeys keys.
+
+    Values below or above the edges are counted in an underflow and overflow bin, so that bin i (for 0 < i < len(edges)) counts the values in [edges[i-1], edges[i]). NaN values are not counted.
+    """
+    def __init__(self, edges, nkeys):
+        self.edges = np.asarray(edges, dtype=float)
+        if np.any(np.diff(self.edges) <= 0):
+            raise ValueError('Histogram edges must be strictly increasing!')
+        self.counts = np.zeros((nkeys, len(self.edges)+1))
+
+    def add(self, keys, values, weights):
+        values = np.asarray(values, dtype=float)
+        counted = ~np.isnan(values)
+        bins = np.searchsorted(self.edges, values[counted], side='right')
+        flat = np.asarray(keys)[counted]*self.counts.shape[1] + bins
+        self.counts += np.bincount(flat, weights[counted], minlength=self.counts.size).reshape(self.counts.shape)
+
+    def merge(self, other):
+        if (self.counts.shape != other.counts.shape) or np.any(self.edges != other.edges):
+            raise ValueError('Cannot merge histograms with different keys or bins!')
+        self.counts += other.counts
+
+
+class QuantileSketch(WeightedHistogram):
+    """Weighted histograms with log-spaced bins, whose quantiles are estimated to within a relative accuracy.
+
+    The bins between vmin and vmax grow by a factor (1+accuracy)/(1-accuracy), so that the harmonic mean of the edges of a bin is within the accuracy of any value in it (as in DDSketch). Quantiles in the underflow or overflow bin are returned as vmin or vmax.
+    """
+    def __init__(self, nkeys, accuracy=SKETCH_ACCURACY, vmin=SKETCH_MIN, vmax=SKETCH_MAX):
+        gamma = (1+accuracy) / (1-accuracy)
+        nbins = int(np.ceil(np.log(vmax/vmin) / np.log(gamma)))
+        super().__init__(vmin*gamma**np.arange(nbins+1), nkeys)
+
+    def quantile(self, q, keys=slice(None)):
+        """Quantiles q of the values of the keys (e.g. an index, slice, or boolean mask), combined.
+        """
+        counts = np.atleast_2d(self.counts[keys]).sum(axis=0)
+        cumulative = np.cumsum(counts)
+        if cumulative[-1] == 0:
+            return np.full(np.shape(q), np.nan)
+        bins = np.searchsorted(cumulative, np.asarray(q)*cumulative[-1], side='left')
+        # representative value of each bin, with the underflow and overflow bins at the edges of the sketch
+        lo, hi = self.edges[:-1], self.edges[1:]
+        values = np.concatenate([[self.edges[0]], 2*lo*hi/(lo+hi), [self.edges[-1]]])
+        return values[np.clip(bins, 0, len(values)-1)]
+
+
+
+class TracerAggregates:
+    """Streaming aggregates of the tracer results, keyed by the birth timestep (t0) and systemic-velocity bin of the tracers.
+
+    For each key, keeps the (weighted) tracer counts in COUNTS, histograms of the projected offsets and merger redshifts, and a QuantileSketch of the projected offsets. Systemic velocities outside vsys_edges are counted in an underflow and overflow bin, as in WeightedHistogram.
+    """
+    def __init__(self, nsteps, vsys_edges=VSYS_EDGES, offset_edges=OFFSET_EDGES, redz_edges=REDZ_EDGES, sketch_accuracy=SKETCH_ACCURACY):
+        self.vsys_edges = np.asarray(vsys_edges, dtype=float)
+        self.shape = (nsteps, len(self.vsys_edges)+1)
+        nkeys = self.shape[0]*self.shape[1]
+        self.sketch_accuracy = sketch_accuracy
+
+        self.counts = {name: np.zeros(nkeys) for name in COUNTS}
+        self.offsets = WeightedHistogram(offset_edges, nkeys)
+        self.offset_sketch = QuantileSketch(nkeys, sketch_accuracy)
+        self.merger_redz = WeightedHistogram(redz_edges, nkeys)
+
+
+    def keys(self, t0, Vsys):
+        """Flat keys of tracers born at timesteps t0 with systemic velocities Vsys [km/s].
+        """
+        vbins = np.searchsorted(self.vsys_edges, np.asarray(Vsys, dtype=float), side='right')
+        return np.ravel_multi_index((np.asarray(t0, dtype=int), vbins), self.shape)
+
+
+    def add(self, t0, Vsys, Rproj_offset, merger_redz, weights=None):
+        """Adds a block of integrated tracers, with their birth timesteps, systemic velocities [km/s], projected offsets [kpc], and merger redshifts (as in integrate_orbits, 0 if they did not merge before the sGRB).
+
+        Tracers whose offset is NaN were disrupted by the SN. Rproj_offset may also hold the projected offsets of each tracer along several sightlines (Ntracers x Nsight), which are added to the offset histograms and sketches with an equal share of the weight of the tracer.
+        """
+        keys = self.keys(t0, Vsys)
+        if len(keys) == 0:
+            return
+        weights = np.ones(len(keys)) if weights is None else np.broadcast_to(np.asarray(weights, dtype=float), keys.shape)
+        Rproj_offset = np.asarray(Rproj_offset, dtype=float).reshape(len(keys), -1)
+        nsight = Rproj_offset.shape[1]
+        merged = np.asarray(merger_redz, dtype=float) > 0
+        merger_redz = np.where(merged, merger_redz, np.nan)
+
+        for name, selected in [('total', slice(None)), ('disrupted', np.isnan(Rproj_offset[:,0])), ('merged', merged)]:
+            self.counts[name] += np.bincount(keys[selected], weights[selected], minlength=len(self.counts[name]))
+        sample_keys, sample_weights = np.repeat(keys, nsight), np.repeat(weights/nsight, nsight)
+        self.offsets.add(sample_keys, Rproj_offset.ravel(), sample_weights)
+        self.offset_sketch.add(sample_keys, Rproj_offset.ravel(), sample_weights)
+        self.merger_redz.add(keys, merger_redz, weights)
+
+
+    def add_escaped(self, t0, Vsys, escaped, weights=None):
+        """Counts the tracers that escaped, given their birth timesteps, systemic velocities [km/s], and whether each escaped.
+        """
+        keys = self.keys(t0, Vsys)
+        weights = np.ones(len(keys)) if weights is None else np.broadcast_to(np.asarray(weights, dtype=float), keys.shape)
+        escaped = np.asarray(escaped, dtype=bool)
+        self.counts['escaped'] += np.bincount(keys[escaped], weights[escaped], minlength=len(self.counts['escaped']))
+
+
+    def merge(self, other):
+        """Adds the aggregates of other, which must have the same keys and bins, to these.
+        """
+        if (self.shape != other.shape) or np.any(self.vsys_edges != other.vsys_edges):
+            raise ValueError('Cannot merge aggregates with different keys!')
+        for name in COUNTS:
+            self.counts[name] += other.counts[name]
+        self.offsets.merge(other.offsets)
+        self.offset_sketch.merge(other.offset_sketch)
+        self.merger_redz.merge(other.merger_redz)
+
+        return self
+
+
+    def select(self, t0=slice(None), vbin=slice(None)):
+        """Boolean mask of the flat keys of the birth timesteps t0 and systemic-velocity bins vbin (indices or slices, with vbin 0 the underflow bin).
+        """
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[t0, vbin] = True
+        return mask.ravel()
+
+
+    def count(self, name, t0=slice(None), vbin=slice(None)):
+        """Combined count of name in COUNTS for the selected keys (see select).
+        """
+        return self.counts[name][self.select(t0, vbin)].sum()
+
+
+    def fraction(self, name, t0=slice(None), vbin=slice(None)):
+        """Fraction of the selected tracers (see select) in the count name, e.g. the escaped fraction.
+        """
+        total = self.count('total', t0, vbin)
+        return self.count(name, t0, vbin) / total if total > 0 else np.nan
+
+
+    def histogram(self, name, t0=slice(None), vbin=slice(None)):
+        """Combined histogram of 'offsets' or 'merger_redz' for the selected keys (see select), with the underflow and overflow bins first and last, and its edges.
+        """
+        if name not in ['offsets', 'merger_redz']:
+            raise NameError("Histogram '{0:s}' not recognized!".format(name))
+        hist = getattr(self, name)
+        return hist.counts[self.select(t0, vbin)].sum(axis=0), hist.edges
+
+
+    def offset_quantiles(self, q, t0=slice(None), vbin=slice(None)):
+        """Quantiles q of the projected offsets [kpc] of the selected tracers (see select), to within the relative accuracy of the sketch.
+        """
+        return self.offset_sketch.quantile(q, self.select(t0, vbin))
+
+
+    def write(self, path):
+        """Writes the aggregates to the 'aggregates' group of the HDF5 file at path, replacing any there.
+        """
+        with h5py.File(path, 'a') as f:
+            if GROUP in f:
+                del f[GROUP]
+            group = f.create_group(GROUP)
+            group.attrs['format'] = FORMAT_NAME
+            group.attrs['format_version'] = FORMAT_VERSION
+            group.attrs['kickIT_version'] = __version__
+            group.attrs['shape'] = self.shape
+            group.attrs['sketch_accuracy'] = self.sketch_accuracy
+            group.attrs['counts'] = json.dumps(COUNTS)
+            group.create_dataset('vsys_edges', data=self.vsys_edges)
+            for name in COUNTS:
+                group.create_dataset('count_'+name, data=self.counts[name])
+            for name, hist in [('offsets', self.offsets), ('offset_sketch', self.offset_sketch), ('merger_redz', self.merger_redz)]:
+                group.create_dataset(name+'_edges', data=hist.edges)
+                group.create_dataset(name, data=hist.counts, compression='gzip', shuffle=True)
+
+
+
+def read_aggregates(path):
+    """Reads the TracerAggregates from the HDF5 file at path.
+    """
+    with h5py.File(path, 'r') as f:
+        if GROUP not in f:
+            raise ValueError('{0:s} does not contain aggregates!'.format(path))
+        group = f[GROUP]
+        if group.attrs.get('format') != FORMAT_NAME:
+            raise ValueError('{0:s} does not contain aggregates in the {1:s} format!'.format(path, FORMAT_NAME))
+        if group.attrs['format_version'] > FORMAT_VERSION:
+            raise ValueError('Aggregates in {0:s} have format version {1:d}, but this version of kickIT only reads up to version {2:d}!'.format(path, group.attrs['format_version'], FORMAT_VERSION))
+
+        aggregates = TracerAggregates(int(group.attrs['shape'][0]), vsys_edges=group['vsys_edges'][()], offset_edges=group['offsets_edges'][()], redz_edges=group['merger_redz_edges'][()], sketch_accuracy=float(group.attrs['sketch_accuracy']))
+        for name in COUNTS:
+            aggregates.counts[name] = group['count_'+name][()]
+        for name in ['offsets', 'offset_sketch', 'merger_redz']:
+            getattr(aggregates, name).edges = group[name+'_edges'][()]
+            getattr(aggregates, name).counts = group[name][()]
+
+    return aggregates
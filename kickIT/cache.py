@@ -0,0 +1,213 @@
+"""Content-addressed cache for galaxy models, SFR history solutions, potential interpolations, and the tables of the scaling relations.
+
+Artifacts are stored under a key that is the hash of everything that went into building them (the host properties, the galaxy and grid options, and the code version), so changing any input results in a new entry rather than silently reusing a stale one.
+"""
+import os
+import json
+import warnings
+import hashlib
+import pickle
+
+import numpy as np
+
+from . import __version__
+
+
+VERBOSE = True
+
+# Directory of the tables that only depend on the code (e.g. the Monte Carlo scaling relations), shared by every run. Nothing is written to disk unless it is set, through the KICKIT_TABLE_DIRPATH environment variable or the --table-dirpath option of the scripts; if None (or the variable is empty), the tables are recalculated in every process.
+TABLE_DIRPATH = os.environ.get('KICKIT_TABLE_DIRPATH') or None
+# Incremented whenever the way that the tables are calculated changes
+TABLE_VERSION = 1
+# Incremented whenever the way that the potential interpolations are built changes (2: radial grid flat in ln(R) rather than log10(R))
+INTERP_VERSION = 2
+
+
+def _jsonable(value):
+    """Converts numpy scalars and NaNs to types with a stable JSON representation.
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def atomic_write(path, writer, mode='wb'):
+    """Writes a file at path with writer(f), given the file opened with mode.
+
+    The file is written to a temporary file first and then moved into place, so other processes never read a partial file.
+    """
+    tmp_path = path+'.tmp{0:d}'.format(os.getpid())
+    try:
+        with open(tmp_path, mode) as f:
+            writer(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return
+
+
+def input_hash(inputs):
+    """Hash of a dictionary of inputs, independent of the key ordering.
+    """
+    blob = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()[:16]
+
+
+def host_inputs(gal_info):
+    """Dictionary of the host galaxy properties from a row of the sGRB host table.
+    """
+    return {str(key): _jsonable(value) for key, value in gal_info.items()}
+
+
+def galaxy_inputs(gal_info, disk_profile, dm_profile, smhm_relation, smhm_sigma, bulge_profile, z_scale, differential_prof, collapse_shells=False, coarsen_tol=None):
+    """Dictionary of everything that determines a galaxy model.
+    """
+    inputs = {
+        'host': host_inputs(gal_info),
+        'disk_profile': disk_profile,
+        'dm_profile': dm_profile,
+        'smhm_relation': smhm_relation,
+        'smhm_sigma': smhm_sigma,
+        'bulge_profile': bulge_profile,
+        'z_scale': z_scale,
+        'differential_prof': differential_prof,
+        'collapse_shells': collapse_shells,
+        'coarsen_tol': coarsen_tol,
+        'version': __version__,
+        }
+    return inputs
+
+
+def interp_inputs(gal_key, Rgrid, Zgrid, Rgrid_max, Zgrid_max):
+    """Dictionary of everything that determines the potential interpolations of a galaxy model.
+    """
+    inputs = {
+        'galaxy': gal_key,
+        'Rgrid': Rgrid,
+        'Zgrid': Zgrid,
+        'Rgrid_max': Rgrid_max,
+        'Zgrid_max': Zgrid_max,
+        'version': __version__,
+        'interp_version': INTERP_VERSION,
+        }
+    return inputs
+
+
+def entry_dirpath(cache_dirpath, kind, inputs):
+    """Directory of the cache entry for this kind of artifact and set of inputs.
+
+    The inputs are saved alongside the artifact when the entry is created, and are checked every time the entry is looked up.
+    """
+    key = input_hash(inputs)
+    dirpath = os.path.join(cache_dirpath, kind, key)
+    inputs_path = os.path.join(dirpath, 'inputs.json')
+
+    if os.path.exists(inputs_path):
+        saved_inputs = json.load(open(inputs_path, 'r'))
+        if saved_inputs != json.loads(json.dumps(inputs, sort_keys=True, default=str)):
+            raise ValueError('Cache entry {0:s} does not match the requested inputs!'.format(dirpath))
+    else:
+        os.makedirs(dirpath, exist_ok=True)
+        atomic_write(inputs_path, lambda f: json.dump(inputs, f, sort_keys=True, default=str, indent=2), mode='w')
+
+    return key, dirpath
+
+
+def load_galaxy(cache_dirpath, inputs):
+    """Returns the cached galaxy model for these inputs, or None if it has not been built.
+    """
+    key, dirpath = entry_dirpath(cache_dirpath, 'galaxies', inputs)
+    path = os.path.join(dirpath, 'galaxy.pkl')
+    if not os.path.exists(path):
+        return key, None
+
+    if VERBOSE:
+        print('Using cached galaxy realization {0:s}...\n'.format(key))
+    gal = pickle.load(open(path, 'rb'))
+
+    return key, gal
+
+
+def save_galaxy(cache_dirpath, inputs, gal):
+    """Adds a galaxy model to the cache.
+    """
+    key, dirpath = entry_dirpath(cache_dirpath, 'galaxies', inputs)
+    path = os.path.join(dirpath, 'galaxy.pkl')
+
+    atomic_write(path, lambda f: pickle.dump(gal, f))
+
+    if VERBOSE:
+        print('Saved galaxy realization {0:s} to the cache...\n'.format(key))
+
+    return key
+
+
+def load_sfr_params(cache_dirpath, inputs):
+    """Returns the cached SFR history solution of GalaxyHistory.calc_sfr_params for these inputs, or None if it has not been calculated.
+    """
+    path = os.path.join(cache_dirpath, 'sfr_params', input_hash(inputs)+'.json')
+    if not os.path.exists(path):
+        return None
+
+    entry = json.load(open(path, 'r'))
+    if entry['inputs'] != json.loads(json.dumps(inputs, sort_keys=True, default=str)):
+        raise ValueError('Cached SFR history solution {0:s} does not match the requested inputs!'.format(path))
+
+    return tuple(entry['params'])
+
+
+def save_sfr_params(cache_dirpath, inputs, params):
+    """Adds an SFR history solution of GalaxyHistory.calc_sfr_params to the cache.
+    """
+    dirpath = os.path.join(cache_dirpath, 'sfr_params')
+    if not os.path.exists(dirpath):
+        os.makedirs(dirpath, exist_ok=True)
+    path = os.path.join(dirpath, input_hash(inputs)+'.json')
+
+    entry = {'inputs': inputs, 'params': [float(val) for val in params]}
+    atomic_write(path, lambda f: json.dump(entry, f, sort_keys=True, default=str, indent=2), mode='w')
+
+    return
+
+
+def cached_table(name, inputs, build):
+    """Array that is expensive to calculate but only depends on the inputs, such as the percentiles of a Monte Carlo scaling relation.
+
+    The table is loaded from TABLE_DIRPATH if it has already been calculated with the same inputs and TABLE_VERSION, and is otherwise calculated with build() and saved there. The inputs must be JSON-serializable (i.e. arrays converted to lists).
+    """
+    if TABLE_DIRPATH is None:
+        return build()
+
+    inputs = dict(inputs, table=name, table_version=TABLE_VERSION)
+    blob = json.dumps(inputs, sort_keys=True, default=str)
+    path = os.path.join(TABLE_DIRPATH, '{0:s}_{1:s}.npz'.format(name, input_hash(inputs)))
+
+    if os.path.exists(path):
+        with np.load(path) as data:
+            if json.loads(str(data['inputs'])) != json.loads(blob):
+                raise ValueError('Cached table {0:s} does not match the requested inputs!'.format(path))
+            return data['table']
+
+    table = build()
+
+    try:
+        os.makedirs(TABLE_DIRPATH, exist_ok=True)
+        atomic_write(path, lambda f: np.savez(f, table=table, inputs=blob))
+    except OSError as err:
+        warnings.warn('Could not save table {0:s} to {1:s}, it will be recalculated next time ({2:s})'.format(name, TABLE_DIRPATH, str(err)))
+    else:
+        if VERBOSE:
+            print('Saved table {0:s} to {1:s}...\n'.format(name, path))
+
+    return table
+
+
+def interp_dirpath(cache_dirpath, inputs):
+    """Directory of the cached per-timestep interpolations for these inputs, for use with an InterpolantProvider.
+    """
+    _, dirpath = entry_dirpath(cache_dirpath, 'interpolants', inputs)
+    return dirpath
@@ -12,6 +12,7 @@ import astropy.constants as C
 from tqdm import tqdm
 
 from . import galaxy_history
+from . import tracer_storage
 
 
 
@@ -201,6 +202,21 @@ def weight_tracers_from_samples(tracers, Vsys_samps, Tinsp_samps, normalize=True
 
 
 
+# --- offsets of tracers at resampled inspiral times
+
+def offsets_at_tinsp(path, Tinsp):
+    """
+    Offsets of the tracers in the output file at path after the inspiral times Tinsp (in Gyr, one for all tracers or one per tracer)
+
+    Requires the tracers to have been evolved with elapsed_times (see Systems.evolve), and interpolates between the recorded snapshots, so the tracers need not be integrated again for each choice of inspiral times
+    """
+    Tinsp = u.Quantity(Tinsp, u.Gyr).value
+
+    return tracer_storage.read_elapsed_offsets(path, Tinsp)
+
+
+
+
 # --- weight tracers based on the observed offset of the sGRB
 
 def weight_tracers_from_observations(tracers, offset, offset_error, normalize=True):
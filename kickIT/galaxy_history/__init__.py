@@ -8,7 +8,7 @@ import itertools
 import os
 import pickle
 import time
-import pandas as pd
+import copy
 import multiprocessing
 from functools import partial
 
@@ -18,12 +18,15 @@ import astropy as ap
 import astropy.units as u
 import astropy.constants as C
 
-from galpy.potential import RazorThinExponentialDiskPotential, DoubleExponentialDiskPotential, NFWPotential
-from galpy.potential import interpRZPotential
-
 # Import of local modules must come after constants above
 from .. import utils
-from . import baryons, halos, cosmology
+from .. import cache
+from ..lazy import lazy_import
+from . import baryons, halos, disks, storage, engine
+
+# galpy is imported where the potentials are constructed, and pandas and astropy.cosmology when they are first used, since they are slow to import
+pd = lazy_import('pandas')
+cosmology = lazy_import(__name__+'.cosmology')
 
 
 # Specify initial redshift and number of timesteps
@@ -45,21 +48,145 @@ MAX_REDZ = 10.0
 MAX_STEPS = 300
 MAX_DM_FRAC = 0.01
 
+# Distance and velocity scales of galpy's natural units
+RO = 8*u.kpc
+VO = 220*u.km/u.s
+
 # Tolerance in choosing SF main sequence
 STAR_AGE_RTOL = 0.02
+# Search used to choose the SF main sequence ('refine' or 'grid'), and the spacing of the coarse subgrid for 'refine'
+SFR_PARAMS_METHOD = 'refine'
+SFR_COARSE_STEP = 5
+
+# Points where the forces are compared when coarsening the potential time grid, in kpc
+COARSEN_RADS = np.geomspace(0.1, RGRID_MAX, 20)
+COARSEN_HEIGHTS = np.concatenate([[0], np.geomspace(1, ZGRID_MAX, 3)])
 
 VERBOSE = True
 
+# Disk profiles whose stellar shells can be collapsed, since they are fit as double exponential disks
+COLLAPSE_DISK_PROFILES = ['DoubleExponential', 'MNExponential']
+
+# Attributes that are not saved in the HDF5 format, and the methods that rebuild them
+LAZY_ATTRS = {
+    'cosmo': '_init_cosmology',
+    'mass_sfr_prof': 'calc_mass_profiles_vs_time',
+    'mass_stars_prof': 'calc_mass_profiles_vs_time',
+    'mass_gas_prof': 'calc_mass_profiles_vs_time',
+    'mass_dm_prof': 'calc_mass_profiles_vs_time',
+    'stars_potentials_natural': '_calc_potentials_vs_time',
+    'gas_potentials_natural': '_calc_potentials_vs_time',
+    'dm_potentials_natural': '_calc_potentials_vs_time',
+    'full_potentials_natural': '_calc_potentials_vs_time',
+    }
+
+
+def read_sgrb_hosts(path):
+    """Reads the table of sGRB host galaxy properties as a pandas dataframe.
+    """
+    return pd.read_csv(path, delim_whitespace=True, na_values='-', converters={'GRB': lambda x: str(x)})
+
+
+def host_obs_props(gal_info):
+    """Observed properties of an sGRB host, as used by GalaxyHistory, from a row of the sGRB host table.
+    """
+    obs_props = {'name':gal_info['GRB'],\
+                      'pcc':gal_info['Pcc'],\
+                      'mass_stars':10**gal_info['log(M*)']*u.Msun,\
+                      'redz':gal_info['z'],\
+                      'age_stars':gal_info['PopAge']*u.Gyr,\
+                      'rad_eff':gal_info['r_e']*u.kpc,\
+                      'rad_offset':gal_info['deltaR']*u.kpc,\
+                      'rad_offset_error':gal_info['deltaR_err']*u.kpc,\
+                      'gal_sfr':gal_info['SFR']*u.Msun/u.yr
+                      }
+    return obs_props
+
+
+def construct_ensemble(obs_props, smhm_sigmas, **kwargs):
+    """Constructs realizations of a host galaxy for each of the deviations from the stellar mass-halo mass relation in smhm_sigmas, which only differ in their DM.
+
+    The SFR history (including the search in calc_sfr_params), the baryonic profiles, and the stellar and gas potentials are calculated once and shared by all realizations. The DM masses and profiles of the realizations are calculated together, and only their DM potentials are constructed separately. Other arguments are passed to GalaxyHistory.
+
+    Returns a list of GalaxyHistory instances, one for each value of smhm_sigmas.
+    """
+    smhm_sigmas = np.atleast_1d(np.asarray(smhm_sigmas, dtype=float))
+    gal = GalaxyHistory(obs_props, smhm_sigma=float(smhm_sigmas[0]), **kwargs)
+
+    print("Constructing the DM of {0:d} realizations with SMHM sigmas between {1:0.2f} and {2:0.2f}...\n".format(smhm_sigmas.size, np.min(smhm_sigmas), np.max(smhm_sigmas)))
+    start = time.time()
+
+    mass_dm = (halos.stellar_mass_to_halo_mass(gal.mass_stars.cgs.value, relation=gal.smhm_relation, sigma=smhm_sigmas)*u.g).to(u.Msun)
+    mass_dm_prof, Rscale_dm = gal.dm_profiles_vs_time(mass_dm)
+
+    ensemble = [gal]
+    for kk in range(1, smhm_sigmas.size):
+        member = copy.copy(gal)
+        member.smhm_sigma = float(smhm_sigmas[kk])
+        member.mass_dm, member.mass_dm_prof, member.Rscale_dm = mass_dm[kk], mass_dm_prof[kk], Rscale_dm[kk]
+        member.calc_dm_potentials_vs_time()
+        if member.coarsen_tol is not None:
+            member.calc_potential_epochs(member.coarsen_tol)
+        ensemble.append(member)
+
+    if VERBOSE:
+        print("   constructed {0:d} realizations in {1:0.2f}s (final DM masses: {2:0.1e} to {3:0.1e})\n".format(smhm_sigmas.size, time.time()-start, np.min(mass_dm[:,-1]), np.max(mass_dm[:,-1])))
+
+    return ensemble
+
+
+def read_galaxy(path):
+    """Reads a galaxy model, either pickled ('.pkl') or in the HDF5 format ('.h5' or '.hdf5').
+    """
+    if os.path.splitext(path)[1] in ['.h5', '.hdf5']:
+        gal = GalaxyHistory.__new__(GalaxyHistory)
+        gal.__dict__.update(storage.read_hdf(path))
+    else:
+        gal = pickle.load(open(path, 'rb'))
+    return gal
+
+
+def write_ensemble(ensemble, outdir, label=None):
+    """Writes an ensemble of realizations from construct_ensemble to a single HDF5 file (see storage.write_ensemble_hdf).
+    """
+    print("Writing galaxy ensemble in directory {0:s}...\n".format(outdir))
+    if label:
+        savepath = outdir+'/'+label+'.hdf5'
+    else:
+        savepath = outdir+'/ensemble.hdf5'
+    storage.write_ensemble_hdf(ensemble, savepath)
+    return
+
+
+def read_ensemble(path):
+    """Reads an ensemble of realizations written by write_ensemble, as a list of GalaxyHistory instances.
+    """
+    ensemble = []
+    for attrs in storage.read_ensemble_hdf(path):
+        gal = GalaxyHistory.__new__(GalaxyHistory)
+        gal.__dict__.update(attrs)
+        ensemble.append(gal)
+    return ensemble
+
 
 class GalaxyHistory:
     """Class for calculating SFR and mass histories of a galaxy, based on limited observations.
     """
 
 
-    def __init__(self, obs_props, disk_profile, dm_profile, smhm_relation='Guo', smhm_sigma=0.0, bulge_profile=None, z_scale=None, differential_prof=False):
+    def __init__(self, obs_props, disk_profile, dm_profile, smhm_relation='Guo', smhm_sigma=0.0, bulge_profile=None, z_scale=None, differential_prof=False, collapse_shells=False, coarsen_tol=None, sfr_cache_dirpath=None):
         """Units are kept as astropy quantities for clarity!
+
+        If collapse_shells==True (only used with differential_prof), the stellar shells accumulated by each timestep are represented by a single fit rather than one potential per shell (see disks.collapse_shells). The shells are fit as double exponential disks, so this requires a disk_profile in COLLAPSE_DISK_PROFILES and a z_scale.
+
+        If coarsen_tol is specified, consecutive timesteps whose potentials differ by less than this fractional force are merged into epochs that share a single potential (see calc_potential_epochs).
+
+        If sfr_cache_dirpath is specified, the solution of calc_sfr_params is cached in this directory, and reused by galaxies with the same observed properties (see cached_sfr_params).
         """
 
+        if collapse_shells and ((disk_profile not in COLLAPSE_DISK_PROFILES) or (z_scale is None)):
+            raise ValueError('Collapsing the stellar shells requires a disk profile in {0:s} and a z_scale, but got {1:s} and {2:s}!'.format(str(COLLAPSE_DISK_PROFILES), str(disk_profile), str(z_scale)))
+
         # Read in observed parameters of the sGRB host
         self.obs_props = obs_props
         self.disk_profile = disk_profile
@@ -69,9 +196,12 @@ class GalaxyHistory:
         self.bulge_profile = bulge_profile
         self.z_scale = z_scale
         self.differential_prof = differential_prof
+        self.collapse_shells = collapse_shells
+        self.coarsen_tol = coarsen_tol
+        self.sfr_cache_dirpath = sfr_cache_dirpath
 
         # Initiate cosmology
-        self.cosmo = cosmology.Cosmology()
+        self._init_cosmology()
 
         # Store tolerance for SFR calculation
         self.STAR_AGE_RTOL = STAR_AGE_RTOL
@@ -94,13 +224,40 @@ class GalaxyHistory:
         # Calculate the SFR weights at each timestep
         self.calc_sfr_weights()
 
+        # Collapse the accumulated stellar shells at each timestep
+        if self.differential_prof and self.collapse_shells:
+            self.calc_collapsed_shells()
+
         # Calculate galactic potentials vs time
         self.calc_potentials_vs_time(self.differential_prof)
-        self.calc_potentials_vs_time(self.differential_prof, method='natural')
 
+        # Merge timesteps with similar potentials
+        if self.coarsen_tol is not None:
+            self.calc_potential_epochs(self.coarsen_tol)
+
+        return
+
+
+
+    def __getattr__(self, name):
+        """Rebuilds the attributes that are not saved in the HDF5 format on first access.
+        """
+        # only called when the attribute does not exist, so anything else is a genuine error
+        if name not in LAZY_ATTRS:
+            raise AttributeError("'{0:s}' object has no attribute '{1:s}'".format(type(self).__name__, name))
+        getattr(self, LAZY_ATTRS[name])()
+        return self.__dict__[name]
+
+
+    def _init_cosmology(self):
+        self.cosmo = cosmology.Cosmology()
         return
 
 
+    def _calc_potentials_vs_time(self):
+        self.calc_potentials_vs_time(self.differential_prof)
+        return
+
 
     def calc_total_masses_vs_time(self):
         """Calculate the total-mass of stars, gas and DM based on galaxy scaling relations
@@ -114,7 +271,7 @@ class GalaxyHistory:
         mstar_end = self.obs_props['mass_stars']
 
         # Construct instance for calculating SFR Main-sequence relation (units in cgs)
-        sfr_ms = baryons.SFR_MS_Speagle_1405_2041()
+        sfr_ms = baryons.sfr_ms_speagle()
         MIN_MSTAR = 2*sfr_ms._MIN_MSTAR*u.g.to(u.Msun)*u.Msun
 
         # Find time and redshift of SFR peak from stellar-age of galaxy
@@ -127,7 +284,7 @@ class GalaxyHistory:
             print("Time of peak SFR: {0:0.2f} (z={1:0.2f})".format(time_sfr_peak, redz_sfr_peak))
 
         # Determine the approximate quenching time; use a grid-search to find quenching time and location in SFR--stellar-mass space to produce a galaxy with the correct properties
-        time_quench, sfr_ms_sigma, sfr_age, frac_err = self.calc_sfr_params()
+        time_quench, sfr_ms_sigma, sfr_age, frac_err = self.cached_sfr_params()
         time_quench *= u.s.to(u.Gyr)*u.Gyr
         sfr_age *= u.s.to(u.Gyr)*u.Gyr
         redz_quench = cosmo.tage_to_z(time_quench.cgs.value)
@@ -151,85 +308,21 @@ class GalaxyHistory:
         if frac > 0.05:
             warnings.warn("Significant galaxy growth during 'quiescent' phase!")
 
-        times = []
-        sfr = []
-        mass_stars = []
-
-        prev_mstar = q_mass_stars[0]
-        prev_time = q_times[0]
-        prev_sfr = q_gal_sfr[0]
-
-        temp_time = prev_time
-        temp_mstar = prev_mstar
-        ii = 0
-        while (temp_time > MIN_TIME) and (temp_mstar > MIN_MSTAR):
-            temp_dt = MAX_DT
-            temp_time = prev_time - temp_dt
-            if temp_time < 0.0:
-                temp_time = MIN_TIME
-                temp_dt = prev_time - temp_time
-
-            temp_mstar = prev_mstar - temp_dt * prev_sfr
-            if temp_mstar <= 0.0:
-                temp_dt = (prev_mstar - MIN_MSTAR)/prev_sfr
-                temp_time = prev_time - temp_dt
-                temp_mstar = prev_mstar - temp_dt * prev_sfr
-
-            try:
-                temp_sfr = sfr_ms.sfr_from_mstar(temp_mstar.cgs.value, temp_time.cgs.value, sfr_ms_sigma)[0] * u.g.to(u.Msun)/u.s.to(u.yr) * u.Msun/u.yr
-            except ValueError:
-                print("temp_mstar = {0:.2e}".format(tmp_mstar))
-                print("temp_time = {0:.2e}".format(temp_time))
-                print("sfr_ms_sigma = {0:.2e}".format(sfr_ms_sigma))
-                raise
-            if not np.isfinite(temp_sfr):
-                raise ValueError("Infinite `temp_sfr`!")
-
-            temp_dm = temp_sfr * temp_dt.to(u.yr)
-
-            if temp_dm/mstar_end > MAX_DM_FRAC:
-                temp_dt = (0.98*MAX_DM_FRAC*mstar_end / temp_sfr).to(u.Gyr)
-                temp_time = prev_time - temp_dt
-                temp_dm = temp_sfr * temp_dt
-
-                if temp_dm/self.obs_props['mass_stars'] > MAX_DM_FRAC:
-                    raise ValueError("Mass-change STILL too large!")
-
-            temp_mstar = prev_mstar - temp_dm
-            temp_sfr = sfr_ms.sfr_from_mstar(temp_mstar.cgs.value, temp_time.cgs.value, sfr_ms_sigma)[0] * (u.g.to(u.Msun)/u.s.to(u.yr))*(u.Msun/u.yr)
-            temp_sfr = 0.5 * (temp_sfr + prev_sfr)
-            temp_dm = temp_sfr * temp_dt.to(u.yr)
-
-            if temp_dm/mstar_end > MAX_DM_FRAC:
-                temp_dt = (MAX_DM_FRAC*mstar_end / temp_sfr).to(u.Gyr)
-                temp_time = prev_time - temp_dt
-                temp_dm = temp_sfr * temp_dt.to(u.yr)
-
-            if prev_mstar - temp_dm < MIN_MSTAR:
-                temp_dm = (prev_mstar - MIN_MSTAR)
-                temp_dt = (temp_dm / temp_sfr).to(u.Gyr)
-                temp_time = prev_time - temp_dt
-
-            temp_mstar = prev_mstar - temp_dm
-            times.append(temp_time.value)
-            sfr.append(temp_sfr.value)
-            mass_stars.append(temp_mstar.value)
-
-            prev_mstar = temp_mstar
-            prev_sfr = temp_sfr
-            prev_time = temp_time
-
-            ii += 1
-            if ii > MAX_STEPS:
-                raise RuntimeError("Excceded maximum steps!")
-
-        times = times[::-1]
-        sfr = sfr[::-1]
-        mass_stars = mass_stars[::-1]
-
-        times = np.append(times, q_times.value)
-        sfr = np.append(sfr, q_gal_sfr.value)
-        mass_stars = np.append(mass_stars, q_mass_stars.value)
+        # Integrate backward through the star-forming phase
+        times, sfr, mass_stars = engine.star_forming_history(sfr_ms, sfr_ms_sigma, \
+                        time_beg=q_times[0].to(u.Gyr).value, \
+                        mstar_beg=q_mass_stars[0].to(u.Msun).value, \
+                        sfr_beg=q_gal_sfr[0].to(u.Msun/u.yr).value, \
+                        mstar_end=mstar_end.to(u.Msun).value, \
+                        min_time=MIN_TIME.to(u.Gyr).value, \
+                        min_mstar=MIN_MSTAR.to(u.Msun).value, \
+                        max_dt=MAX_DT.to(u.Gyr).value, \
+                        max_dm_frac=MAX_DM_FRAC, \
+                        max_steps=MAX_STEPS)
+
+        times = np.append(times, q_times.to(u.Gyr).value)
+        sfr = np.append(sfr, q_gal_sfr.to(u.Msun/u.yr).value)
+        mass_stars = np.append(mass_stars, q_mass_stars.to(u.Msun).value)
         if np.any(np.diff(times) < 0.0):
             raise ValueError("BAD TIMES!")
         if np.any(np.diff(mass_stars) < 0.0):
@@ -275,73 +368,47 @@ class GalaxyHistory:
         """Calculate the radial mass profiles vs time
         The profile at each timestep will be a linear interpolant
         """
-        # Initialize arrays for galaxy matter profiles over time
-        prof_shape = (self.times.size, self.rads.size)
-
-        # All of these quantities are in units of mass (Msun), such that the total mass out to a given radius is simply the sum out to that index.
-        # Note that the SFR, stars and gas are in a thin-disk while the DM is roughly spherical.
-        mass_sfr_prof = np.zeros(prof_shape)
-        mass_stars_prof = np.zeros(prof_shape)
-        mass_gas_prof = np.zeros(prof_shape)
-        mass_dm_prof = np.zeros(prof_shape)
-
-        Rscale_baryons = np.zeros(self.times.size)
-        Rscale_dm = np.zeros(self.times.size)
-
         # --- Compare the observed scale radius with the predicted scale radius, to account for the "width" of the star-formation main sequence
         _, R_final = baryons.sfr_rad_dist(self.rads.cgs.value, self.obs_props['mass_stars'].cgs.value)
         R_final = (R_final*u.cm).to(u.kpc)
         R_scaling = (self.obs_props['rad_eff'] / R_final).value
 
-        dt = 0 * u.yr
-
-        # --- Iterate over each time-step until when the sgrb occurred
-        for ii, zz in enumerate(self.redz):
-
-            sfr = self.sfr[ii]
-            mstar = self.mass_stars[ii]
-            mgas = self.mass_gas[ii]
-            mdm = self.mass_dm[ii]
-
-            # Skips times before galaxy 'formed' (i.e. when it had negligible mass/SFR)
-            if ii == 0 or sfr <= 0.0 or mstar <= 0.0:
-                continue
-
-            # --- Calculate exponential disk-profile (normalized to 1), used for both gas and SFR radial distributions since the gas follows the SFR
-            dt = (self.times[ii] - self.times[ii-1]).to(u.yr)
-            disk_prof, Rscale_baryons[ii] = baryons.sfr_rad_dist(self.rads.cgs.value,  mstar.cgs.value, scaling=R_scaling)
-            Rscale_baryons[ii] *= u.cm.to(u.kpc)
-
-            # --- Add the new mass of stars from the ongoing SF
-            mass_stars_prof[ii, :] = mass_sfr_prof[ii-1, :] + mass_stars_prof[ii-1]
-
-            # --- Calculate the SFR profile at this timestep, which is used for the next timestep
-            mass_sfr_prof[ii, :] = sfr * dt * disk_prof
-
-            # --- Distribute gas in disk
-            mass_gas_prof[ii, :] = mgas * disk_prof
-
-            # --- Distribute DM in NFW profile
-            if self.dm_profile not in ['NFW']:
-                raise NameError('DM profile {0:s} not recognized!'.format(self.dm_profile))
-
-            mass_dm_prof[ii, :], Rscale_dm[ii] = halos.nfw_mass_prof(self.rads.cgs.value, mdm.cgs.value, zz, self.cosmo)
-            mass_dm_prof[ii, :] *= u.g.to(u.Msun)
-            Rscale_dm[ii] *= u.cm.to(u.kpc)
+        # --- Calculate the profiles of the SFR, stars and gas at every timestep at once. All of these quantities are in units of mass (Msun), such that the total mass out to a given radius is simply the sum out to that index.
+        # Note that the SFR, stars and gas are in a thin-disk while the DM is roughly spherical.
+        mass_sfr_prof, mass_stars_prof, mass_gas_prof, Rscale_baryons = engine.baryon_profiles(self.rads.to(u.kpc).value, \
+                        self.times.to(u.Gyr).value, self.sfr.to(u.Msun/u.yr).value, self.mass_stars.to(u.Msun).value, \
+                        self.mass_gas.to(u.Msun).value, scaling=R_scaling)
 
+        # --- Distribute DM in NFW profile
+        self.mass_dm_prof, self.Rscale_dm = self.dm_profiles_vs_time(self.mass_dm)
 
         # --- store the profiles
         self.mass_sfr_prof = mass_sfr_prof * u.Msun
         self.mass_stars_prof = mass_stars_prof * u.Msun
         self.mass_gas_prof = mass_gas_prof * u.Msun
-        self.mass_dm_prof = mass_dm_prof * u.Msun
 
         self.Rscale_baryons = Rscale_baryons * u.kpc
-        self.Rscale_dm = Rscale_dm * u.kpc
 
         return
 
 
+    def dm_profiles_vs_time(self, mass_dm):
+        """DM mass profiles and scale radii at each timestep, for the DM masses mass_dm.
+
+        mass_dm can have leading dimensions in addition to time (e.g. for an ensemble of realizations, see construct_ensemble), which are kept in the outputs. The profiles are empty at the timesteps skipped by calc_mass_profiles_vs_time.
+        """
+        if self.dm_profile not in ['NFW']:
+            raise NameError('DM profile {0:s} not recognized!'.format(self.dm_profile))
+
+        # Skips times before galaxy 'formed' (i.e. when it had negligible mass/SFR)
+        formed = engine.formed_steps(self.sfr.value, self.mass_stars.value)
+        mdm = np.where(formed, mass_dm.cgs.value, 0.0)
+
+        mass_dm_prof, Rscale_dm = halos.nfw_mass_profs(self.rads.cgs.value, mdm, self.redz, self.cosmo)
+
+        return mass_dm_prof*u.g.to(u.Msun)*u.Msun, Rscale_dm*u.cm.to(u.kpc)*u.kpc
+
+
     def calc_sfr_weights(self):
         """Calculate the SFR weighting used to sample t0.
 
@@ -366,21 +433,20 @@ class GalaxyHistory:
 
 
 
-    def calc_potentials_vs_time(self, differential=False, method='astropy'):
+    def calc_potentials_vs_time(self, differential=False):
         """Calculates the gravitational potentials of each component for all redshift steps using galpy
         The gas and stars are represented by a double exponential profile by default. 
+        With disk_profile=='MNExponential', the double exponential disks are approximated by a sum of Miyamoto-Nagai potentials (see disks.py), which are much cheaper to evaluate and can be used by galpy's C integrators. 
         The DM is represented by a NFW profile. 
-        Can construct potential in both astropy units (method=='astropy') or galpy's 'natural' units (method=='natural') for the purposes of interpolation. 
+        The potentials are constructed once, in galpy's natural units (as needed for interpolation); the full_potentials property provides views of them that take and return astropy quantities. 
 
         Stars can be calculated using a differential mass profile with varying scale radii, but in this case it is best to interpolate the potentials first
         """
 
-        if method == 'astropy':
-            print("Calculating galactic potentials at each redshift using astropy units...\n")
-        elif method == 'natural':
-            print("Calculating galactic potentials at each redshift using galpy's natural units...\n")
-        else:
-            raise NameError('Method {0:s} for constructing the potential not recognized!'.format(method))
+        from galpy.potential import RazorThinExponentialDiskPotential, DoubleExponentialDiskPotential
+        from galpy.potential import flatten as flatten_potentials
+
+        print("Calculating galactic potentials at each redshift using galpy's natural units...\n")
 
         # lists for saving potentials at each step
         stars_potentials = []
@@ -388,50 +454,27 @@ class GalaxyHistory:
         dm_potentials = []
         full_potentials = []
 
-        if self.disk_profile not in ['RazorThinExponential','DoubleExponential']:
+        if self.disk_profile not in ['RazorThinExponential','DoubleExponential','MNExponential']:
             raise NameError('Disk profile {0:s} not recognized!'.format(self.disk_profile))
 
         # iterate over each time-step until when the sgrb occurred
         for ii, zz in enumerate(self.redz):
 
-            # --- get the gas and DM masses at this step
-            if method=='astropy':
-                mgas = self.mass_gas[ii]
-                mdm = self.mass_dm[ii]
-            elif method=='natural':
-                mgas = utils.Mphys_to_nat(self.mass_gas[ii])
-                mdm = utils.Mphys_to_nat(self.mass_dm[ii])
+            # --- get the gas mass at this step
+            mgas = utils.Mphys_to_nat(self.mass_gas[ii], ro=RO, vo=VO)
 
             # --- if differential stellar potential not being used, just take the total stellar mass at each timestep
             # --- this is also done for the first differential timestep
             if (differential==False) or (ii == 0):
-                if method=='astropy':
-                    mstar = self.mass_stars[ii]
-                elif method=='natural':
-                    mstar = utils.Mphys_to_nat(self.mass_stars[ii])
+                mstar = utils.Mphys_to_nat(self.mass_stars[ii], ro=RO, vo=VO)
             else:
-                if method=='astropy':
-                    mstar = self.mass_stars[ii] - self.mass_stars[ii-1]
-                elif method=='natural':
-                    mstar = utils.Mphys_to_nat(self.mass_stars[ii] - self.mass_stars[ii-1])
-
-            # --- get the scale lengths for the baryons and halo at this redshift step
-            if method=='astropy':
-                rs_baryons = self.Rscale_baryons[ii]
-                rs_dm = self.Rscale_dm[ii]
-                # if galaxy hasn't formed yet, give the potentials neglible scale sizes to avoid dividing by 0
-                if rs_baryons==0:
-                    rs_baryons = 1e-10 * rs_baryons.unit
-                if rs_dm==0:
-                    rs_dm = 1e-10 * rs_dm.unit
-            elif method=='natural':
-                rs_baryons = utils.Rphys_to_nat(self.Rscale_baryons[ii])
-                rs_dm = utils.Rphys_to_nat(self.Rscale_dm[ii])
-                # if galaxy hasn't formed yet, give the potentials neglible scale sizes to avoid dividing by 0
-                if rs_baryons==0:
-                    rs_baryons = 1e-10
-                if rs_dm==0:
-                    rs_dm = 1e-10
+                mstar = utils.Mphys_to_nat(self.mass_stars[ii] - self.mass_stars[ii-1], ro=RO, vo=VO)
+
+            # --- get the scale length for the baryons at this redshift step
+            rs_baryons = utils.Rphys_to_nat(self.Rscale_baryons[ii], ro=RO, vo=VO)
+            # if galaxy hasn't formed yet, give the potentials neglible scale sizes to avoid dividing by 0
+            if rs_baryons==0:
+                rs_baryons = 1e-10
 
 
             # --- construct the stellar and gas potentials
@@ -451,12 +494,16 @@ class GalaxyHistory:
                 stars_potential = DoubleExponentialDiskPotential(amp=amp_stars, hr=rs_baryons, hz=self.z_scale*rs_baryons)
                 gas_potential = DoubleExponentialDiskPotential(amp=amp_gas, hr=rs_baryons, hz=self.z_scale*rs_baryons)
 
+            elif self.disk_profile=='MNExponential':
+                # each disk is a list of Miyamoto-Nagai potentials, with amplitudes given by the mass
+                stars_potential = disks.miyamoto_nagai_disk(mstar, rs_baryons, self.z_scale)
+                gas_potential = disks.miyamoto_nagai_disk(mgas, rs_baryons, self.z_scale)
+
 
 
             # --- construct the DM potentials
 
-            amp_dm = mdm
-            dm_potential = NFWPotential(amp=amp_dm, a=rs_dm)
+            dm_potential = self.dm_potential(ii)
 
 
             # --- add the potentials to the lists for each step
@@ -465,46 +512,238 @@ class GalaxyHistory:
             dm_potentials.append(dm_potential)
 
             # --- if differential is specified, we use *all* the stellar profiles up to this point
-            if differential==True:
+            if differential==True and getattr(self, 'collapsed_shells', None) and (self.collapsed_shells[ii] is not None):
+                combined_potentials = self.collapsed_shells_potentials(ii)
+                combined_potentials.extend([gas_potential, dm_potential])
+            elif differential==True:
                 combined_potentials = stars_potentials[:]
                 combined_potentials.extend([gas_potential, dm_potential])
             else:
                 combined_potentials = [stars_potential,gas_potential,dm_potential]
-            full_potentials.append(combined_potentials)
+            full_potentials.append(flatten_potentials(combined_potentials))
+
+
+        self.stars_potentials_natural = stars_potentials
+        self.gas_potentials_natural = gas_potentials
+        self.dm_potentials_natural = dm_potentials
+        self.full_potentials_natural = full_potentials
+        self._full_potentials = None
+
+        return
+
 
+    def dm_potential(self, ii):
+        """NFW potential of the DM at timestep ii, in natural units.
+        """
+        from galpy.potential import NFWPotential
+
+        mdm = utils.Mphys_to_nat(self.mass_dm[ii], ro=RO, vo=VO)
+        rs_dm = utils.Rphys_to_nat(self.Rscale_dm[ii], ro=RO, vo=VO)
+        # if galaxy hasn't formed yet, give the potential a neglible scale size to avoid dividing by 0
+        if rs_dm==0:
+            rs_dm = 1e-10
 
-        if method=='astropy':
-            self.stars_potentials = stars_potentials
-            self.gas_potentials = gas_potentials
-            self.dm_potentials = dm_potentials
-            self.full_potentials = full_potentials
-        if method=='natural':
-            self.stars_potentials_natural = stars_potentials
-            self.gas_potentials_natural = gas_potentials
-            self.dm_potentials_natural = dm_potentials
-            self.full_potentials_natural = full_potentials
+        return NFWPotential(amp=mdm, a=rs_dm)
 
 
+    def calc_dm_potentials_vs_time(self):
+        """Reconstructs only the DM potentials at each timestep (e.g. after changing mass_dm), reusing the stellar and gas potentials.
+        """
+        dm_potentials = [self.dm_potential(ii) for ii in range(len(self.redz))]
+
+        # the DM is the last component of the full potential at each timestep
+        self.full_potentials_natural = [pots[:-1]+[dm_potential] for pots, dm_potential in zip(self.full_potentials_natural, dm_potentials)]
+        self.dm_potentials_natural = dm_potentials
+        self._full_potentials = None
+
         return
 
 
-    def write(self, outdir, label=None):
-        """Writes the galaxy data to a pickled file.
+    @property
+    def full_potentials(self):
+        """Potentials at each timestep that take and return astropy quantities.
+
+        These are shallow copies of the potentials in full_potentials_natural with galpy's physical outputs turned on, so they share all of their data. They are created on first access and are not pickled.
         """
+        # galaxies pickled before the potentials were only built once store these directly
+        if 'full_potentials' in self.__dict__:
+            return self.__dict__['full_potentials']
+
+        if self.__dict__.get('_full_potentials') is None:
+            views = {}
+            def view(pot):
+                if id(pot) not in views:
+                    views[id(pot)] = copy.copy(pot)
+                    views[id(pot)].turn_physical_on(ro=RO, vo=VO)
+                return views[id(pot)]
+            self._full_potentials = [[view(pot) for pot in pots] for pots in self.full_potentials_natural]
+
+        return self._full_potentials
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_full_potentials', None)
+        return state
+
+
+    def calc_potential_epochs(self, force_rtol):
+        """Merges consecutive timesteps whose potentials differ by less than force_rtol into epochs.
+
+        The difference is the maximum fractional change in the total force over a grid in R and z, relative to the first timestep of the epoch. The potential of the first timestep is then used throughout the epoch. The times, masses, and SFR weights of each timestep are not changed, so birth times and weights stay exact.
+
+        Stores potential_epochs, which gives for each timestep the index of the timestep whose potential is used.
+        """
+
+        print("Coarsening the potential time grid with a force tolerance of {0:0.1e}...\n".format(force_rtol))
+        start = time.time()
+
+        Rs, Zs = [vals.flatten() for vals in np.meshgrid(COARSEN_RADS, COARSEN_HEIGHTS)]
+        Rs, Zs = utils.Rphys_to_nat(Rs*u.kpc, ro=RO, vo=VO), utils.Rphys_to_nat(Zs*u.kpc, ro=RO, vo=VO)
+
+        # --- evaluate each distinct potential once, since differential shells are shared between timesteps
+        forces = {}
+        def pot_forces(pot):
+            if id(pot) not in forces:
+                FR = np.array([pot.Rforce(R, Z, use_physical=False) for R, Z in zip(Rs, Zs)])
+                Fz = np.array([pot.zforce(R, Z, use_physical=False) for R, Z in zip(Rs, Zs)])
+                forces[id(pot)] = (FR, Fz)
+            return forces[id(pot)]
+
+        step_forces = []
+        for pots in self.full_potentials_natural:
+            FR, Fz = np.zeros_like(Rs), np.zeros_like(Zs)
+            for pot in pots:
+                FR_pot, Fz_pot = pot_forces(pot)
+                FR, Fz = FR+FR_pot, Fz+Fz_pot
+            step_forces.append((FR, Fz))
+
+        # --- greedily extend each epoch until the force differs from its first timestep by more than the tolerance
+        epochs = np.zeros(len(step_forces), dtype=int)
+        epoch_start = 0
+        for ii in range(1, len(step_forces)):
+            FR_ref, Fz_ref = step_forces[epoch_start]
+            FR, Fz = step_forces[ii]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                err = np.max(np.sqrt((FR-FR_ref)**2 + (Fz-Fz_ref)**2) / np.sqrt(FR_ref**2 + Fz_ref**2))
+            if not (err < force_rtol):
+                epoch_start = ii
+            epochs[ii] = epoch_start
+
+        self.potential_epochs = epochs
+
+        if VERBOSE:
+            print('   merged {0:d} timesteps into {1:d} epochs in {2:0.2f}s\n'.format(len(epochs), len(np.unique(epochs)), time.time()-start))
+
+        return
+
+
+    def calc_collapsed_shells(self):
+        """Fits a single sum of Miyamoto-Nagai potentials to the stellar shells accumulated by each timestep, in Msun and kpc.
+
+        Timesteps before any shell has a nonzero scale radius, or whose fit does not reach disks.COLLAPSE_FORCE_RTOL, are not collapsed (None), so their uncollapsed shells are used instead.
+        """
+
+        print("Collapsing the differential stellar shells at each redshift...\n")
+        start = time.time()
+
+        shell_masses = np.diff(self.mass_stars.to(u.Msun).value, prepend=0)
+        shell_rads = self.Rscale_baryons.to(u.kpc).value
+
+        self.collapsed_shells = []
+        fit, failed = None, []
+        for ii in range(len(self.redz)):
+            if (ii == 0) or not np.any(shell_rads[:ii+1] > 0):
+                self.collapsed_shells.append(None)
+                continue
+            step_fit = disks.collapse_shells(shell_masses[:ii+1], shell_rads[:ii+1], self.z_scale, rtol=disks.COLLAPSE_FORCE_RTOL, init=fit)
+            if step_fit[3] >= disks.COLLAPSE_FORCE_RTOL:
+                self.collapsed_shells.append(None)
+                failed.append(ii)
+                continue
+            fit = step_fit
+            self.collapsed_shells.append(fit)
+
+        if len(failed) > 0:
+            warnings.warn('The stellar shells of {0:d} timesteps (first: {1:d}) could not be collapsed to within a force error of {2:0.3f}, so their uncollapsed shells are used instead!'.format(len(failed), failed[0], disks.COLLAPSE_FORCE_RTOL))
+
+        if VERBOSE:
+            errs = [fit[3] for fit in self.collapsed_shells if fit is not None]
+            if len(errs) > 0:
+                print('   collapsed {0:d} timesteps in {1:0.2f}s (maximum force error: {2:0.2e})\n'.format(len(errs), time.time()-start, np.max(errs)))
+
+        return
+
+
+    def collapsed_shells_potentials(self, ii):
+        """List of the Miyamoto-Nagai potentials representing the collapsed stellar shells at timestep ii, in natural units.
+        """
+        from galpy.potential import MiyamotoNagaiPotential
+
+        masses, a, b, _ = self.collapsed_shells[ii]
+        masses, a, b = utils.Mphys_to_nat(masses*u.Msun, ro=RO, vo=VO), utils.Rphys_to_nat(a*u.kpc, ro=RO, vo=VO), utils.Rphys_to_nat(b*u.kpc, ro=RO, vo=VO)
+
+        return [MiyamotoNagaiPotential(amp=mm, a=aa, b=bb) for mm, aa, bb in zip(masses, a, b)]
+
+
+    def write(self, outdir, label=None, fmt='pkl'):
+        """Writes the galaxy data to a pickled file (fmt='pkl'), or to a compact HDF5 file that only stores the history and build parameters (fmt='hdf5', see storage.py).
+        """
+
+        if fmt not in ['pkl','hdf5']:
+            raise NameError('Galaxy format {0:s} not recognized!'.format(fmt))
 
         print("Writing galaxy data in directory {0:s}...\n".format(outdir))
         if label:
-            savepath = outdir+'/'+label+'.pkl'
+            savepath = outdir+'/'+label+'.'+fmt
         else:
-            savepath = outdir+'/galaxy.pkl'
-        pickle.dump(self, open(savepath, 'wb'))
+            savepath = outdir+'/galaxy.'+fmt
+
+        if fmt=='pkl':
+            pickle.dump(self, open(savepath, 'wb'))
+        else:
+            storage.write_hdf(self, savepath)
         return
 
 
 
 
 
-    def calc_sfr_params(self):
+    def sfr_params_inputs(self):
+        """Dictionary of everything that determines the solution of calc_sfr_params.
+
+        This is the observed redshift, stellar mass, stellar age and SFR of the galaxy, the tolerance on the stellar age, and a hash of the parameters and Monte Carlo seed of the SFR main sequence.
+        """
+        inputs = {
+            'redz': float(self.obs_props['redz']),
+            'mass_stars': float(self.obs_props['mass_stars'].to(u.Msun).value),
+            'age_stars': float(self.obs_props['age_stars'].to(u.Gyr).value),
+            'gal_sfr': float(self.obs_props['gal_sfr'].to(u.Msun/u.yr).value),
+            'star_age_rtol': self.STAR_AGE_RTOL,
+            'sfr_ms': cache.input_hash({'DATA': baryons.SFR_MS_Speagle_1405_2041.DATA, 'seed': baryons.MC_SEED, 'table_version': cache.TABLE_VERSION}),
+            }
+        return inputs
+
+
+    def cached_sfr_params(self):
+        """Solution of calc_sfr_params, read from or added to the cache in sfr_cache_dirpath if it is specified.
+        """
+        cache_dirpath = getattr(self, 'sfr_cache_dirpath', None)
+        if cache_dirpath is None:
+            return self.calc_sfr_params()
+
+        inputs = self.sfr_params_inputs()
+        params = cache.load_sfr_params(cache_dirpath, inputs)
+        if params is None:
+            params = self.calc_sfr_params()
+            cache.save_sfr_params(cache_dirpath, inputs, params)
+        elif VERBOSE:
+            print("Using cached SFR history solution...")
+
+        return params
+
+
+    def calc_sfr_params(self, method=SFR_PARAMS_METHOD):
         """
         Grid search to find quiescence time and "sigma" on SFR relation to produce galaxy props.
 
@@ -512,78 +751,27 @@ class GalaxyHistory:
 
         Here, a grid of quenching-times and sigma-values are considered, and star-formation histories are constructed (in parallel) for each. Average stellar-ages are then calculated, and the best fitting value is chosen. This worked much better than using an actual minimization routine.
 
+        With method=='grid', the star-formation histories of every cell in the grid are constructed. With method=='refine', they are first constructed on a coarse subgrid (every SFR_COARSE_STEP cells), and then for the cells of the full grid in coarse blocks near the target stellar age. Any other block that could hold a cell as cheap as the best one found within tolerance (which is known from the cost-function alone) is then evaluated as well, until there are none left, so that both methods choose the same cell of the same grid. If no cell within tolerance is found, this evaluates the full grid.
+
         Units for this function are in cgs.
         """
+        if method not in ['grid','refine']:
+            raise NameError('SFR parameter method {0:s} not recognized!'.format(method))
+
         time_end = self.cosmo.age(self.obs_props['redz']).cgs.value
         gal_age_stars = self.obs_props['age_stars'].cgs.value
         target_time = time_end - gal_age_stars
-        sfr_end = self.obs_props['gal_sfr'].to(u.g/u.s).value
 
         # Number of values in each dimension to use
         NSIGMA = 100
         NQUENCH = 100
         NTIMES = 200
 
-        # Construct an instance for calculating SFR values
-        sfr_ms = baryons.SFR_MS_Speagle_1405_2041()
-
-        # Lowest stellar-mass at which interpolation functions for the MS will work
-        MIN_MASS = sfr_ms._MIN_MSTAR
-
         # Construct parameter arrays
         times = np.linspace(0.0, time_end, NTIMES)
         quench = np.linspace(target_time, time_end, NQUENCH)
         sigma = np.linspace(-2.0, 2.0, NSIGMA)
-
-        # Arrays to store values
-        sfh = np.zeros((NQUENCH, NSIGMA, NTIMES))
-        mass = np.zeros_like(sfh)
-        dmh = np.zeros_like(sfh)
-
-        dt = np.append([0.0], np.diff(times))
-        # initialize last time-step to be observed mass of galaxy
-        mass[..., -1] = self.obs_props['mass_stars'].cgs.value
-
-        # Iterate backwards in time to de-construct the galaxy following the SFR MS
-        for ii, tt in utils.renumerate(times):
-            # (Q,S,)
-            mm = mass[..., ii]
-            # Sources above the minimum mass (galaxies below this mass stop evolving)
-            idx = (mm > MIN_MASS)
-
-            # Find 'active' galaxies still on the main-sequence
-            act = (tt < quench[:, np.newaxis]) & idx
-            num_act = np.count_nonzero(act)
-            if num_act > 0:
-                ss = sigma[np.newaxis, :]
-                args = mm, tt*np.ones_like(mm), ss*np.ones_like(mm)
-                args = [aa[act].flatten() for aa in args]
-                # Calculate and store star-formation-rate for all galaxies at this time
-                sfh[act, ii] = sfr_ms.sfr_from_mstar(*args)
-
-            # Find 'passive' (i.e. quiescent) galaxies, off the main-sequence
-            psv = (tt >= quench[:, np.newaxis]) & idx
-            num_psv = np.count_nonzero(psv)
-            if num_psv > 0:
-                # Set the SFR to the quiescent (observed) value
-                sfh[psv, ii] = sfr_end
-
-            # Increment the stellar-mass of the galaxy
-            if ii > 0:
-                dm = sfh[..., ii] * dt[ii]
-                dmh[..., ii] = dm
-                mass[..., ii-1] = mm - dm
-
-        # Calculate average times (age of the universe) of star-formation
-        tsf = np.sum(dmh * times[np.newaxis, np.newaxis, :], axis=-1) / np.sum(dmh, axis=-1)
-
-        if np.all(tsf < target_time) or np.all(tsf > target_time):
-            raise RuntimeError("Average times never cross target: {:.2e}".format(target_time*u.s.to(u.Gyr)))
-
-        # Calculate the fractional error in stellar-age relative to target galaxy age
-        frac_err = np.fabs(((time_end - tsf) - gal_age_stars)/gal_age_stars)
-        # Find region of parameter space within target tolerance of true value
-        idx = (frac_err < self.STAR_AGE_RTOL)
+        grid_quench, grid_sigma = np.meshgrid(quench, sigma, indexing='ij')
 
         # Choose 'best' prior values on parameters
         s0 = 0.0
@@ -599,6 +787,61 @@ class GalaxyHistory:
         cost_sigma = cost_func(sigma, s0)[np.newaxis, :]
         cost = np.sqrt(cost_quench**2 + cost_sigma**2)
 
+        # Fractional error in stellar-age of the evaluated cells relative to target galaxy age
+        def age_errors(tsf):
+            return np.fabs(((time_end - tsf) - gal_age_stars)/gal_age_stars)
+
+        # Average times (age of the universe) of star-formation in each cell, NaN where not calculated
+        tsf = np.full((NQUENCH, NSIGMA), np.nan)
+
+        if method=='grid':
+            tsf[...] = self.calc_sfr_times(grid_quench, grid_sigma, times)
+        else:
+            # --- coarse subgrid, including the edges of the full grid
+            iq = np.unique(np.append(np.arange(0, NQUENCH, SFR_COARSE_STEP), NQUENCH-1))
+            js = np.unique(np.append(np.arange(0, NSIGMA, SFR_COARSE_STEP), NSIGMA-1))
+            coarse = np.ix_(iq, js)
+            tsf[coarse] = self.calc_sfr_times(grid_quench[coarse], grid_sigma[coarse], times)
+
+            # --- refine the blocks whose corners (with a margin for curvature) bracket the target age
+            err = ((time_end - tsf[coarse]) - gal_age_stars)/gal_age_stars
+            corners = np.stack([err[:-1,:-1], err[1:,:-1], err[:-1,1:], err[1:,1:]])
+            lo, hi = np.min(corners, axis=0), np.max(corners, axis=0)
+            margin = 0.5*(hi - lo)
+            refine = ~((lo - margin >= self.STAR_AGE_RTOL) | (hi + margin <= -self.STAR_AGE_RTOL))
+
+            fine = np.zeros((NQUENCH, NSIGMA), dtype=bool)
+            for bi, bj in zip(*np.nonzero(refine)):
+                fine[iq[bi]:iq[bi+1]+1, js[bj]:js[bj+1]+1] = True
+            fine &= np.isnan(tsf)
+            tsf[fine] = self.calc_sfr_times(grid_quench[fine], grid_sigma[fine], times)
+
+            # --- evaluate the blocks that could still hold a cell at least as cheap as the best one within tolerance
+            blocks = [(slice(iq[bi], iq[bi+1]+1), slice(js[bj], js[bj+1]+1)) for bi in range(len(iq)-1) for bj in range(len(js)-1)]
+            while True:
+                within = np.isfinite(tsf) & (age_errors(tsf) < self.STAR_AGE_RTOL)
+                best = np.min(cost[within]) if np.any(within) else np.inf
+                fine = np.zeros((NQUENCH, NSIGMA), dtype=bool)
+                for block in blocks:
+                    if np.any(np.isnan(tsf[block])) and (np.min(cost[block]) <= best):
+                        fine[block] = True
+                fine &= np.isnan(tsf)
+                if not np.any(fine):
+                    break
+                tsf[fine] = self.calc_sfr_times(grid_quench[fine], grid_sigma[fine], times)
+
+        evaluated = np.isfinite(tsf)
+        if np.all(tsf[evaluated] < target_time) or np.all(tsf[evaluated] > target_time):
+            raise RuntimeError("Average times never cross target: {:.2e}".format(target_time*u.s.to(u.Gyr)))
+
+        # Calculate the fractional error in stellar-age relative to target galaxy age
+        frac_err = age_errors(tsf)
+        # Find region of parameter space within target tolerance of true value
+        idx = evaluated & (frac_err < self.STAR_AGE_RTOL)
+
+        if not np.any(idx):
+            raise ValueError("Solution accuracy did not reach tolerance (shouldn't happen)!")
+
         # Find the "optimal" (w.r.t. the cost-function) indices within the error-tolerance for ages
         valid = np.ma.masked_array(cost, mask=(~idx))
         argmin = np.argmin(valid)
@@ -616,3 +859,58 @@ class GalaxyHistory:
         sig = sigma[jj]
 
         return tq, sig, sol_age, sol_err
+
+
+    def calc_sfr_times(self, quench, sigma, times):
+        """Average times (age of the universe) of star-formation of the SFR histories with quenching times 'quench' and SFR MS deviations 'sigma' (arrays of the same shape).
+
+        Each history is constructed by iterating backwards in time over 'times' from the observed stellar mass, following the SFR MS until the quenching time and the observed SFR afterwards. Units are in cgs.
+        """
+        sfr_end = self.obs_props['gal_sfr'].to(u.g/u.s).value
+
+        # Construct an instance for calculating SFR values
+        sfr_ms = baryons.sfr_ms_speagle()
+
+        # Lowest stellar-mass at which interpolation functions for the MS will work
+        MIN_MASS = sfr_ms._MIN_MSTAR
+
+        # Arrays to store values
+        shape = np.shape(quench) + (times.size,)
+        sfh = np.zeros(shape)
+        mass = np.zeros(shape)
+        dmh = np.zeros(shape)
+
+        dt = np.append([0.0], np.diff(times))
+        # initialize last time-step to be observed mass of galaxy
+        mass[..., -1] = self.obs_props['mass_stars'].cgs.value
+
+        # Iterate backwards in time to de-construct the galaxy following the SFR MS
+        for ii, tt in utils.renumerate(times):
+            mm = mass[..., ii]
+            # Sources above the minimum mass (galaxies below this mass stop evolving)
+            idx = (mm > MIN_MASS)
+
+            # Find 'active' galaxies still on the main-sequence
+            act = (tt < quench) & idx
+            num_act = np.count_nonzero(act)
+            if num_act > 0:
+                # Calculate and store star-formation-rate for all galaxies at this time
+                sfh[act, ii] = sfr_ms.sfr_from_mstar(mm[act], tt*np.ones(num_act), sigma[act])
+
+            # Find 'passive' (i.e. quiescent) galaxies, off the main-sequence
+            psv = (tt >= quench) & idx
+            num_psv = np.count_nonzero(psv)
+            if num_psv > 0:
+                # Set the SFR to the quiescent (observed) value
+                sfh[psv, ii] = sfr_end
+
+            # Increment the stellar-mass of the galaxy
+            if ii > 0:
+                dm = sfh[..., ii] * dt[ii]
+                dmh[..., ii] = dm
+                mass[..., ii-1] = mm - dm
+
+        # Calculate average times (age of the universe) of star-formation
+        tsf = np.sum(dmh * times, axis=-1) / np.sum(dmh, axis=-1)
+
+        return tsf
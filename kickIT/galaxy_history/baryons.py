@@ -1,9 +1,12 @@
 """Baryonic (galaxy) scaling relations
 """
 
+from functools import lru_cache
+
 import numpy as np
 import astropy as ap
 from . import utils
+from .. import cache
 
 MSOL = ap.constants.M_sun.cgs.value    # gram
 PC = ap.units.pc.to(ap.units.cm)       # cm
@@ -12,6 +15,9 @@ YR = 365.2425*24*3600                  # sec
 KPC = 1e3 * PC    # cm
 GYR = 1e9 * YR    # yr
 
+# Seed of the Monte Carlo draws used to construct the SFR main sequence tables, so that every run uses the same relation
+MC_SEED = 1405
+
 
 class GUO_0909_4305:
     """Stellar-Mass -- Halo-Mass scaling relation.
@@ -75,6 +81,28 @@ def sfr_rad_dist(rads, mstar, scaling=1.0):
 
 
 
+def sfr_rad_dists(rads, mstars, scaling=1.0):
+    """Vectorized version of sfr_rad_dist, for an array of stellar masses.
+
+    Returns the normalized SFR radial distributions, with the radii along the last axis, and the scale radii.
+    """
+    rs = sfr_disk_rad(np.asarray(mstars, dtype=float), scaling)
+
+    # Density of star-formation distribution
+    sfr_dens = np.zeros(np.shape(rs) + np.shape(rads))
+    pos = rs > 0
+    sfr_dens[pos] = np.exp(-rads[np.newaxis, :] / rs[pos][:, np.newaxis])
+
+    # Area of each disk-section
+    sfr = sfr_dens * utils.annulus_areas(rads)
+
+    # Normalize
+    norm = np.sum(sfr, axis=-1, keepdims=True)
+    sfr = np.divide(sfr, norm, out=sfr, where=(norm > 0))
+
+    return sfr, rs
+
+
 def gas_mass_from_stellar_mass(mstar):
     """Gas-Mass -- Stellar-Mass Relation
 
@@ -237,7 +265,9 @@ class SFR_MS_Speagle_1405_2041(utils.OutlierND):
         "B2": [0.11, 0.03],
     }
 
-    def __init__(self, store=True):
+    def __init__(self, store=True, seed=MC_SEED):
+        """The Monte Carlo tables are drawn with the given seed, and saved to (or loaded from) the table cache (see cache.cached_table). If seed is None, they are drawn from the global numpy random state every time.
+        """
         NUM_MC = 1000
 
         MSTAR_GRID_RANGE = [5.0, 13.0]   # log10(M_h/Msol)
@@ -275,8 +305,16 @@ class SFR_MS_Speagle_1405_2041(utils.OutlierND):
         self._MIN_MSTAR = np.min(mstar_grid)
         xgrids = (np.log10(mstar_grid), time_grid)
 
+        # Draw the Monte Carlo tables, or load them if they were already drawn with this seed
+        yvals_percs = None
+        if seed is not None:
+            def build():
+                return self.mc_percentiles(xgrids, self.function, sigma_grid, NUM_MC, rng=np.random.RandomState(seed))
+            inputs = {'DATA': self.DATA, 'xgrids': [grid.tolist() for grid in xgrids], 'sgrid': sigma_grid.tolist(), 'nmc': NUM_MC, 'seed': seed}
+            yvals_percs = cache.cached_table('sfr_ms_speagle_1405_2041', inputs, build)
+
         # initialize outlier class in utils.py
-        super().__init__(xgrids, sgrid=sigma_grid, nmc=NUM_MC, store=store)
+        super().__init__(xgrids, sgrid=sigma_grid, nmc=NUM_MC, store=store, yvals_percs=yvals_percs)
 
         return
 
@@ -306,27 +344,28 @@ class SFR_MS_Speagle_1405_2041(utils.OutlierND):
         return sfr
 
     @classmethod
-    def param(cls, name, size=None):
+    def param(cls, name, size=None, rng=None):
         vals, sigma = cls.DATA[name]
 
         if size is not None:
-            vals = np.random.normal(vals, sigma, size=size)
+            rng = np.random if rng is None else rng
+            vals = rng.normal(vals, sigma, size=size)
 
         return vals
 
     @classmethod
-    def function(cls, log_mstar, time, samples=None):
+    def function(cls, log_mstar, time, samples=None, rng=None):
         mhalo = np.power(10.0, log_mstar)
-        sfr = cls.sfr_ms(mhalo, time, samples=samples)
+        sfr = cls.sfr_ms(mhalo, time, samples=samples, rng=rng)
         sfr = np.log10(sfr)
         return sfr
 
     @classmethod
-    def sfr_ms(cls, mstar, time, samples=None):
-        a1 = cls.param("A1", size=samples)
-        a2 = cls.param("A2", size=samples)
-        b1 = cls.param("B1", size=samples)
-        b2 = cls.param("B2", size=samples)
+    def sfr_ms(cls, mstar, time, samples=None, rng=None):
+        a1 = cls.param("A1", size=samples, rng=rng)
+        a2 = cls.param("A2", size=samples, rng=rng)
+        b1 = cls.param("B1", size=samples, rng=rng)
+        b2 = cls.param("B2", size=samples, rng=rng)
 
         shape = np.shape(mstar) + (samples,)
         a1, a2, b1, b2 = [np.broadcast_to(zz, shape) for zz in [a1, a2, b1, b2]]
@@ -337,3 +376,10 @@ class SFR_MS_Speagle_1405_2041(utils.OutlierND):
         log_psi = (a1 - a2*tt) * log_mass - (b1 - b2*tt)
         psi = np.power(10.0, log_psi) * MSOL / YR
         return psi
+
+
+@lru_cache()
+def sfr_ms_speagle():
+    """Shared instance of SFR_MS_Speagle_1405_2041, since its Monte Carlo tables are expensive to construct and do not depend on the galaxy. The tables are seeded with MC_SEED, and cached on disk between runs.
+    """
+    return SFR_MS_Speagle_1405_2041()
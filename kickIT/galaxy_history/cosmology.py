@@ -28,6 +28,8 @@ class Cosmology(ap.cosmology.FlatLambdaCDM):
     -   dlum_to_z                      -   Convert from luminosity-dist to redshift.
     -   get_grid                       -   Retrieve the underlying interpolation grid.
 
+    The interpolators between the grids are constructed the first time each conversion is used, and are reused afterwards, so arrays of values should be converted in a single call where possible.
+
     """
 
     # These are WMAP9 parameters
@@ -65,6 +67,9 @@ class Cosmology(ap.cosmology.FlatLambdaCDM):
         #    Comoving distances in centimeters
         self._grid_dlum = self.luminosity_distance(zgrid).cgs.value
         self._sort_dlum = np.argsort(self._grid_dlum)
+
+        # Interpolators between the grids, constructed on first use (see _interpolator)
+        self._interps = {}
         return
 
     def __str__(self):
@@ -140,40 +145,54 @@ class Cosmology(ap.cosmology.FlatLambdaCDM):
         arrs = sp.interpolate.PchipInterpolator(xx[inds], yy[inds], extrapolate=False)(vals)
         return arrs
 
+    def _interpolator(self, xname, yname):
+        """Interpolator from the grid `_grid_<xname>` to the grid `_grid_<yname>`, constructed on first use.
+        """
+        # instances pickled before the interpolators were cached do not have the dictionary
+        interps = self.__dict__.setdefault('_interps', {})
+        key = (xname, yname)
+        if key not in interps:
+            xx = getattr(self, '_grid_'+xname)
+            yy = getattr(self, '_grid_'+yname)
+            inds = getattr(self, '_sort_'+xname)
+            # PchipInterpolate guarantees monotonicity with higher order
+            interps[key] = sp.interpolate.PchipInterpolator(xx[inds], yy[inds], extrapolate=False)
+        return interps[key]
+
     def tage_to_z(self, age):
         """Convert from age of the universe [seconds] to redshift.
         """
-        zz = self._interp(age, self._grid_age, self._grid_z, self._sort_age)
+        zz = self._interpolator('age', 'z')(age)
         return zz
 
     def tlbk_to_z(self, lbk):
         """Convert from lookback time [seconds] to redshift.
         """
-        zz = self._interp(lbk, self._grid_lbk, self._grid_z, self._sort_lbk)
+        zz = self._interpolator('lbk', 'z')(lbk)
         return zz
 
     def dcom_to_z(self, dc):
         """Convert from comoving-distance [cm] to redshift.
         """
-        zz = self._interp(dc, self._grid_dcom, self._grid_z, self._sort_dcom)
+        zz = self._interpolator('dcom', 'z')(dc)
         return zz
 
     def dlum_to_z(self, dl):
         """Convert from luminosity-distance [cm] to redshift.
         """
-        zz = self._interp(dl, self._grid_dlum, self._grid_z, self._sort_dlum)
+        zz = self._interpolator('dlum', 'z')(dl)
         return zz
 
     def _z_to_dcom(self, zz):
         """Convert from comoving-distance [cm] to redshift.
         """
-        dc = self._interp(zz, self._grid_z, self._grid_dcom, self._sort_z)
+        dc = self._interpolator('z', 'dcom')(zz)
         return dc
 
     def _z_to_dlum(self, zz):
         """Convert from luminosity-distance [cm] to redshift.
         """
-        dl = self._interp(zz, self._grid_z, self._grid_dlum, self._sort_z)
+        dl = self._interpolator('z', 'dlum')(zz)
         return dl
 
     def get_grid(self):
@@ -0,0 +1,212 @@
+"""Cheap closed-form approximations to exponential disk potentials.
+
+galpy's DoubleExponentialDiskPotential is evaluated with Bessel-function integrals, which makes it expensive to integrate orbits in. Here the disk is instead represented as a sum of Miyamoto-Nagai potentials, which are closed form and supported by galpy's C integrators. The components are fit to the forces of the double exponential disk in units of its scale radius, so a single fit applies to every disk with the same ratio of scale height to scale radius.
+"""
+import warnings
+from functools import lru_cache
+
+import numpy as np
+
+
+# Target maximum fractional error in the total force of the fit
+MN_FORCE_RTOL = 0.03
+# Numbers of Miyamoto-Nagai components to try, using the first that meets the tolerance
+MN_MIN_COMPONENTS = 3
+MN_MAX_COMPONENTS = 4
+# Number of starting points for the least-squares fit of each number of components
+MN_NUM_STARTS = 4
+
+# Points where the forces are fit, in units of the disk scale radius
+FIT_RADS = np.geomspace(0.1, 100, 30)
+FIT_HEIGHTS_MAX = 20
+FIT_NUM_HEIGHTS = 8
+
+VERBOSE = True
+
+
+def _mn_forces(params, Rs, Zs, ncomp):
+    """Radial and vertical forces of a sum of Miyamoto-Nagai potentials with total mass of order unity (G=1).
+
+    The parameters are the masses of the components followed by the logs of their scale radii and scale heights.
+    """
+    mass = params[:ncomp]
+    a = np.exp(params[ncomp:2*ncomp])
+    b = np.exp(params[2*ncomp:3*ncomp])
+
+    s = np.sqrt(Zs[:,None]**2 + b**2)
+    D3 = (Rs[:,None]**2 + (a+s)**2)**1.5
+    FR = -np.sum(mass*Rs[:,None]/D3, axis=1)
+    Fz = -np.sum(mass*Zs[:,None]*(a+s)/(s*D3), axis=1)
+
+    return FR, Fz
+
+
+@lru_cache()
+def fit_miyamoto_nagai(z_scale, rtol=MN_FORCE_RTOL):
+    """Fits a sum of Miyamoto-Nagai potentials to a double exponential disk with scale radius 1, scale height z_scale, and mass 1.
+
+    Returns the masses, scale radii, and scale heights of the components, and the maximum fractional error in the total force over the fit points.
+    """
+    from scipy.optimize import least_squares
+    from galpy.potential import DoubleExponentialDiskPotential
+
+    # --- forces of the double exponential disk, per unit mass
+    disk = DoubleExponentialDiskPotential(amp=1.0, hr=1.0, hz=z_scale)
+    mass = 4*np.pi*z_scale
+    heights = np.concatenate([[0], np.geomspace(0.5*z_scale, FIT_HEIGHTS_MAX, FIT_NUM_HEIGHTS)])
+    Rs, Zs = [vals.flatten() for vals in np.meshgrid(FIT_RADS, heights)]
+    FR = np.asarray([disk.Rforce(R, Z, use_physical=False) for R, Z in zip(Rs, Zs)]) / mass
+    Fz = np.asarray([disk.zforce(R, Z, use_physical=False) for R, Z in zip(Rs, Zs)]) / mass
+    F = np.sqrt(FR**2 + Fz**2)
+
+    # --- add components until the tolerance is met, keeping the best fit
+    best_err, best_params, best_ncomp = np.inf, None, None
+    for ncomp in range(MN_MIN_COMPONENTS, MN_MAX_COMPONENTS+1):
+
+        # the last residual keeps the total mass close to that of the disk
+        def residuals(params):
+            FR_fit, Fz_fit = _mn_forces(params, Rs, Zs, ncomp)
+            return np.append(np.sqrt((FR_fit-FR)**2 + (Fz_fit-Fz)**2)/F, 10*(np.sum(params[:ncomp])-1))
+
+        rng = np.random.RandomState(ncomp)
+        for start in range(MN_NUM_STARTS):
+            params0 = np.concatenate([rng.uniform(0.5, 1.5, ncomp)/ncomp, \
+                            np.log(np.geomspace(0.5, 4, ncomp)) + rng.normal(0, 0.2, ncomp), \
+                            np.log(z_scale) + rng.normal(0, 0.3, ncomp)])
+            params = least_squares(residuals, params0).x
+            err = np.max(np.abs(residuals(params)[:-1]))
+            if err < best_err:
+                best_err, best_params, best_ncomp = err, params, ncomp
+
+        if best_err < rtol:
+            break
+
+    if best_err >= rtol:
+        warnings.warn('Miyamoto-Nagai fit to the exponential disk with z_scale={0:0.3f} has a maximum force error of {1:0.3f}, above the tolerance of {2:0.3f}!'.format(z_scale, best_err, rtol))
+    if VERBOSE:
+        print('Approximated the exponential disk using {0:d} Miyamoto-Nagai components (maximum force error: {1:0.2e})...\n'.format(best_ncomp, best_err))
+
+    masses = best_params[:best_ncomp]
+    a = np.exp(best_params[best_ncomp:2*best_ncomp])
+    b = np.exp(best_params[2*best_ncomp:3*best_ncomp])
+
+    return masses, a, b, best_err
+
+
+def miyamoto_nagai_disk(mdisk, hr, z_scale):
+    """List of Miyamoto-Nagai potentials approximating a double exponential disk of mass mdisk, scale radius hr, and scale height z_scale*hr.
+
+    mdisk and hr can either both be astropy quantities or both be in galpy's natural units.
+    """
+    from galpy.potential import MiyamotoNagaiPotential
+
+    masses, a, b, _ = fit_miyamoto_nagai(z_scale)
+    return [MiyamotoNagaiPotential(amp=mm*mdisk, a=aa*hr, b=bb*hr) for mm, aa, bb in zip(masses, a, b)]
+
+
+# Target maximum fractional error in the stellar force when collapsing differential shells
+COLLAPSE_FORCE_RTOL = 0.02
+COLLAPSE_MIN_COMPONENTS = 3
+COLLAPSE_MAX_COMPONENTS = 6
+# Shells with less than this fraction of the stellar mass do not set the range of the fit points
+COLLAPSE_MIN_MASS_FRAC = 1e-3
+COLLAPSE_NUM_RADS = 40
+
+
+def shell_forces(masses, hrs, z_scale, Rs, Zs):
+    """Summed radial and vertical forces (G=1) of exponential disk shells with the given masses and scale radii, each represented by its Miyamoto-Nagai fit. Shells with a scale radius of 0 are treated as point masses.
+    """
+    mn_masses, mn_a, mn_b, _ = fit_miyamoto_nagai(z_scale)
+    params = np.concatenate([mn_masses, np.log(mn_a), np.log(mn_b)])
+
+    FR, Fz = np.zeros_like(Rs), np.zeros_like(Zs)
+    for mass, hr in zip(masses, hrs):
+        if mass == 0:
+            continue
+        if hr == 0:
+            r3 = (Rs**2 + Zs**2)**1.5
+            FR -= mass * Rs / r3
+            Fz -= mass * Zs / r3
+            continue
+        FR_shell, Fz_shell = _mn_forces(params, Rs/hr, Zs/hr, len(mn_masses))
+        FR += mass * FR_shell / hr**2
+        Fz += mass * Fz_shell / hr**2
+
+    return FR, Fz
+
+
+def collapse_shells(masses, hrs, z_scale, rtol=COLLAPSE_FORCE_RTOL, init=None):
+    """Fits a single sum of Miyamoto-Nagai potentials to the combined forces of a set of exponential disk shells, so that the cost of evaluating the stellar potential does not grow with the number of shells.
+
+    masses and hrs are floats in consistent units (e.g. Msun and kpc), and at least one shell must have a nonzero scale radius. The fit is made against the shells' own Miyamoto-Nagai representations (see fit_miyamoto_nagai), so the error relative to the exact double exponential shells is up to MN_FORCE_RTOL larger. 'init' is the result of a previous call (e.g. for the previous timestep), used as the starting point of the fit.
+
+    Returns the masses, scale radii, and scale heights of the components in the units of the inputs, and the maximum fractional error in the total force over the fit points. This error is not bounded when no fit reaches rtol, so callers must check it.
+    """
+    from scipy.optimize import least_squares
+
+    masses, hrs = np.asarray(masses, dtype=float), np.asarray(hrs, dtype=float)
+
+    resolved = hrs > 0
+    if not np.any(resolved):
+        raise ValueError('At least one stellar shell must have a nonzero scale radius to be collapsed!')
+
+    # --- work in units of the total mass and mass-weighted scale radius of the resolved shells
+    mtot = np.sum(masses)
+    hr_ref = np.sum(masses[resolved]*hrs[resolved]) / np.sum(masses[resolved])
+    masses, hrs = masses/mtot, hrs/hr_ref
+
+    significant = resolved & (masses >= COLLAPSE_MIN_MASS_FRAC)
+    if not np.any(significant):
+        significant = resolved
+    hr_lo, hr_hi = np.min(hrs[significant]), np.max(hrs[significant])
+    heights = np.concatenate([[0], np.geomspace(0.5*z_scale*hr_lo, FIT_HEIGHTS_MAX*hr_hi, FIT_NUM_HEIGHTS)])
+    Rs, Zs = [vals.flatten() for vals in np.meshgrid(np.geomspace(0.1*hr_lo, 100*hr_hi, COLLAPSE_NUM_RADS), heights)]
+    FR, Fz = shell_forces(masses, hrs, z_scale, Rs, Zs)
+    F = np.sqrt(FR**2 + Fz**2)
+
+    # --- starting points: the previous fit if provided, otherwise those for a single shell
+    starts = []
+    if init is not None:
+        init_masses, init_a, init_b, _ = init
+        starts.append(np.concatenate([init_masses/mtot, np.log(init_a/hr_ref), np.log(init_b/hr_ref)]))
+    mn_masses, mn_a, mn_b, _ = fit_miyamoto_nagai(z_scale)
+    rng = np.random.RandomState(0)
+
+    # shells only accumulate, so start from the number of components needed previously
+    min_ncomp = COLLAPSE_MIN_COMPONENTS if init is None else max(COLLAPSE_MIN_COMPONENTS, len(init[0]))
+
+    best_err, best_params, best_ncomp = np.inf, None, None
+    for ncomp in range(min_ncomp, COLLAPSE_MAX_COMPONENTS+1):
+
+        def residuals(params):
+            FR_fit, Fz_fit = _mn_forces(params, Rs, Zs, ncomp)
+            return np.append(np.sqrt((FR_fit-FR)**2 + (Fz_fit-Fz)**2)/F, 10*(np.sum(params[:ncomp])-1))
+
+        # spread the single-shell components over the range of shell scale radii
+        params0 = [params for params in starts if len(params) == 3*ncomp]
+        scales = np.geomspace(hr_lo, hr_hi, ncomp) if ncomp > len(mn_masses) else np.ones(ncomp)
+        idxs = np.arange(ncomp) % len(mn_masses)
+        params0.append(np.concatenate([mn_masses[idxs]*len(mn_masses)/ncomp, np.log(mn_a[idxs]*scales), np.log(mn_b[idxs]*scales)]))
+        params0.append(np.concatenate([rng.uniform(0.5, 1.5, ncomp)/ncomp, np.log(np.geomspace(0.5*hr_lo, 4*hr_hi, ncomp)), np.log(z_scale*hr_lo) + rng.normal(0, 0.3, ncomp)]))
+
+        # keep the component scales within the range of the fit points
+        log_lo, log_hi = np.log(1e-3*z_scale*hr_lo), np.log(1e3*hr_hi)
+        lower = np.concatenate([np.full(ncomp, -np.inf), np.full(2*ncomp, log_lo)])
+        upper = np.concatenate([np.full(ncomp, np.inf), np.full(2*ncomp, log_hi)])
+
+        for start in params0:
+            params = least_squares(residuals, np.clip(start, lower+1e-6, upper-1e-6), bounds=(lower, upper)).x
+            err = np.max(np.abs(residuals(params)[:-1]))
+            if err < best_err:
+                best_err, best_params, best_ncomp = err, params, ncomp
+            if best_err < rtol:
+                break
+
+        if best_err < rtol:
+            break
+
+    masses = best_params[:best_ncomp] * mtot
+    a = np.exp(best_params[best_ncomp:2*best_ncomp]) * hr_ref
+    b = np.exp(best_params[2*best_ncomp:3*best_ncomp]) * hr_ref
+
+    return masses, a, b, best_err
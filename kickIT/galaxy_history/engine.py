@@ -0,0 +1,134 @@
+"""Plain-float engine for the mass histories and mass profiles of galaxies.
+
+GalaxyHistory applies astropy units at its interface, while the calculations here use floats in fixed units: times in Gyr, masses in Msun, SFRs in Msun/yr, and radii in kpc. The profiles of every timestep are calculated at once as arrays.
+"""
+
+import numpy as np
+import astropy.units as u
+
+from . import baryons
+
+GYR_TO_YR = u.Gyr.to(u.yr)
+GYR_TO_S = u.Gyr.to(u.s)
+MSUN_TO_G = u.Msun.to(u.g)
+KPC_TO_CM = u.kpc.to(u.cm)
+# Converts SFRs from g/s to Msun/yr
+SFR_CGS_TO_MSUN_YR = u.g.to(u.Msun) / u.s.to(u.yr)
+
+
+def sfr_main_sequence(sfr_ms, mstar, time, sigma):
+    """SFR [Msun/yr] of a galaxy with stellar mass mstar [Msun] at time [Gyr], offset by sigma from the SFR main sequence sfr_ms.
+    """
+    return sfr_ms.sfr_from_mstar(mstar*MSUN_TO_G, time*GYR_TO_S, sigma)[0] * SFR_CGS_TO_MSUN_YR
+
+
+def star_forming_history(sfr_ms, sigma, time_beg, mstar_beg, sfr_beg, mstar_end, min_time, min_mstar, max_dt, max_dm_frac, max_steps):
+    """Integrates the stellar mass backward in time along the SFR main sequence, starting from the beginning of the quiescent phase (time_beg, mstar_beg, sfr_beg).
+
+    Steps are at most max_dt long, and change the stellar mass by at most max_dm_frac of mstar_end. The integration stops at min_time or once the stellar mass reaches min_mstar.
+
+    Returns the times, SFRs, and stellar masses of the star-forming phase, in order of increasing time.
+    """
+    times = []
+    sfr = []
+    mass_stars = []
+
+    prev_mstar = mstar_beg
+    prev_time = time_beg
+    prev_sfr = sfr_beg
+
+    temp_time = prev_time
+    temp_mstar = prev_mstar
+    ii = 0
+    while (temp_time > min_time) and (temp_mstar > min_mstar):
+        temp_dt = max_dt
+        temp_time = prev_time - temp_dt
+        if temp_time < 0.0:
+            temp_time = min_time
+            temp_dt = prev_time - temp_time
+
+        temp_mstar = prev_mstar - temp_dt * GYR_TO_YR * prev_sfr
+        if temp_mstar <= 0.0:
+            temp_dt = (prev_mstar - min_mstar) / prev_sfr / GYR_TO_YR
+            temp_time = prev_time - temp_dt
+            temp_mstar = prev_mstar - temp_dt * GYR_TO_YR * prev_sfr
+
+        temp_sfr = sfr_main_sequence(sfr_ms, temp_mstar, temp_time, sigma)
+        if not np.isfinite(temp_sfr):
+            raise ValueError("Infinite `temp_sfr`!")
+
+        temp_dm = temp_sfr * temp_dt * GYR_TO_YR
+
+        if temp_dm/mstar_end > max_dm_frac:
+            temp_dt = 0.98*max_dm_frac*mstar_end / temp_sfr / GYR_TO_YR
+            temp_time = prev_time - temp_dt
+            temp_dm = temp_sfr * temp_dt * GYR_TO_YR
+
+            if temp_dm/mstar_end > max_dm_frac:
+                raise ValueError("Mass-change STILL too large!")
+
+        temp_mstar = prev_mstar - temp_dm
+        temp_sfr = sfr_main_sequence(sfr_ms, temp_mstar, temp_time, sigma)
+        temp_sfr = 0.5 * (temp_sfr + prev_sfr)
+        temp_dm = temp_sfr * temp_dt * GYR_TO_YR
+
+        if temp_dm/mstar_end > max_dm_frac:
+            temp_dt = max_dm_frac*mstar_end / temp_sfr / GYR_TO_YR
+            temp_time = prev_time - temp_dt
+            temp_dm = temp_sfr * temp_dt * GYR_TO_YR
+
+        if prev_mstar - temp_dm < min_mstar:
+            temp_dm = (prev_mstar - min_mstar)
+            temp_dt = temp_dm / temp_sfr / GYR_TO_YR
+            temp_time = prev_time - temp_dt
+
+        temp_mstar = prev_mstar - temp_dm
+        times.append(temp_time)
+        sfr.append(temp_sfr)
+        mass_stars.append(temp_mstar)
+
+        prev_mstar = temp_mstar
+        prev_sfr = temp_sfr
+        prev_time = temp_time
+
+        ii += 1
+        if ii > max_steps:
+            raise RuntimeError("Excceded maximum steps!")
+
+    return np.array(times[::-1]), np.array(sfr[::-1]), np.array(mass_stars[::-1])
+
+
+def formed_steps(sfr, mass_stars):
+    """Timesteps at which the galaxy has 'formed' (i.e. has non-negligible mass and SFR), which are the only ones with mass profiles. The first timestep never has a profile.
+    """
+    return (np.arange(np.size(sfr)) > 0) & (sfr > 0.0) & (mass_stars > 0.0)
+
+
+def baryon_profiles(rads, times, sfr, mass_stars, mass_gas, scaling=1.0):
+    """Radial mass profiles of the newly formed stars, total stars, and gas at every timestep, and the scale radii of the baryonic disks.
+
+    The stars formed during a timestep follow the SFR disk of the previous timestep, and accumulate until the next timestep at which the galaxy has not formed. Returns arrays of shape (times, rads) for the profiles, and (times,) for the scale radii.
+    """
+    formed = formed_steps(sfr, mass_stars)
+
+    # --- exponential disk-profiles (normalized to 1) of the formed steps, used for both gas and SFR radial distributions since the gas follows the SFR
+    disk_profs = np.zeros((np.size(times), np.size(rads)))
+    Rscale_baryons = np.zeros(np.size(times))
+    disk_profs[formed], Rscale_baryons[formed] = baryons.sfr_rad_dists(rads*KPC_TO_CM, mass_stars[formed]*MSUN_TO_G, scaling=scaling)
+    Rscale_baryons /= KPC_TO_CM
+
+    # --- mass formed during each timestep, distributed in the SFR disk
+    dts = np.zeros(np.size(times))
+    dts[1:] = np.diff(times) * GYR_TO_YR
+    mass_sfr_prof = np.where(formed, sfr*dts, 0.0)[:, np.newaxis] * disk_profs
+
+    # --- stars accumulate the mass formed in all previous steps, back to the last step that had not formed
+    prev_sfr_prof = np.cumsum(mass_sfr_prof, axis=0)
+    prev_sfr_prof = np.concatenate([np.zeros((1, np.size(rads))), prev_sfr_prof[:-1]])
+    last_unformed = np.maximum.accumulate(np.where(formed, 0, np.arange(np.size(times))))
+    mass_stars_prof = np.where(formed[:, np.newaxis], prev_sfr_prof - prev_sfr_prof[last_unformed], 0.0)
+
+    # --- distribute gas in disk
+    mass_gas_prof = mass_gas[:, np.newaxis] * disk_profs
+
+    return mass_sfr_prof, mass_stars_prof, mass_gas_prof, Rscale_baryons
@@ -1,10 +1,14 @@
 """Dark Matter Halo and Subhalo related code.
 """
 
+from functools import lru_cache
+
 import numpy as np
 import astropy as ap
 import scipy as sp
 from . import utils, baryons
+from .. import cache
+from ..lazy import lazy_import
 
 MSOL = ap.constants.M_sun.cgs.value    # gram
 PC = ap.units.pc.to(ap.units.cm)       # cm
@@ -13,7 +17,11 @@ YR = 365.2425*24*3600                  # sec
 KPC = 1e3 * PC    # cm
 GYR = 1e9 * YR    # yr
 
-from . cosmology import Cosmology
+# Seed of the Monte Carlo draws used to construct the SMHM tables, so that every run uses the same relation
+MC_SEED = 1205
+
+# astropy.cosmology is slow to import, so the cosmology is only loaded once it is used
+cosmology = lazy_import(__package__+'.cosmology')
 
 class Moster_1205_5807():
 
@@ -43,7 +51,9 @@ class Moster_1205_5807():
         }
     }
 
-    def __init__(self, redz=0.0, store=False):
+    def __init__(self, redz=0.0, store=False, seed=MC_SEED):
+        """The Monte Carlo tables are drawn with the given seed, and saved to (or loaded from) the table cache (see cache.cached_table). If seed is None, they are drawn from the global numpy random state every time.
+        """
         MHALO_GRID_RANGE = [10.0, 20.0]   # log10(M_h/Msol)
         MHALO_GRID_SIZE_PER_DEX = 4      # per decade
         NUM_MC = 1000
@@ -55,18 +65,28 @@ class Moster_1205_5807():
         mhalo_grid_size = np.diff(MHALO_GRID_RANGE) * MHALO_GRID_SIZE_PER_DEX
         mhalo_grid = np.logspace(*MHALO_GRID_RANGE, mhalo_grid_size) * MSOL
 
-        # MC Calculate stellar-masses from grid of halo-masses
-        # shape: (N, M) for `N` halo-masses, and `M` MC samples
-        mstar_from_mhalo_grid = self.stellar_mass(mhalo_grid[:, np.newaxis], size=NUM_MC)
-
         # Construct a grid of standard-deviation values
         sigma_grid_size = np.diff(SIGMA_GRID_RANGE) * SIGMA_GRID_SIZE_PER_STD
         sigma_grid = np.linspace(*SIGMA_GRID_RANGE, sigma_grid_size)
-        # Convert standard-deviations to percentiles
-        percentiles = sp.stats.norm.cdf(sigma_grid)
-        # Calculate distribution of stellar masses
-        # shape: (L, N) for `L` standard-deviation values and `N` halo masses
-        mstar_dist = np.percentile(mstar_from_mhalo_grid, 100*percentiles, axis=-1)
+
+        def build():
+            # MC Calculate stellar-masses from grid of halo-masses
+            # shape: (N, M) for `N` halo-masses, and `M` MC samples
+            rng = None if seed is None else np.random.RandomState(seed)
+            mstar_from_mhalo_grid = self.stellar_mass(mhalo_grid[:, np.newaxis], size=NUM_MC, rng=rng)
+
+            # Convert standard-deviations to percentiles
+            from scipy.stats import norm
+            percentiles = norm.cdf(sigma_grid)
+            # Calculate distribution of stellar masses
+            # shape: (L, N) for `L` standard-deviation values and `N` halo masses
+            return np.percentile(mstar_from_mhalo_grid, 100*percentiles, axis=-1)
+
+        if seed is None:
+            mstar_dist = build()
+        else:
+            inputs = {'DATA': self.DATA, 'mhalo_grid': mhalo_grid.tolist(), 'sigma_grid': sigma_grid.tolist(), 'nmc': NUM_MC, 'seed': seed}
+            mstar_dist = cache.cached_table('moster_1205_5807', inputs, build)
 
         # Find the range of valid stellar-masses
         # Minimum value is the one reached by the *highest* percentile, at the lowest halo-mass
@@ -112,14 +132,15 @@ class Moster_1205_5807():
         return mstar
 
     @classmethod
-    def param(cls, name, redz=0.0, size=None):
+    def param(cls, name, redz=0.0, size=None, rng=None):
         data = cls.DATA[name]
         vals = data['VALS']
         sigma = data['SIGMA']
         log_flag = data['LOG']
 
         if size is not None:
-            vals = [np.random.normal(pp, ss, size=size) for pp, ss in zip(vals, sigma)]
+            rng = np.random if rng is None else rng
+            vals = [rng.normal(pp, ss, size=size) for pp, ss in zip(vals, sigma)]
 
         par = vals[0] + vals[1] * redz / (1 + redz)
         if log_flag:
@@ -128,11 +149,11 @@ class Moster_1205_5807():
         return par
 
     @classmethod
-    def stellar_mass(cls, mhalo, redz=0.0, size=None):
-        m1 = cls.param("M1", redz=redz, size=size)
-        norm = cls.param("N1", redz=redz, size=size)
-        beta = cls.param("B1", redz=redz, size=size)
-        gamma = cls.param("G1", redz=redz, size=size)
+    def stellar_mass(cls, mhalo, redz=0.0, size=None, rng=None):
+        m1 = cls.param("M1", redz=redz, size=size, rng=rng)
+        norm = cls.param("N1", redz=redz, size=size, rng=rng)
+        beta = cls.param("B1", redz=redz, size=size, rng=rng)
+        gamma = cls.param("G1", redz=redz, size=size, rng=rng)
 
         bterm = np.power(mhalo/m1, -beta)
         gterm = np.power(mhalo/m1, gamma)
@@ -153,27 +174,22 @@ class KLYPIN_1411_4001:
     _mass0 = [5.50e+05, 1.00e+05, 2.00e+04, 9.00e+02, 3.00e+02,
               4.20e+01, 1.70e+01, 8.50e+00, 2.00e+00, 3.00e-01]
 
-    _zz = np.log10(1 + np.array(_redz))
-    _lin_interp_c0 = utils.interp_1d(_zz, np.log10(_c0))
-    _lin_interp_gamma = utils.interp_1d(_zz, np.log10(_gamma))
-    _lin_interp_mass0 = utils.interp_1d(_zz, np.log10(_mass0)+np.log10(1e12 * MSOL / Cosmology.h))
-
     @classmethod
     def c0(cls, redz):
         xx = np.log10(1 + redz)
-        yy = np.power(10.0, cls._lin_interp_c0(xx))
+        yy = np.power(10.0, klypin_1411_4001_interps()[0](xx))
         return yy
 
     @classmethod
     def gamma(cls, redz):
         xx = np.log10(1 + redz)
-        yy = np.power(10.0, cls._lin_interp_gamma(xx))
+        yy = np.power(10.0, klypin_1411_4001_interps()[1](xx))
         return yy
 
     @classmethod
     def mass0(cls, redz):
         xx = np.log10(1 + redz)
-        yy = np.power(10.0, cls._lin_interp_mass0(xx))
+        yy = np.power(10.0, klypin_1411_4001_interps()[2](xx))
         return yy
 
     @classmethod
@@ -181,12 +197,24 @@ class KLYPIN_1411_4001:
         c0 = cls.c0(redz)
         gamma = cls.gamma(redz)
         mass0 = cls.mass0(redz)
-        f1 = np.power(mass/(1e12*MSOL/Cosmology.h), -gamma)
+        f1 = np.power(mass/(1e12*MSOL/cosmology.Cosmology.h), -gamma)
         f2 = 1 + np.power(mass/mass0, 0.4)
         conc = c0 * f1 * f2
         return conc
 
 
+@lru_cache()
+def klypin_1411_4001_interps():
+    """Interpolants of the c0, gamma, and mass0 of KLYPIN_1411_4001 in log10(1+z), constructed on first use.
+    """
+    klypin = KLYPIN_1411_4001
+    zz = np.log10(1 + np.array(klypin._redz))
+    lin_interp_c0 = utils.interp_1d(zz, np.log10(klypin._c0))
+    lin_interp_gamma = utils.interp_1d(zz, np.log10(klypin._gamma))
+    lin_interp_mass0 = utils.interp_1d(zz, np.log10(klypin._mass0)+np.log10(1e12 * MSOL / cosmology.Cosmology.h))
+    return lin_interp_c0, lin_interp_gamma, lin_interp_mass0
+
+
 def nfw_dens_prof(rads, mhalo, redz, cosmo):
     """NFW DM Density profile.
 
@@ -225,18 +253,59 @@ def nfw_mass_prof(rads, mhalo, redz, cosmo):
     return mass, rs
 
 
-# Construct interpolants for inverting halo-mass--stellar-mass relation
-mass_halo_grid = np.logspace(6, 15, 1000) * MSOL
-mass_stel_grid = baryons.halo_mass_to_stellar_mass(mass_halo_grid)
-xx = np.log10(mass_stel_grid)
-yy = np.log10(mass_halo_grid)
-lin_interp = utils.interp_1d(xx, yy, fill_value=-np.inf)
+def nfw_mass_profs(rads, mhalos, redz, cosmo):
+    """Vectorized version of nfw_mass_prof, for arrays of halo masses and redshifts that broadcast against each other.
+
+    Returns the masses in radial shells, with the radii along the last axis, and the scale radii. Halos with zero mass have empty profiles and a scale radius of 0.
+    """
+    mhalos, redz = np.broadcast_arrays(np.asarray(mhalos, dtype=float), np.asarray(redz, dtype=float))
+    dens = np.zeros(mhalos.shape + np.shape(rads))
+    rs = np.zeros(mhalos.shape)
+
+    pos = (mhalos != 0)
+    mm, zz = mhalos[pos], redz[pos]
+
+    # same as nfw_dens_prof, for every halo at once
+    conc = KLYPIN_1411_4001.concentration(mm, zz)
+    log_c_term = np.log(1 + conc) - conc/(1+conc)
+    delta_c = (200/3) * (conc**3) / log_c_term
+    rho_s = cosmo.critical_density(zz).cgs.value * delta_c
+    rs[pos] = np.power(mm / (4*np.pi*rho_s*log_c_term), 1.0/3.0)
+
+    xx = rads[np.newaxis, :] / rs[pos][:, np.newaxis]
+    dens[pos] = rho_s[:, np.newaxis] / (xx * np.square(1 + xx))
+
+    mass = dens * utils.shell_volumes(rads, relative=False)
+    return mass, rs
+
+
+@lru_cache()
+def moster_1205_5807():
+    """Shared instance of Moster_1205_5807, so its tables are only constructed once per process (and loaded from the table cache after the first run).
+    """
+    return Moster_1205_5807(store=True)
+
+
+@lru_cache()
+def guo_0909_4305_inverse():
+    """Interpolant for inverting the halo-mass--stellar-mass relation of Guo+2010, from log10 stellar mass to log10 halo mass. Constructed on first use.
+    """
+    mass_halo_grid = np.logspace(6, 15, 1000) * MSOL
+    mass_stel_grid = baryons.halo_mass_to_stellar_mass(mass_halo_grid)
+    xx = np.log10(mass_stel_grid)
+    yy = np.log10(mass_halo_grid)
+    return utils.interp_1d(xx, yy, fill_value=-np.inf)
 
 
 def stellar_mass_to_halo_mass(mstar, relation='Guo', redz=None, sigma=None):
     """Inverted Guo+2010 relation.
     Also can call Moster_1205_5807 relation.
+
+    If an array of sigma values is given, returns one row of halo masses per sigma (the Guo relation does not depend on sigma).
     """
+    if np.ndim(sigma) > 0:
+        return _stellar_mass_to_halo_mass_sigmas(mstar, relation, np.asarray(sigma, dtype=float))
+
     if relation not in ['Guo', 'Moster']:
         raise NameError('Stellar mass-Halo mass relation {0:s} not recognized!'.format(relation))
 
@@ -244,13 +313,33 @@ def stellar_mass_to_halo_mass(mstar, relation='Guo', redz=None, sigma=None):
     pos_vals = mstar!=0
 
     if relation == 'Guo':
-        mhalo[pos_vals] = lin_interp(np.log10(mstar[pos_vals]))
+        mhalo[pos_vals] = guo_0909_4305_inverse()(np.log10(mstar[pos_vals]))
         mhalo[pos_vals] = np.power(10.0, mhalo[pos_vals])
 
     elif relation == 'Moster':
-        mos = Moster_1205_5807(store=True)
+        mos = moster_1205_5807()
         mhalo[pos_vals] = mos.mhalo_from_mstar(mstar[pos_vals], sigma=sigma)
 
 
     return mhalo
 
+
+def _stellar_mass_to_halo_mass_sigmas(mstar, relation, sigmas):
+    if relation not in ['Guo', 'Moster']:
+        raise NameError('Stellar mass-Halo mass relation {0:s} not recognized!'.format(relation))
+
+    if relation == 'Guo':
+        mhalo = stellar_mass_to_halo_mass(mstar, relation=relation)
+        return np.tile(mhalo, (sigmas.size, 1))
+
+    mhalo = np.zeros((sigmas.size,) + np.shape(mstar))
+    pos_vals = mstar!=0
+
+    # the interpolant evaluates on the grid of (sorted) sigmas and stellar masses at once
+    mos = moster_1205_5807()
+    order = np.argsort(sigmas)
+    vals = np.atleast_2d(mos.mhalo_from_mstar(mstar[pos_vals], sigma=sigmas[order]))
+    mhalo[:, pos_vals] = vals[np.argsort(order)]
+
+    return mhalo
+
@@ -0,0 +1,175 @@
+"""Compact HDF5 storage of galaxy models.
+
+Only the scalar history of the galaxy (times, redshifts, masses, SFR, scale radii, and weights) and the parameters it was built with are saved, as plain arrays with their units stored as strings. The potentials, mass profiles, and cosmology are rebuilt from these when they are first accessed (see GalaxyHistory.__getattr__), so files are small, fast to load, and do not depend on the galpy or astropy versions they were written with.
+"""
+import json
+
+import numpy as np
+
+import astropy.units as u
+
+from .. import __version__
+from ..lazy import lazy_import
+
+h5py = lazy_import('h5py')
+
+
+FORMAT_NAME = 'kickIT-galaxy'
+FORMAT_VERSION = 1
+
+# Arrays with one entry per timestep (and the radial grid), stored as datasets
+HISTORY_ARRAYS = ['times', 'redz', 'mass_stars', 'mass_gas', 'mass_dm', 'sfr', 'Rscale_baryons', 'Rscale_dm', 'sfr_weights', 'rads']
+# Scalars determined while building the history
+HISTORY_SCALARS = ['time_beg', 'time_end', 'time_dur', 'time_sfr_peak', 'redz_sfr_peak', 'time_quench', 'redz_quench', 'STAR_AGE_RTOL']
+# Arguments that the galaxy was built with, other than the observed properties
+BUILD_PARAMS = ['disk_profile', 'dm_profile', 'smhm_relation', 'smhm_sigma', 'bulge_profile', 'z_scale', 'differential_prof', 'collapse_shells', 'coarsen_tol']
+# Arrays that differ between the realizations of an ensemble (see construct_ensemble)
+ENSEMBLE_ARRAYS = ['mass_dm', 'Rscale_dm']
+
+
+def _encode(value):
+    """JSON-compatible representation of a scalar, keeping the units of astropy quantities.
+    """
+    if isinstance(value, u.Quantity):
+        return {'value': _encode(value.value), 'unit': value.unit.to_string()}
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict) and ('unit' in value):
+        return value['value'] * u.Unit(value['unit'])
+    return value
+
+
+def write_hdf(gal, path):
+    """Writes the history and build parameters of a gal class to an HDF5 file.
+    """
+    with h5py.File(path, 'w') as f:
+        _write_galaxy(f, gal)
+
+    return
+
+
+def write_ensemble_hdf(gals, path):
+    """Writes an ensemble of realizations of a galaxy that only differ in their DM to an HDF5 file.
+
+    The first realization is stored in full, and only the SMHM sigma, DM masses and scale radii, and potential epochs of each realization are stored in addition.
+    """
+    with h5py.File(path, 'w') as f:
+        _write_galaxy(f, gals[0])
+
+        members = f.create_group('members')
+        members.create_dataset('smhm_sigma', data=[gal.smhm_sigma for gal in gals])
+        for key in ENSEMBLE_ARRAYS:
+            vals = u.Quantity([getattr(gal, key) for gal in gals])
+            members.create_dataset(key, data=vals.value)
+            members[key].attrs['unit'] = vals.unit.to_string()
+        if getattr(gals[0], 'potential_epochs', None) is not None:
+            members.create_dataset('potential_epochs', data=np.array([gal.potential_epochs for gal in gals]))
+
+    return
+
+
+def _write_galaxy(f, gal):
+    """Writes a galaxy to an open HDF5 file.
+    """
+    f.attrs['format'] = FORMAT_NAME
+    f.attrs['format_version'] = FORMAT_VERSION
+    f.attrs['kickIT_version'] = __version__
+
+    # galaxies built before an option existed were built without it
+    f.attrs['params'] = json.dumps({key: _encode(getattr(gal, key, None)) for key in BUILD_PARAMS})
+    f.attrs['obs_props'] = json.dumps({key: _encode(val) for key, val in gal.obs_props.items()})
+    f.attrs['scalars'] = json.dumps({key: _encode(getattr(gal, key)) for key in HISTORY_SCALARS})
+
+    history = f.create_group('history')
+    for key in HISTORY_ARRAYS:
+        vals = getattr(gal, key)
+        if isinstance(vals, u.Quantity):
+            history.create_dataset(key, data=vals.value)
+            history[key].attrs['unit'] = vals.unit.to_string()
+        else:
+            history.create_dataset(key, data=np.asarray(vals))
+
+    if getattr(gal, 'potential_epochs', None) is not None:
+        history.create_dataset('potential_epochs', data=gal.potential_epochs)
+
+    # --- collapsed stellar shells, as the concatenated components of each timestep
+    collapsed_shells = getattr(gal, 'collapsed_shells', None)
+    if collapsed_shells is not None:
+        fits = [fit for fit in collapsed_shells if fit is not None]
+        shells = f.create_group('collapsed_shells')
+        shells.create_dataset('ncomp', data=[0 if fit is None else len(fit[0]) for fit in collapsed_shells])
+        shells.create_dataset('error', data=[np.nan if fit is None else fit[3] for fit in collapsed_shells])
+        for idx, key in enumerate(['masses', 'a', 'b']):
+            shells.create_dataset(key, data=np.concatenate([fit[idx] for fit in fits]) if fits else np.zeros(0))
+
+    return
+
+
+def read_hdf(path):
+    """Reads a galaxy model written by write_hdf, returning a dictionary of the attributes of the gal class.
+    """
+    with h5py.File(path, 'r') as f:
+        if 'members' in f:
+            raise ValueError('File {0:s} holds an ensemble of galaxy models, use read_ensemble_hdf!'.format(path))
+        attrs = _read_galaxy(f, path)
+
+    return attrs
+
+
+def read_ensemble_hdf(path):
+    """Reads an ensemble of galaxy models written by write_ensemble_hdf, returning a list of dictionaries of the attributes of each gal class.
+    """
+    with h5py.File(path, 'r') as f:
+        attrs = _read_galaxy(f, path)
+
+        members = f['members']
+        sigmas = members['smhm_sigma'][()]
+        member_vals = {key: members[key][()] * u.Unit(members[key].attrs['unit']) for key in ENSEMBLE_ARRAYS}
+        if 'potential_epochs' in members:
+            member_vals['potential_epochs'] = members['potential_epochs'][()]
+
+    ensemble = []
+    for kk, sigma in enumerate(sigmas):
+        member = dict(attrs)
+        member['smhm_sigma'] = float(sigma)
+        member.update({key: vals[kk] for key, vals in member_vals.items()})
+        ensemble.append(member)
+
+    return ensemble
+
+
+def _read_galaxy(f, path):
+    """Reads a galaxy from an open HDF5 file.
+    """
+    if f.attrs.get('format') != FORMAT_NAME:
+        raise ValueError('File {0:s} is not a kickIT galaxy model!'.format(path))
+    if f.attrs['format_version'] > FORMAT_VERSION:
+        raise ValueError('Galaxy model {0:s} has format version {1:d}, but only versions up to {2:d} can be read!'.format(path, f.attrs['format_version'], FORMAT_VERSION))
+
+    attrs = json.loads(f.attrs['params'])
+    attrs['obs_props'] = {key: _decode(val) for key, val in json.loads(f.attrs['obs_props']).items()}
+    attrs.update({key: _decode(val) for key, val in json.loads(f.attrs['scalars']).items()})
+
+    history = f['history']
+    for key in HISTORY_ARRAYS:
+        vals = history[key][()]
+        if 'unit' in history[key].attrs:
+            vals = vals * u.Unit(history[key].attrs['unit'])
+        attrs[key] = vals
+
+    if 'potential_epochs' in history:
+        attrs['potential_epochs'] = history['potential_epochs'][()]
+
+    if 'collapsed_shells' in f:
+        shells = f['collapsed_shells']
+        ncomps, errs = shells['ncomp'][()], shells['error'][()]
+        masses, a, b = shells['masses'][()], shells['a'][()], shells['b'][()]
+        bounds = np.concatenate([[0], np.cumsum(ncomps)])
+        attrs['collapsed_shells'] = [None if ncomp == 0 else (masses[lo:hi], a[lo:hi], b[lo:hi], errs[ii]) \
+                        for ii, (ncomp, lo, hi) in enumerate(zip(ncomps, bounds[:-1], bounds[1:]))]
+
+    return attrs
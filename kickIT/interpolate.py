@@ -0,0 +1,314 @@
+"""Construction and validation of interpolated galactic potentials.
+"""
+import os
+import warnings
+import time
+import pickle
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+import astropy.units as u
+
+from galpy.potential import interpRZPotential, evaluateRforces, evaluatezforces
+
+from . import cache
+
+
+# Inner edge of the radial grid, in kpc
+RGRID_MIN = 1e-4
+
+# Starting point and limits for the adaptive grid selection
+RGRID_START = 32
+ZGRID_START = 16
+RGRID_LIMIT = 2000
+ZGRID_LIMIT = 1000
+
+# Order of the bicubic splines used by interpRZPotential; the interpolation error scales as h**ORDER
+SPLINE_ORDER = 4
+# Safety factor when extrapolating the number of gridpoints needed to reach the tolerance
+REFINE_SAFETY = 1.2
+MIN_REFINE = 1.25
+MAX_REFINE = 4.0
+# Refinement along an axis stops if the error does not drop below this fraction of its previous value
+MIN_IMPROVEMENT = 0.8
+
+# Number of off-grid points (per axis) used to measure the interpolation error
+NUM_TEST_POINTS = 100
+# Number of timesteps used to tune and validate the grid
+NUM_TEST_STEPS = 3
+
+# Default number of interpolants held in memory by the InterpolantProvider
+INTERP_CACHE_SIZE = 64
+# Interval for checking whether another process has finished building an interpolant, and time after which its lock is considered stale, in seconds
+LOCK_POLL = 5
+LOCK_TIMEOUT = 6*3600
+
+VERBOSE = True
+
+
+def interp_grids(Rgrid, Zgrid, Rgrid_max, Zgrid_max, ro=8*u.kpc):
+    """Returns the (min, max, N) tuples for the radial and vertical grids in galpy's natural units.
+    The radial grid is flat in ln(R), as expected by interpRZPotential when logR=True.
+    """
+    rads = (np.asarray([RGRID_MIN, Rgrid_max])*u.kpc / ro).value
+    heights = (np.asarray([0, Zgrid_max])*u.kpc / ro).value
+
+    rgrid = (*np.log(rads), int(Rgrid))
+    zgrid = (*heights, int(Zgrid))
+
+    return rgrid, zgrid
+
+
+def interp_func(potentials, rgrid, zgrid, ro=8*u.kpc, vo=220*u.km/u.s):
+    """Interpolates the forces of the combined potentials on the supplied grid.
+    """
+    ip = interpRZPotential(potentials, rgrid=rgrid, zgrid=zgrid, logR=True, interpRforce=True, interpzforce=True, zsym=True, ro=ro, vo=vo)
+    return ip
+
+
+def force_errors(potentials, ip, Rs, Zs):
+    """Fractional error in the total force of the interpolant relative to direct evaluation of the potentials, at the points (Rs, Zs) in natural units.
+    """
+    # galpy's disk potentials do not accept array inputs, so evaluate point by point
+    FR = np.asarray([evaluateRforces(potentials, R, Z, use_physical=False) for (R,Z) in zip(Rs,Zs)])
+    Fz = np.asarray([evaluatezforces(potentials, R, Z, use_physical=False) for (R,Z) in zip(Rs,Zs)])
+    FR_ip = np.asarray([evaluateRforces(ip, R, Z, use_physical=False) for (R,Z) in zip(Rs,Zs)])
+    Fz_ip = np.asarray([evaluatezforces(ip, R, Z, use_physical=False) for (R,Z) in zip(Rs,Zs)])
+
+    return np.sqrt((FR_ip-FR)**2 + (Fz_ip-Fz)**2) / np.sqrt(FR**2 + Fz**2)
+
+
+def test_points(rgrid, zgrid, npts=NUM_TEST_POINTS, seed=0):
+    """Off-grid points for measuring the interpolation error along each axis.
+
+    Returns points at the radial midpoints of the grid (on the vertical nodes) and at the vertical midpoints (on the radial nodes), such that the error from each axis can be measured separately.
+    """
+    rng = np.random.RandomState(seed)
+    logRs = np.linspace(*rgrid)
+    Zs = np.linspace(*zgrid)
+    logR_mids = 0.5*(logRs[1:] + logRs[:-1])
+    Z_mids = 0.5*(Zs[1:] + Zs[:-1])
+
+    ridx = rng.randint(0, len(logR_mids), npts)
+    zidx = rng.randint(0, len(Zs), npts)
+    R_pts = (np.exp(logR_mids[ridx]), Zs[zidx])
+
+    ridx = rng.randint(0, len(logRs), npts)
+    zidx = rng.randint(0, len(Z_mids), npts)
+    Z_pts = (np.exp(logRs[ridx]), Z_mids[zidx])
+
+    return R_pts, Z_pts
+
+
+def test_steps(gal, nsteps=NUM_TEST_STEPS):
+    """Chooses the timesteps used to tune and validate the grid.
+
+    Tracers are born according to the SFR weights, so the steps are taken at evenly spaced quantiles of the cumulative SFR weight, in addition to the final step (the observed galaxy).
+    """
+    cum_weights = np.cumsum(gal.sfr_weights)
+    quantiles = np.linspace(0.05, 0.95, nsteps-1)
+    steps = np.searchsorted(cum_weights, quantiles)
+    steps = np.unique(np.append(steps, len(gal.times)-1))
+    return steps
+
+
+def select_grid(gal, force_rtol, Rgrid_max=1e3, Zgrid_max=1e2, steps=None):
+    """Chooses the number of radial and vertical gridpoints needed to interpolate the potentials of the gal class to within a fractional force error of force_rtol.
+
+    The error along each axis is measured separately at off-grid points, and only the axis that misses the tolerance is refined. Since interpolation errors scale as a power of the grid spacing, the refinement factor is extrapolated from the measured error, such that the final grid is not much larger than it needs to be.
+
+    Returns the number of radial and vertical gridpoints and the achieved errors at each of the tuning steps.
+    """
+    if steps is None:
+        steps = test_steps(gal)
+
+    print('Selecting interpolation grid for a fractional force error of {0:0.1e} using timesteps {1:s}...\n'.format(force_rtol, str(list(steps))))
+
+    Rgrid, Zgrid = RGRID_START, ZGRID_START
+    prev_err_R, prev_err_Z = np.inf, np.inf
+    while True:
+        start = time.time()
+        rgrid, zgrid = interp_grids(Rgrid, Zgrid, Rgrid_max, Zgrid_max)
+        R_pts, Z_pts = test_points(rgrid, zgrid)
+
+        err_R, err_Z = 0.0, 0.0
+        errors = {}
+        for step in steps:
+            potentials = gal.full_potentials_natural[step]
+            ip = interp_func(potentials, rgrid, zgrid)
+            step_err_R = np.max(force_errors(potentials, ip, *R_pts))
+            step_err_Z = np.max(force_errors(potentials, ip, *Z_pts))
+            errors[step] = max(step_err_R, step_err_Z)
+            err_R = max(err_R, step_err_R)
+            err_Z = max(err_Z, step_err_Z)
+
+        if VERBOSE:
+            print('   grid {0:d}x{1:d}: radial error {2:0.2e}, vertical error {3:0.2e} ({4:0.2f}s)'.format(Rgrid, Zgrid, err_R, err_Z, time.time()-start))
+
+        if (err_R <= force_rtol) and (err_Z <= force_rtol):
+            break
+
+        if ((err_R > force_rtol) and (Rgrid >= RGRID_LIMIT)) or ((err_Z > force_rtol) and (Zgrid >= ZGRID_LIMIT)):
+            warnings.warn('Reached the maximum grid size ({0:d}x{1:d}) before the force tolerance was met!'.format(Rgrid, Zgrid))
+            break
+
+        # if refining an axis no longer helps, the structure is unresolvable on a uniform grid
+        if ((err_R > force_rtol) and (err_R > MIN_IMPROVEMENT*prev_err_R)) or ((err_Z > force_rtol) and (err_Z > MIN_IMPROVEMENT*prev_err_Z)):
+            warnings.warn('Force error stopped improving with grid refinement at {0:d}x{1:d} before the force tolerance was met!'.format(Rgrid, Zgrid))
+            break
+
+        # refine only the axes that have not reached the tolerance
+        if err_R > force_rtol:
+            Rgrid = min(int(np.ceil(Rgrid*refine_factor(err_R, force_rtol))), RGRID_LIMIT)
+            prev_err_R = err_R
+        if err_Z > force_rtol:
+            Zgrid = min(int(np.ceil(Zgrid*refine_factor(err_Z, force_rtol))), ZGRID_LIMIT)
+            prev_err_Z = err_Z
+
+    print('\nSelected a {0:d}x{1:d} grid, achieving a maximum fractional force error of {2:0.2e}\n'.format(Rgrid, Zgrid, max(err_R, err_Z)))
+
+    return Rgrid, Zgrid, errors
+
+
+def refine_factor(err, force_rtol):
+    """Factor by which to increase the number of gridpoints along an axis, extrapolated from the measured error.
+    """
+    factor = REFINE_SAFETY * (err/force_rtol)**(1.0/SPLINE_ORDER)
+    return np.clip(factor, MIN_REFINE, MAX_REFINE)
+
+
+def validate_interpolants(gal, interpolants, rgrid, zgrid, steps=None):
+    """Reports the maximum fractional force error of the interpolants relative to direct galpy evaluation at off-grid points.
+    """
+    if steps is None:
+        steps = test_steps(gal)
+
+    R_pts, Z_pts = test_points(rgrid, zgrid, seed=1)
+    Rs = np.concatenate([R_pts[0], Z_pts[0]])
+    Zs = np.concatenate([R_pts[1], Z_pts[1]])
+
+    errors = {}
+    for step in steps:
+        errors[step] = np.max(force_errors(gal.full_potentials_natural[step], interpolants[step], Rs, Zs))
+        print('   step {0:d} (z={1:0.2f}): maximum fractional force error {2:0.2e}'.format(step, gal.redz[step], errors[step]))
+    print('')
+
+    return errors
+
+
+
+class InterpolantProvider:
+    """Provides the interpolated potential of a gal class at each timestep on demand.
+
+    Interpolants are looked up by timestep like a list. On first use, an interpolant is loaded from the directory 'dirpath' if it was built previously, and otherwise it is built and saved there. At most 'maxsize' interpolants are kept in memory, with the least recently used ones evicted first.
+
+    The provider can be passed to multiprocessing workers; the in-memory cache is not pickled, and processes coordinate through lock files so each interpolant is only built once.
+
+    If the potential time grid of the gal class was coarsened (gal.potential_epochs), every timestep of an epoch is given the interpolant of the first timestep of the epoch.
+    """
+
+    def __init__(self, gal, dirpath, Rgrid=300, Zgrid=100, Rgrid_max=1e3, Zgrid_max=1e2, maxsize=INTERP_CACHE_SIZE, ro=8*u.kpc, vo=220*u.km/u.s):
+
+        self.gal = gal
+        self.dirpath = dirpath
+        self.rgrid, self.zgrid = interp_grids(Rgrid, Zgrid, Rgrid_max, Zgrid_max, ro=ro)
+        self.maxsize = maxsize
+        self.ro = ro
+        self.vo = vo
+        self._cache = OrderedDict()
+
+        os.makedirs(dirpath, exist_ok=True)
+
+        # --- make sure interpolants saved in this directory were built on the same grid
+        grid_info = {'rgrid': list(self.rgrid), 'zgrid': list(self.zgrid), 'ro': ro.to(u.kpc).value, 'vo': vo.to(u.km/u.s).value, 'nsteps': len(gal.times)}
+        grid_path = os.path.join(dirpath, 'grid.json')
+        if os.path.exists(grid_path):
+            saved_info = json.load(open(grid_path, 'r'))
+            if saved_info != json.loads(json.dumps(grid_info)):
+                raise ValueError('The interpolants in {0:s} were built with different parameters ({1:s}) than requested ({2:s})!'.format(dirpath, str(saved_info), str(grid_info)))
+        else:
+            cache.atomic_write(grid_path, lambda f: json.dump(grid_info, f), mode='w')
+
+    def __len__(self):
+        return len(self.gal.times)
+
+    def __getitem__(self, step):
+        step = self.epoch(step)
+
+        if step in self._cache:
+            self._cache.move_to_end(step)
+            return self._cache[step]
+
+        ip = self.load(step)
+        if ip is None:
+            ip = self.build(step)
+
+        self._cache[step] = ip
+        if (self.maxsize is not None) and (len(self._cache) > self.maxsize):
+            self._cache.popitem(last=False)
+
+        return ip
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+
+    def epoch(self, step):
+        """Timestep whose potential is used at this timestep.
+        """
+        step = int(step)
+        if step < 0:
+            step += len(self)
+
+        epochs = getattr(self.gal, 'potential_epochs', None)
+        if epochs is not None:
+            step = int(epochs[step])
+        return step
+
+    def path(self, step):
+        return os.path.join(self.dirpath, 'interp_{0:04d}.pkl'.format(step))
+
+    def exists(self, step):
+        return os.path.exists(self.path(step))
+
+    def load(self, step):
+        """Loads the interpolant at this timestep if it was saved previously, otherwise returns None.
+        """
+        if self.exists(step):
+            return pickle.load(open(self.path(step), 'rb'))
+        return None
+
+    def build(self, step):
+        """Builds the interpolant at this timestep and saves it. If another process is already building it, waits for it to finish instead.
+        """
+        lock_path = self.path(step)+'.lock'
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                break
+            except FileExistsError:
+                if self.exists(step):
+                    return self.load(step)
+                if (time.time() - os.path.getmtime(lock_path)) > LOCK_TIMEOUT:
+                    os.remove(lock_path)
+                    continue
+                time.sleep(LOCK_POLL)
+
+        try:
+            # another process may have finished this interpolant while we were waiting for the lock
+            if self.exists(step):
+                return self.load(step)
+
+            start = time.time()
+            ip = interp_func(self.gal.full_potentials_natural[step], self.rgrid, self.zgrid, ro=self.ro, vo=self.vo)
+            cache.atomic_write(self.path(step), lambda f: pickle.dump(ip, f))
+            if VERBOSE:
+                print('   interpolated potential for step {0:d} (z={1:0.2f}) created in {2:0.2f}s...'.format(step, self.gal.redz[step], time.time()-start))
+        finally:
+            os.remove(lock_path)
+
+        return ip
@@ -0,0 +1,27 @@
+"""Deferred imports of heavy modules.
+
+Importing galpy, astropy, pandas, or h5py takes a large fraction of a second each. Modules imported with lazy_import are only imported once one of their attributes is first used, so that quick command-line calls (e.g. --help or --version) and short tasks that only use part of the package do not pay for them.
+"""
+import types
+import importlib
+
+
+class _LazyModule(types.ModuleType):
+    """Placeholder for a module, which imports it when any of its attributes is accessed.
+    """
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        return getattr(module, attr)
+
+    def __setattr__(self, attr, value):
+        # e.g. module-level options such as cache.TABLE_DIRPATH, which must be set on the module itself
+        setattr(importlib.import_module(self.__name__), attr, value)
+
+    def __dir__(self):
+        return dir(importlib.import_module(self.__name__))
+
+
+def lazy_import(name):
+    """Module `name`, which (along with its parent packages) is only imported when one of its attributes is first accessed.
+    """
+    return _LazyModule(name)
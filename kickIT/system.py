@@ -1,11 +1,10 @@
 import numpy as np
-import pandas as pd
 
 import time
 import multiprocessing
 from functools import partial
-import copy
 import os
+import queue
 
 import astropy.units as u
 import astropy.constants as C
@@ -19,11 +18,63 @@ from galpy.orbit import Orbit
 from galpy.potential import evaluatePotentials
 
 from kickIT.galaxy_history import cosmology
+from kickIT.interpolate import InterpolantProvider
 from . import utils
+from . import tracer_storage
 
 
 VERBOSE=True
 
+# Number of tracers per chunk when writing the tracer data
+CHUNK_SIZE = 1000000
+
+# Results of the integration of each tracer, in the order returned by integrate_orbits, and those that are written to the output file as the tracers are integrated
+RESULT_COLUMNS = ['X','Y','Z','vX','vY','vZ','R_offset','Rproj_offset','merger_redz']
+STREAMED_COLUMNS = RESULT_COLUMNS[:-1]
+
+# galpy's natural units of distance [kpc] and velocity [km/s], as in utils.orbit_nat_to_phys
+GALPY_RO = 8.0
+GALPY_VO = 220.0
+
+
+class Column:
+    """Per-tracer quantity of the Systems class, with a declared unit and dtype.
+
+    The values are stored as a plain array in the Systems store. Reading the attribute returns a Quantity view of the array (or the array itself if the column has no unit), so in-place assignments modify the store. Assigned Quantities are converted to the declared unit, while plain arrays are assumed to already be in it. Derived columns, which nothing else is calculated from, are stored as float32 if the Systems class is initialized with float32=True.
+    """
+    def __init__(self, unit=None, dtype=np.float64, derived=False):
+        self.unit = unit
+        self.dtype = np.dtype(dtype)
+        self.derived = derived
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def store_dtype(self, systems):
+        if self.derived and systems.float32:
+            return np.dtype(np.float32)
+        return self.dtype
+
+    def __get__(self, systems, owner=None):
+        if systems is None:
+            return self
+        if self.name not in systems._columns:
+            raise AttributeError("'{0:s}' has not been calculated for these systems!".format(self.name))
+        values = systems._columns[self.name]
+        if self.unit is None:
+            return values
+        return u.Quantity(values, self.unit, copy=False)
+
+    def __set__(self, systems, values):
+        if isinstance(values, u.Quantity):
+            values = values.to_value(self.unit)
+        values = np.asarray(values, dtype=self.store_dtype(systems))
+        if values.shape != (systems.Nsys,):
+            raise ValueError("Column '{0:s}' should have shape ({1:d},), but has shape {2:s}!".format(self.name, systems.Nsys, str(values.shape)))
+        systems._columns[self.name] = values
+
+
+
 class Systems:
     """
     Places system in orbit in the galaxy model. 
@@ -34,27 +85,98 @@ class Systems:
     Galactic units: r, theta (polar angle), phi (azimuthal angle). 
     System starts on a circular orbit in the r-phi (x-y) plane, on the x-axis (phi=0) and moving in the positive y direction. 
     Galaxy projection taken account when determining radial offset at merger. 
-    """
-    def __init__(self, sampled_parameters, SNphi=None, SNtheta=None, SYSphi=None, SYStheta=None, sample_progenitor_props=False):
 
-        self.R = np.asarray(sampled_parameters['R'])*u.kpc
-        self.t0 = np.asarray(sampled_parameters['t0'])
-        self.tbirth = np.asarray(sampled_parameters['tbirth'])*u.Gyr
-        self.zbirth = np.asarray(sampled_parameters['zbirth'])*u.dimensionless_unscaled
-        self.Nsys = len(self.R)
+    The per-tracer quantities are the Column attributes below, stored as one plain array each in the order of COLUMNS. If float32==True, the derived outputs (e.g. the final positions, velocities, and offsets) are stored in single precision.
+    """
+    __slots__ = ('Nsys', 'float32', '_columns', '_streamed')
+
+    # --- birth properties
+    R = Column(u.kpc)
+    t0 = Column(dtype=int)
+    tbirth = Column(u.Gyr)
+    zbirth = Column(u.dimensionless_unscaled)
+
+    # --- progenitor properties
+    Mns = Column(u.Msun)
+    Mcomp = Column(u.Msun)
+    Mhe = Column(u.Msun)
+    Apre = Column(u.Rsun)
+    epre = Column(u.dimensionless_unscaled)
+    Vkick = Column(u.km/u.s)
+
+    # --- systemic properties, either sampled or calculated from the SN
+    Vsys = Column(u.km/u.s)
+    Tinsp = Column(u.Gyr)
+    SNsurvive = Column(dtype=bool)
+
+    # --- random orientations of the SN kick and of the system
+    SNphi = Column(u.rad)
+    SNtheta = Column(u.rad)
+    SYSphi = Column(u.rad)
+    SYStheta = Column(u.rad)
+
+    # --- escape and pre-SN galactic velocities
+    Vesc = Column(u.km/u.s, derived=True)
+    Vcirc = Column(u.km/u.s)
+
+    # --- SN kick and post-SN orbital properties
+    Vkx = Column(u.km/u.s)
+    Vky = Column(u.km/u.s)
+    Vkz = Column(u.km/u.s)
+    Vr = Column(u.km/u.s)
+    epost = Column(u.dimensionless_unscaled)
+    Vsx = Column(u.km/u.s)
+    Vsy = Column(u.km/u.s)
+    Vsz = Column(u.km/u.s)
+    tilt = Column(u.rad, derived=True)
+    Apost = Column(u.Rsun)
+    SNcheck1 = Column(dtype=bool)
+    SNcheck2 = Column(dtype=bool)
+    SNcheck3 = Column(dtype=bool)
+    SNcheck4 = Column(dtype=bool)
+
+    # --- post-SN velocity in the galactic frame
+    Vpx = Column(u.km/u.s)
+    Vpy = Column(u.km/u.s)
+    Vpz = Column(u.km/u.s)
+    Vpost = Column(u.km/u.s, derived=True)
+
+    # --- results of the integration
+    merger_redz = Column(u.dimensionless_unscaled, derived=True)
+    R_offset = Column(u.kpc, derived=True)
+    Rproj_offset = Column(u.kpc, derived=True)
+    X = Column(u.kpc, derived=True)
+    Y = Column(u.kpc, derived=True)
+    Z = Column(u.kpc, derived=True)
+    vX = Column(u.km/u.s, derived=True)
+    vY = Column(u.km/u.s, derived=True)
+    vZ = Column(u.km/u.s, derived=True)
+
+    def __init__(self, sampled_parameters, SNphi=None, SNtheta=None, SYSphi=None, SYStheta=None, sample_progenitor_props=False, float32=False):
+
+        self.Nsys = len(sampled_parameters['R'])
+        self.float32 = float32
+        self._columns = {}
+        # output file and columns that were written while evolving
+        self._streamed = (None, [])
+
+        self.R = sampled_parameters['R']
+        self.t0 = sampled_parameters['t0']
+        self.tbirth = sampled_parameters['tbirth']
+        self.zbirth = sampled_parameters['zbirth']
 
         # --- read in the sampled progenitor parameters specific to both sampling methods
         if sample_progenitor_props:
-            self.Mns = np.asarray(sampled_parameters['Mns'])*u.Msun
-            self.Mcomp = np.asarray(sampled_parameters['Mcomp'])*u.Msun
-            self.Mhe = np.asarray(sampled_parameters['Mhe'])*u.Msun
-            self.Apre = np.asarray(sampled_parameters['Apre'])*u.Rsun
-            self.epre = np.asarray(sampled_parameters['epre'])*u.dimensionless_unscaled
-            self.Vkick = np.asarray(sampled_parameters['Vkick'])*u.km/u.s
+            self.Mns = sampled_parameters['Mns']
+            self.Mcomp = sampled_parameters['Mcomp']
+            self.Mhe = sampled_parameters['Mhe']
+            self.Apre = sampled_parameters['Apre']
+            self.epre = sampled_parameters['epre']
+            self.Vkick = sampled_parameters['Vkick']
         else:
-            self.Vsys = np.asarray(sampled_parameters['Vsys'])*u.km/u.s
-            self.Tinsp = np.asarray(sampled_parameters['Tinsp'])*u.Gyr
-            self.SNsurvive = np.asarray(sampled_parameters['SNsurvive'])
+            self.Vsys = sampled_parameters['Vsys']
+            self.Tinsp = sampled_parameters['Tinsp']
+            self.SNsurvive = sampled_parameters['SNsurvive']
         
 
         #  --- initialize random angles (only need SN angles if implementing the SN)
@@ -72,6 +194,25 @@ class Systems:
         else: self.SYStheta = np.arccos(2*np.random.random(self.Nsys)-1)*u.rad
 
 
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        """Slices of at most chunk_size consecutive tracers, for processing the columns chunk-wise.
+        """
+        for start in range(0, self.Nsys, chunk_size):
+            yield slice(start, min(start+chunk_size, self.Nsys))
+
+
+    def columns(self, rows=slice(None)):
+        """Views (for a slice of rows) of the stored columns, as plain arrays in their declared units, in the order of COLUMNS.
+        """
+        return {name: self._columns[name][rows] for name in COLUMNS if name in self._columns}
+
+
+    def schema(self, names):
+        """Dtypes and units of the columns in names, as stored for these systems.
+        """
+        return {name: (getattr(Systems, name).store_dtype(self), str(getattr(Systems, name).unit or '')) for name in names}
+
+
     def escape_velocity(self, gal, interpolants):
         """
         Calculates the escape velocity for each particle at their respective radius.
@@ -79,25 +220,19 @@ class Systems:
 
         print('Calculating particle escape velocities...\n')
 
-        # Read in Rvals, assuming particles start in the plane
-        R_vals = self.R
-        z_vals = np.zeros_like(R_vals)
-
-        # specify radius and height at "infinity" in kpc
-        R_inf = 1000*u.kpc
-        z_inf = 1000*u.kpc
-
-        Vescs = []
-        for idx, (t0,R,z) in enumerate(zip(self.t0, R_vals, z_vals)):
+        # loop over the particles in order of birth timestep, so that lazily-provided interpolants are reused
+        Vescs = np.zeros(self.Nsys)
+        for idx in np.argsort(self.t0, kind='stable'):
+            t0 = self.t0[idx]
             if interpolants:
                 potential = interpolants[t0]
             else:
                 potential = gal.full_potentials[t0]
 
-            pot_at_inf = evaluatePotentials(potential, R_inf, z_inf).value
-            Vescs.append(np.sqrt(2*(pot_at_inf - evaluatePotentials(potential, R, z).value)))
+            # particles start in the plane
+            Vescs[idx] = calc_escape_velocity(potential, self.R[idx])
 
-        self.Vesc = np.asarray(Vescs)*u.km/u.s
+        self.Vesc = Vescs*u.km/u.s
         return
 
 
@@ -109,12 +244,10 @@ class Systems:
 
         print('Calculating the pre-SN galactic velocity...\n')
 
-        # --- Using galpy's vcirc method, we can easily calculate the rotation velocity at any R
-
-        R_vals = self.R
-
-        Vcircs = []
-        for idx, (t0,R) in enumerate(zip(self.t0, R_vals)):
+        # loop over the particles in order of birth timestep, so that lazily-provided interpolants are reused
+        Vcircs = np.zeros(self.Nsys)
+        for idx in np.argsort(self.t0, kind='stable'):
+            t0 = self.t0[idx]
             # if fixed_potential, we take the potential at the specified timestep only
             if fixed_potential:
                 t0_pot = fixed_potential
@@ -127,9 +260,9 @@ class Systems:
             else:
                 potential = gal.full_potentials[t0_pot]
 
-            Vcircs.append(vcirc(potential, R).value)
+            Vcircs[idx] = calc_circular_velocity(potential, self.R[idx])
 
-        self.Vcirc = np.asarray(Vcircs)*u.km/u.s
+        self.Vcirc = Vcircs*u.km/u.s
 
         
 
@@ -307,13 +440,11 @@ class Systems:
         print('Transforming systems into the galactic frame of reference...\n')
 
         # create Vsys array (Nsamples x Ndim)
-        Vsys_vec = np.transpose([self.Vsx,self.Vsy,self.Vsz])
-
-        # Rotate Vsys about the Z-axis by SYSphi
-        Vsys_vec = utils.euler_rot(Vsys_vec, np.asarray(self.SYSphi), axis='Z')
+        Vsys_vec = np.transpose([self.Vsx.value,self.Vsy.value,self.Vsz.value])
 
-        # Rotate Vsys about the Y-axis by SYStheta
-        Vsys_vec = utils.euler_rot(Vsys_vec, np.asarray(self.SYStheta), axis='Y')
+        # Rotate Vsys about the Z-axis by SYSphi, then about the Y-axis by SYStheta
+        rotations = utils.transforms.euler_matrix(np.transpose([self.SYSphi.value,self.SYStheta.value]), axes='ZY')
+        Vsys_vec = utils.transforms.rotate(Vsys_vec, rotations)
 
         # Save the velocity of the system immediately following the SN
         # Don't forget to add the pre-SN galactic velocity to the y-component!
@@ -339,14 +470,15 @@ class Systems:
 
         # Save the velocity of the system immediately following the SN
         # Don't forget to add the pre-SN galactic velocity to the y-component!
-        self.Vpx = self.Vsys*np.sin(self.SYStheta)*np.cos(self.SYSphi)
-        self.Vpy = self.Vsys*np.sin(self.SYStheta)*np.sin(self.SYSphi) + self.Vcirc
-        self.Vpz = self.Vsys*np.cos(self.SYStheta)
+        Vpx, Vpy, Vpz = utils.transforms.spherical_to_cartesian(self.Vsys.value, self.SYStheta.value, self.SYSphi.value)
+        self.Vpx = Vpx*u.km/u.s
+        self.Vpy = Vpy*u.km/u.s + self.Vcirc
+        self.Vpz = Vpz*u.km/u.s
         self.Vpost = np.linalg.norm(np.asarray([self.Vpx,self.Vpy,self.Vpz]), axis=0)
 
 
 
-    def evolve(self, gal, multiproc=None, int_method='odeint', Tint_max=120, resolution=1000, save_traj=False, downsample=None, outdir=None, fixed_potential=False, interpolants=None, label=None):
+    def evolve(self, gal, multiproc=None, int_method='odeint', Tint_max=120, resolution=1000, save_traj=False, downsample=None, outdir=None, fixed_potential=False, interpolants=None, label=None, pipeline=False, traj_tols=None, snapshot_times=None, elapsed_times=None, aggregates=None, store_tracers=True, nsightlines=None, stratify_sightlines=False):
         """
         Evolves the tracer particles using galpy's 'Evolve' method
         Does for each bound systems until one of two conditions are met:
@@ -355,60 +487,143 @@ class Systems:
 
         Each system will evolve through a series of galactic potentials specified in distinct redshift bins in the 'gal' class
 
+        If save_traj==True, the trajectories are saved to the output file quantized to the tolerances traj_tols (see tracer_storage.trajectory_tolerances), and can be read with tracer_storage.read_trajectories.
+
+        If snapshot_times (cosmic times, in Gyr) are specified, the positions and velocities of every tracer are also recorded at these times, which are shared by all tracers, and saved to the output file time-major. The tracers at any of these times can then be read at once with tracer_storage.read_snapshot.
+
+        If elapsed_times (times since the birth of each tracer, in Gyr, e.g. tracer_storage.elapsed_grid()) are specified, the positions and velocities of every tracer are recorded at these times after its birth in the same way. The offsets after any other elapsed time, such as a resampled inspiral time, can then be interpolated with tracer_storage.read_elapsed_offsets.
+
+        If outdir is specified, the columns calculated so far are written to the output file (see write) before the integration, and the results of the integration as each tracer finishes, so that they are saved as the run progresses.
+
+        If aggregates (an aggregates.TracerAggregates) are specified, they are updated with the results of the tracers in blocks as they finish, and with the tracers that escaped (Vpost > Vesc) at the end, and written to the output file. If store_tracers==False, the results of each tracer are then not stored, in the Systems class or the output file, so that very large runs only keep the aggregates.
+
+        If nsightlines is specified, the final position of each tracer is also projected along this many random isotropic sightlines (stratified over the sphere about the tracer if stratify_sightlines==True, see utils.isotropic_sightlines), since the projection is cheap compared to the integration. The projected offsets are written to the output file (see tracer_storage.read_projections), and all of them are added to the aggregates, so that the distribution of projected offsets converges with fewer tracers.
+
+        If pipeline==True, 'interpolants' must be an InterpolantProvider. The interpolants are then built on the same pool of workers as the integrations, latest timesteps first, and each tracer is integrated as soon as the interpolants it needs exist. The escape and pre-SN galactic velocities are calculated by the workers as well, so escape_velocity() and galactic_velocity() should not be called beforehand; the pre-SN galactic velocity is added to Vpy here.
+
         Note that all units are cgs unless otherwise specified, and galpy is initialized to take in astropy units
         """
         print('Evolving orbits of the tracer particles...\n')
 
-        # --- set up arrays/lists of arrays for storing output
-        merger_redzs = []
-        R_offsets = []
-        Rproj_offsets = []
-        Xs = []
-        Ys = []
-        Zs = []
-        vXs = []
-        vYs = []
-        vZs = []
-
+        if (not store_tracers) and (aggregates is None):
+            raise ValueError('The results of the tracers must either be stored or aggregated!')
 
         # --- get the pertinent data for the evolution function
+        t0, SNsurvive, Tinsp, R, Vpx, Vpy, Vpz = self.t0, self.SNsurvive, self.Tinsp, self.R, self.Vpx, self.Vpy, self.Vpz
         systems_info = []
         for idx in np.arange(self.Nsys):
-            systems_info.append([idx,self.t0[idx],self.SNsurvive[idx],self.Tinsp[idx],self.R[idx],self.Vpx[idx],self.Vpy[idx],self.Vpz[idx]])
+            systems_info.append([idx,t0[idx],SNsurvive[idx],Tinsp[idx],R[idx],Vpx[idx],Vpy[idx],Vpz[idx]])
 
 
         # --- initialize integrate_orbits function
-        func = partial(integrate_orbits, gal=gal, int_method=int_method, Tint_max=Tint_max, resolution=resolution, save_traj=save_traj, downsample=downsample, outdir=outdir, fixed_potential=fixed_potential, interpolants=interpolants)
-
-
-        # --- if save_traj==True, write the temporary trajectories directory
-        if save_traj:
-            columns = ['idx','X','Y','Z','vX','vY','vZ','R_offset','Rproj_offset','time']
-            trajectories = pd.DataFrame(columns=columns)
-            trajectories.to_csv(outdir+'/trajectories.tmp', index=False)
+        if save_traj and (traj_tols is None):
+            traj_tols = tracer_storage.trajectory_tolerances()
+        if snapshot_times is not None:
+            snapshot_times = np.asarray(u.Quantity(snapshot_times, u.Gyr).value, dtype=float)
+            if np.any(np.diff(snapshot_times) <= 0):
+                raise ValueError('Snapshot times must be strictly increasing!')
+        if elapsed_times is not None:
+            elapsed_times = np.asarray(u.Quantity(elapsed_times, u.Gyr).value, dtype=float)
+            if np.any(np.diff(elapsed_times) <= 0):
+                raise ValueError('Elapsed snapshot times must be strictly increasing!')
+        func = partial(integrate_orbits, gal=gal, int_method=int_method, Tint_max=Tint_max, resolution=resolution, save_traj=save_traj, downsample=downsample, outdir=outdir, fixed_potential=fixed_potential, interpolants=interpolants, defer_merger_redz=True, traj_tols=traj_tols, snapshot_times=snapshot_times, elapsed_times=elapsed_times)
+
+
+        # --- write the columns calculated so far, and create the columns for the results of the integration
+        writer = None
+        if outdir:
+            savepath = output_path(outdir, label)
+            writer = tracer_storage.TracerWriter(savepath, self.Nsys)
+            columns = self.columns()
+            schema = self.schema(columns)
+            for name, values in columns.items():
+                writer.write_column(name, values, schema[name][1], CHUNK_SIZE)
+            if store_tracers:
+                writer.create_columns(self.schema(STREAMED_COLUMNS))
+                self._streamed = (savepath, STREAMED_COLUMNS)
+            else:
+                self._streamed = (savepath, [])
+
+        # --- projected offsets of final positions along random sightlines
+        def project(positions):
+            return utils.projected_offset_samples(positions, utils.isotropic_sightlines((len(positions), nsightlines), stratify_sightlines, poles=positions))
+
+        # --- results waiting to be added to the aggregates, which are added in blocks
+        block = []
+        def aggregate():
+            idxs = np.asarray([idx for idx, result in block], dtype=int)
+            values = np.asarray([result for idx, result in block], dtype=float)
+            Rproj_offset, merger_redz = values[:, RESULT_COLUMNS.index('Rproj_offset')], values[:, RESULT_COLUMNS.index('merger_redz')]
+            merged = np.isinf(merger_redz)
+            merger_redz[merged] = merger_redshifts(gal, t0[idxs][merged], Tinsp[idxs][merged])
+            if nsightlines:
+                Rproj_offset = project(values[:, [RESULT_COLUMNS.index(name) for name in ['X','Y','Z']]])
+            aggregates.add(t0[idxs], self.Vsys[idxs].value, Rproj_offset, merger_redz)
+            block.clear()
+
+        def stream(idx, result):
+            if writer and store_tracers:
+                writer.add_row(idx, dict(zip(STREAMED_COLUMNS, result)))
+            if aggregates is not None:
+                block.append((idx, result))
+                if len(block) >= tracer_storage.BUFFER_ROWS:
+                    aggregate()
+
+
+        # --- remove any temporary trajectory or snapshot files left by a previous run
+        if save_traj or (snapshot_times is not None) or (elapsed_times is not None):
+            for kind in ['trajectories'] + list(tracer_storage.SNAP_KINDS):
+                for tmp_path in tracer_storage.tmp_paths(outdir, kind):
+                    os.remove(tmp_path)
 
 
 
         # --- CALL THE INTEGRATION FUNCTION AND EVOLVE --- #
 
-        # --- enable multiprocessing, if specifed
+        # --- determine the number of cores, if multiprocessing is specified
         if multiproc:
             if multiproc=='max':
                 mp = multiprocessing.cpu_count()
             else:
                 mp = int(multiproc)
 
+        # --- build interpolants and integrate on the same workers
+        if pipeline:
+            if not isinstance(interpolants, InterpolantProvider):
+                raise ValueError('Pipelined evolution requires interpolants to be built on demand by an InterpolantProvider!')
+
+            start = time.time()
+            if multiproc:
+                print('Pipelining the interpolation and integration over {0:d} cores...'.format(mp))
+            else:
+                print('Performing the interpolations and integrations in serial...')
+                mp = None
+            results, Vcircs, Vescs = pipeline_orbits(systems_info, func, interpolants, mp, fixed_potential, on_result=stream, keep_results=store_tracers)
+            stop = time.time()
+            print('Finished! It took {0:0.2f}s\n'.format(stop-start))
+
+            # the pre-SN galactic velocity was not known when the post-SN velocities were calculated
+            self.Vesc = Vescs*u.km/u.s
+            self.Vcirc = Vcircs*u.km/u.s
+            self.Vpy = self.Vpy + self.Vcirc
+            self.Vpost = np.linalg.norm(np.asarray([self.Vpx.value,self.Vpy.value,self.Vpz.value]), axis=0)*u.km/u.s
+
+        # --- enable multiprocessing, if specifed
+        elif multiproc:
             # initialize the parallelization, and specify function arguments
             pool = multiprocessing.Pool(mp)
 
             start = time.time()
             print('Parallelizing integration of the orbits over {0:d} cores...'.format(mp))
-            results = pool.map(func, systems_info)
+            # chunked like pool.map, but the results are streamed as they arrive
+            chunksize = int(np.ceil(len(systems_info) / (4.*mp))) if systems_info else 1
+            results = []
+            for system, result in zip(systems_info, pool.imap(func, systems_info, chunksize)):
+                stream(system[0], result)
+                if store_tracers:
+                    results.append(result)
             pool.close()
             pool.join()
-
-            results = np.transpose(results)
-            Xs,Ys,Zs,vXs,vYs,vZs,R_offsets,Rproj_offsets,merger_redzs = results[0],results[1],results[2],results[3],results[4],results[5],results[6],results[7],results[8]
             stop = time.time()
             print('Finished! It took {0:0.2f}s\n'.format(stop-start))
 
@@ -418,45 +633,56 @@ class Systems:
             start = time.time()
             print('Performing the integrations in serial...')
 
+            results = []
             for system in systems_info:
 
-                X,Y,Z,vX,vY,vZ,R_offset,Rproj_offset,merger_redz = func(system)
-
-                Xs.append(X)
-                Ys.append(Y)
-                Zs.append(Z)
-                vXs.append(vX)
-                vYs.append(vY)
-                vZs.append(vZ)
-                R_offsets.append(R_offset)
-                Rproj_offsets.append(Rproj_offset)
-                merger_redzs.append(merger_redz)
+                result = func(system)
+                stream(system[0], result)
+                if store_tracers:
+                    results.append(result)
 
             stop = time.time()
             print('Finished! It took {0:0.2f}s\n'.format(stop-start))
 
 
+        if writer:
+            writer.close()
+
         # --- Now that everything is finished, store in the systems class and write trajectory files
-        self.merger_redz = np.asarray(merger_redzs)*u.dimensionless_unscaled
-        self.R_offset = np.asarray(R_offsets)*u.kpc
-        self.Rproj_offset = np.asarray(Rproj_offsets)*u.kpc
-        self.X = np.asarray(Xs)*u.kpc
-        self.Y = np.asarray(Ys)*u.kpc
-        self.Z = np.asarray(Zs)*u.kpc
-        self.vX = np.asarray(vXs)*u.km/u.s
-        self.vY = np.asarray(vYs)*u.km/u.s
-        self.vZ = np.asarray(vZs)*u.km/u.s
+        if store_tracers:
+            results = np.transpose(results)
+            for name, values in zip(RESULT_COLUMNS, results):
+                setattr(self, name, values)
+            # calculate the merger redshifts of all merging tracers at once, rather than in each worker
+            merger_redzs = self._columns['merger_redz']
+            merged = np.isinf(merger_redzs)
+            merger_redzs[merged] = merger_redshifts(gal, self.t0[merged], self.Tinsp[merged])
+
+            if nsightlines and outdir:
+                Rproj_samples = np.zeros((self.Nsys, nsightlines), dtype=np.float32)
+                for rows in self.chunks(CHUNK_SIZE):
+                    Rproj_samples[rows] = project(np.transpose([self.X[rows].value, self.Y[rows].value, self.Z[rows].value]))
+                tracer_storage.write_projections(output_path(outdir, label), Rproj_samples, stratify_sightlines)
+
+        # --- add the remaining tracers and those that escaped to the aggregates, and save them
+        if aggregates is not None:
+            if block:
+                aggregate()
+            aggregates.add_escaped(t0, self.Vsys.value, self.Vpost > self.Vesc)
+            if outdir:
+                aggregates.write(output_path(outdir, label))
 
         # combine the trajectories into a single hdf5 file, if save_traj==True
-        print('Combining trajectory files into single hdf5 file...\n')
         if save_traj==True:
-            if label:
-                savepath = outdir+'/'+label+'.hdf'
-            else:
-                savepath = outdir+'/output.hdf'
-            trajectories = pd.read_csv(outdir+'/trajectories.tmp', index_col='idx')
-            trajectories.to_hdf(savepath, key='trajectories')
-            os.remove(outdir+'/trajectories.tmp')
+            if VERBOSE:
+                print('Combining trajectory files into single hdf5 file...\n')
+            tracer_storage.combine_trajectories(output_path(outdir, label), outdir, traj_tols)
+        if snapshot_times is not None:
+            print('Combining snapshots into single hdf5 file...\n')
+            tracer_storage.combine_snapshots(output_path(outdir, label), outdir, snapshot_times, self.Nsys)
+        if elapsed_times is not None:
+            print('Combining elapsed-time snapshots into single hdf5 file...\n')
+            tracer_storage.combine_snapshots(output_path(outdir, label), outdir, elapsed_times, self.Nsys, kind='elapsed')
 
         return
 
@@ -465,6 +691,8 @@ class Systems:
 
     def write(self, gal, outdir, label=None):
         """Write tracer data as hdf file to specified outpath.
+
+        The columns are stored as compressed, chunked datasets in the 'tracers' group of the file (see tracer_storage), written CHUNK_SIZE tracers at a time. Columns that were already written to the same file while evolving are not written again. Use tracer_storage.read_tracers to read the data, or only some of its columns.
         """
 
         print("Writing tracer data in directory {0:s}...\n".format(outdir))
@@ -472,31 +700,202 @@ class Systems:
         # --- write the inspiral time as the time difference between tbirth and tsGRB
         self.Tinsp = gal.times[-1] - self.tbirth
 
-        tracers = pd.DataFrame()
-        for attr, values in self.__dict__.items():
-            if attr not in ['Nsys']:
-                tracers[attr] = values
-        tracers.index.name = 'idx'
-
-        if label:
-            savepath = outdir+'/'+label+'.hdf'
+        savepath = output_path(outdir, label)
+        streamed_path, streamed = self._streamed
+        if streamed_path == savepath:
+            writer = tracer_storage.TracerWriter(savepath, self.Nsys, mode='a')
         else:
-            savepath = outdir+'/output.hdf'
-        tracers.to_hdf(savepath, key='tracers', mode='a')
+            writer = tracer_storage.TracerWriter(savepath, self.Nsys, mode='w')
+            streamed = []
+
+        columns = self.columns()
+        schema = self.schema(columns)
+        for name, values in columns.items():
+            if name not in streamed:
+                writer.write_column(name, values, schema[name][1], CHUNK_SIZE)
+        writer.close(complete=True)
 
         return
 
 
 
+# Names of the per-tracer columns of the Systems class, in the order they are written
+COLUMNS = [name for name, attr in vars(Systems).items() if isinstance(attr, Column)]
 
 
 
-def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1000, save_traj=False, downsample=None, outdir=None, fixed_potential=False, interpolants=None):
+def output_path(outdir, label=None):
+    """Path of the output file for the tracers, named after the label of the run.
+    """
+    if label:
+        return outdir+'/'+label+'.hdf'
+    return outdir+'/output.hdf'
+
+
+
+
+
+
+def calc_escape_velocity(potential, R, z=0*u.kpc, R_inf=1000*u.kpc, z_inf=1000*u.kpc):
+    """Escape velocity (in km/s) at (R,z), taking (R_inf,z_inf) as "infinity".
+    """
+    pot_at_inf = evaluatePotentials(potential, R_inf, z_inf).value
+    return np.sqrt(2*(pot_at_inf - evaluatePotentials(potential, R, z).value))
+
+
+def calc_circular_velocity(potential, R):
+    """Circular velocity (in km/s) at R, using galpy's vcirc method.
+    """
+    return vcirc(potential, R).value
+
+
+
+
+# Worker state for pipelined evolution, set once per process by the pool initializer so that the galaxy and interpolants are not pickled with every task
+_PIPELINE = {}
+
+def _init_pipeline(func, provider, fixed_potential):
+    _PIPELINE['func'] = func
+    _PIPELINE['provider'] = provider
+    _PIPELINE['fixed_potential'] = fixed_potential
+
+
+def _pipeline_interp(step):
+    _PIPELINE['provider'].build(step)
+    return step
+
+
+def _pipeline_tracer(system):
+    """Calculates the escape and pre-SN galactic velocities of a tracer, adds the latter to its post-SN velocity, and integrates its orbit.
+    """
+    provider, fixed_potential = _PIPELINE['provider'], _PIPELINE['fixed_potential']
+    idx, t0, R = system[0], system[1], system[4]
+
+    Vesc = calc_escape_velocity(provider[t0], R)
+    Vcirc = calc_circular_velocity(provider[fixed_potential if fixed_potential else t0], R)
+
+    system = list(system)
+    system[6] = system[6] + Vcirc*u.km/u.s
+    return idx, _PIPELINE['func'](system), Vcirc, Vesc
+
+
+def pipeline_steps(t0, nsteps, fixed_potential=None):
+    """Timesteps whose interpolants a tracer born at t0 needs, both for its birth velocities and its integration.
+    """
+    if fixed_potential:
+        return {t0, fixed_potential}
+    return set(range(t0, max(t0+1, nsteps-1)))
+
+
+def pipeline_orbits(systems_info, func, provider, mp=None, fixed_potential=None, on_result=None, keep_results=True):
+    """Builds the interpolants needed by the tracers and integrates their orbits on a shared pool of 'mp' workers.
+
+    Interpolants are built latest timestep first. Tracers are integrated, latest birth first, once all interpolants they need exist. While tracers are waiting, at most half the workers are kept busy building interpolants, so the integrations overlap with the remaining interpolation.
+
+    If specified, on_result(idx, result) is called with the integration result of each tracer as it finishes. If keep_results==False, the results are only passed to on_result, and not returned.
+
+    Returns the integration results (if keep_results==True, otherwise an empty list), circular velocities, and escape velocities of the tracers, in the order of systems_info.
+    """
+    nsteps = len(provider)
+
+    # --- interpolants to build, and the lowest timestep each tracer needs
+    needed = set()
+    tracer_min = {}
+    for system in systems_info:
+        # timesteps sharing a coarsened potential epoch share an interpolant
+        steps = set(provider.epoch(step) for step in pipeline_steps(system[1], nsteps, fixed_potential))
+        needed |= steps
+        tracer_min[system[0]] = min(steps)
+    built = set(step for step in needed if provider.exists(step))
+    interp_queue = sorted(needed - built, reverse=True)
+    tracer_queue = sorted(systems_info, key=lambda system: tracer_min[system[0]], reverse=True)
+    if VERBOSE:
+        print('  {0:d} of {1:d} interpolants already exist...'.format(len(built), len(needed)))
+
+    # a tracer can start once every needed interpolant at or above its lowest timestep exists
+    def frontier():
+        pending = needed - built
+        return (max(pending)+1) if pending else -np.inf
+
+    results, Vcircs, Vescs = {}, np.zeros(len(systems_info)), np.zeros(len(systems_info))
+    def store(out):
+        idx, result, Vcirc, Vesc = out
+        if keep_results:
+            results[idx] = result
+        if on_result:
+            on_result(idx, result)
+        Vcircs[idx], Vescs[idx] = Vcirc, Vesc
+
+    # --- serial: alternate between interpolations and the tracers they free up
+    if not mp:
+        _init_pipeline(func, provider, fixed_potential)
+        while tracer_queue:
+            if tracer_min[tracer_queue[0][0]] >= frontier():
+                store(_pipeline_tracer(tracer_queue.pop(0)))
+            else:
+                built.add(_pipeline_interp(interp_queue.pop(0)))
+        return ([results[system[0]] for system in systems_info] if keep_results else []), Vcircs, Vescs
+
+    # --- parallel: keep every worker busy, without queueing tasks behind each other in the pool
+    pool = multiprocessing.Pool(mp, initializer=_init_pipeline, initargs=(func, provider, fixed_potential))
+    done = queue.Queue()
+    n_interp, n_tracer = 0, 0
+    try:
+        while tracer_queue or n_interp or n_tracer:
+            tracer_ready = bool(tracer_queue) and (tracer_min[tracer_queue[0][0]] >= frontier())
+            while (n_interp+n_tracer) < mp:
+                if tracer_ready and ((n_interp >= max(1, mp//2)) or not interp_queue):
+                    pool.apply_async(_pipeline_tracer, (tracer_queue.pop(0),), callback=lambda out: done.put(('tracer', out)), error_callback=lambda err: done.put(('error', err)))
+                    n_tracer += 1
+                elif interp_queue:
+                    pool.apply_async(_pipeline_interp, (interp_queue.pop(0),), callback=lambda out: done.put(('interp', out)), error_callback=lambda err: done.put(('error', err)))
+                    n_interp += 1
+                else:
+                    break
+                tracer_ready = bool(tracer_queue) and (tracer_min[tracer_queue[0][0]] >= frontier())
+
+            kind, out = done.get()
+            if kind == 'error':
+                raise out
+            elif kind == 'interp':
+                built.add(out)
+                n_interp -= 1
+            else:
+                store(out)
+                n_tracer -= 1
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return ([results[system[0]] for system in systems_info] if keep_results else []), Vcircs, Vescs
+
+
+
+
+def merger_redshifts(gal, t0, Tinsp):
+    """Redshifts at which tracers born at the timesteps t0 of the gal class merge, given their inspiral times Tinsp.
+    """
+    ages = gal.times[np.asarray(t0, dtype=int)] + Tinsp
+    return gal.cosmo.tage_to_z(ages.to(u.s).value)
+
+
+
+def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1000, save_traj=False, downsample=None, outdir=None, fixed_potential=False, interpolants=None, defer_merger_redz=False, traj_tols=None, snapshot_times=None, elapsed_times=None):
     """Function for integrating orbits. 
     
     Tint_max will end integration if t_int > Tint_max.
 
-    If save_traj == True, will save the full trajectory information rather than just the last step. If downsample is also specified, will save only every Nth line in the trajectories dataframe.
+    The projected offsets are calculated along a single random sightline per tracer.
+
+    If save_traj == True, will save the full trajectory information rather than just the last step, to a temporary file in outdir (see tracer_storage.append_tmp). The trajectory is quantized to the tolerances traj_tols (default tracer_storage.trajectory_tolerances()). If downsample is also specified, will save only every Nth step of the trajectory.
+
+    If snapshot_times (cosmic times in Gyr) are specified, the trajectory is interpolated to the snapshot times it covers, which are saved to a temporary file in outdir as well (see tracer_storage.sample_snapshots). The same is done for elapsed_times, the times since birth (in Gyr) at which to record the tracer.
+
+    If the potential time grid of the gal class was coarsened (gal.potential_epochs), consecutive timesteps in the same epoch are integrated as a single segment in the potential of the epoch, with the resolution scaled by the number of timesteps in the segment.
+
+    If defer_merger_redz == True, the merger redshift of a tracer that merges is returned as np.inf, so that the redshifts of all tracers can be calculated at once afterwards (see merger_redshifts).
     """
 
     start_time = time.time()
@@ -504,9 +903,13 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
     # NaN values to initialize positions
     X,Y,Z,vX,vY,vZ,R_offset,Rproj_offset = np.nan,np.nan,np.nan,np.nan,np.nan,np.nan,np.nan,np.nan
 
-    # Lists for storing trajectories, if save_traj==True
-    if save_traj:
-        X_traj,Y_traj,Z_traj,vX_traj,vY_traj,vZ_traj,R_offset_traj,Rproj_offset_traj,time_traj = [],[],[],[],[],[],[],[],[]
+    # Lists for storing trajectories, if save_traj==True or snapshots are recorded
+    record_traj = save_traj or (snapshot_times is not None) or (elapsed_times is not None)
+    if record_traj:
+        X_traj,Y_traj,Z_traj,vX_traj,vY_traj,vZ_traj,time_traj = [],[],[],[],[],[],[]
+
+    # Euler angles of the sightline for the projected offsets
+    sightline = 2*np.pi*np.random.random(3)
 
     # system info
     idx = system[0]
@@ -525,6 +928,7 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
         potentials = interpolants
     else:
         potentials = gal.full_potentials
+    epochs = getattr(gal, 'potential_epochs', None)
     
     # initialize cosmology
     cosmo = gal.cosmo
@@ -552,9 +956,18 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
             # --- if potential is held fixed, write down the timestep of the potential being used
             if fixed_potential:
                 tt_pot = fixed_potential
+            elif epochs is not None:
+                tt_pot = epochs[tt]
             else:
                 tt_pot = tt
 
+            # --- integrate through the end of the potential epoch, if the time grid was coarsened
+            tt_next = tt+1
+            if (epochs is not None) and (not fixed_potential):
+                while (tt_next < len(times)-1) and (epochs[tt_next] == epochs[tt]):
+                    tt_next += 1
+            nres = resolution*(tt_next-tt)
+
             # --- for the first step, transform the post-SN systemic velocity into cylindrical coordinates
             if tt==t0:
                 # by construction, the systems start in the galactic plane, at x=R, y=0, and therefore phi=0 (note that galpy's orbit integrator takes in vT = R*vPhi)
@@ -573,7 +986,7 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
     
 
             # record the amount of time that passes in this step
-            dt = times[tt+1]-times[tt]
+            dt = times[tt_next]-times[tt]
 
 
             # --- See if the merger occurred during this step --- #
@@ -582,8 +995,8 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
                 # adjust dt to when it merged
                 dt = Tinsp - T_elapsed
 
-                # get timesteps for this integration (set to 1000 steps for now)
-                ts = np.linspace(0*u.Gyr,dt,resolution)
+                # get timesteps for this integration
+                ts = np.linspace(0*u.Gyr,dt,nres)
 
                 # initialize the orbit and integrate, store redshift of merger
                 orb = Orbit(vxvv=[R, vR, vT, Z, vZ, Phi])
@@ -596,12 +1009,15 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
                     return 0,0,0,0,0,0,0,0,0
 
                 age = times[t0]+Tinsp
-                merger_redz = float(cosmo.tage_to_z(age.to(u.s)))
+                if defer_merger_redz:
+                    merger_redz = np.inf
+                else:
+                    merger_redz = float(cosmo.tage_to_z(age.to(u.s).value))
 
                 stop_time = time.time()
 
                 if VERBOSE:
-                    print('  Tracer {0:d}:\n    merger occurred at z={1:0.2f}...integration took {2:0.2f}s'.format(idx, merger_redz, (stop_time-start_time)))
+                    print('  Tracer {0:d}:\n    merger occurred at {1:0.2f} after the Big Bang...integration took {2:0.2f}s'.format(idx, age.to(u.Gyr), (stop_time-start_time)))
                 FINISHED_EVOLVING = True
                 break
 
@@ -609,7 +1025,7 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
             # --- If it didn't merge, evolve until the next timestep --- #
 
             # get timesteps for this integration
-            ts = np.linspace(0*u.Gyr,dt,resolution)
+            ts = np.linspace(0*u.Gyr,dt,nres)
 
             # initialize the orbit and integrate
             orb = Orbit(vxvv=[R, vR, vT, Z, vZ, Phi])
@@ -626,8 +1042,8 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
             # --- Checks to see if integration should be terminated --- #
 
             # if it evolved until the time of the sGRB, end the integration
-            if tt == (len(times)-2):
-                time_evolved = times[(tt+1)]-times[t0]
+            if tt_next == (len(times)-1):
+                time_evolved = times[tt_next]-times[t0]
 
                 stop_time = time.time()
 
@@ -643,7 +1059,7 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
 
             # if integration time surpasses Tint_max, end
             if (time.time()-start_time) > Tint_max:
-                time_evolved = times[(tt+1)]-times[t0]
+                time_evolved = times[tt_next]-times[t0]
 
                 # set merger_redz to -1 to indicate that integration time has surpassed
                 merger_redz = -1
@@ -659,19 +1075,11 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
             # --- track the amount of elapsed time
             T_elapsed += dt
 
-            # --- append orbit information at this step, if save_traj==True
-            if save_traj:
+            # --- append orbit information at this step, if save_traj==True or snapshots are recorded
+            if record_traj:
                 # transform orbital information back to physical units and calculate offsets
-                X,Y,Z,vX,vY,vZ,R_offset,Rproj_offset = transform_orbits(copy.deepcopy(orb))
-                X = X.value
-                Y = Y.value
-                Z = Z.value
-                vX = vX.value
-                vY = vY.value
-                vZ = vZ.value
-                R_offset = R_offset.value
-                Rproj_offset = Rproj_offset.value
-                time_vals = (times[t0]+ts+T_elapsed).value
+                X,Y,Z,vX,vY,vZ,R_offset,Rproj_offset = transform_orbits(orb, sightline)
+                time_vals = (times[t0]+(T_elapsed-dt)+ts).value
 
                 X_traj.append(X)
                 Y_traj.append(Y)
@@ -679,12 +1087,10 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
                 vX_traj.append(vX)
                 vY_traj.append(vY)
                 vZ_traj.append(vZ)
-                R_offset_traj.append(R_offset)
-                Rproj_offset_traj.append(Rproj_offset)
                 time_traj.append(time_vals)
 
 
-            tt += 1
+            tt = tt_next
 
 
     # --- Once the system has either merged, integrated until the time of the sGRB, or hit wall time, record final trajectory information
@@ -692,53 +1098,39 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
     # --- track the amount of elapsed time
     T_elapsed += dt
 
-    X,Y,Z,vX,vY,vZ,R_offset,Rproj_offset = transform_orbits(copy.deepcopy(orb))
-    X = X.value
-    Y = Y.value
-    Z = Z.value
-    vX = vX.value
-    vY = vY.value
-    vZ = vZ.value
-    R_offset = R_offset.value
-    Rproj_offset = Rproj_offset.value
-    time_vals = (times[t0]+ts+T_elapsed).value
+    X,Y,Z,vX,vY,vZ,R_offset,Rproj_offset = transform_orbits(orb, sightline)
+    time_vals = (times[t0]+(T_elapsed-dt)+ts).value
 
     if VERBOSE:
         print('    final offset: {0:0.2f} (proj: {1:0.2f})\n'.format(R_offset[-1], Rproj_offset[-1]))
 
-    # append orbit information at this step, if save_traj==True
-    if save_traj:
+    # append orbit information at this step, if save_traj==True or snapshots are recorded
+    if record_traj:
         X_traj.append(X)
         Y_traj.append(Y)
         Z_traj.append(Z)
         vX_traj.append(vX)
         vY_traj.append(vY)
         vZ_traj.append(vZ)
-        R_offset_traj.append(R_offset)
-        Rproj_offset_traj.append(Rproj_offset)
         time_traj.append(time_vals)
 
-        # flatten and save trajectories
-        trajectories = pd.DataFrame()
-        trajectories['X'] = [item for sublist in X_traj for item in sublist]
-        trajectories['Y'] = [item for sublist in Y_traj for item in sublist]
-        trajectories['Z'] = [item for sublist in Z_traj for item in sublist]
-        trajectories['vX'] = [item for sublist in vX_traj for item in sublist]
-        trajectories['vY'] = [item for sublist in vY_traj for item in sublist]
-        trajectories['vZ'] = [item for sublist in vZ_traj for item in sublist]
-        trajectories['R_offset'] = [item for sublist in R_offset_traj for item in sublist]
-        trajectories['Rproj_offset'] = [item for sublist in Rproj_offset_traj for item in sublist]
-        trajectories['time'] = [item for sublist in time_traj for item in sublist]
-        trajectories['idx'] = idx
-        trajectories.set_index('idx', inplace=True)
-
+        trajectory = {name: np.concatenate(traj) for name, traj in zip(tracer_storage.TRAJ_COLUMNS, [time_traj,X_traj,Y_traj,Z_traj,vX_traj,vY_traj,vZ_traj])}
 
-        # if downsample is specified, apply here
-        if downsample:
-            trajectories = trajectories.iloc[::downsample, :]
+        # save each snapshot and trajectory separately, then combine at the end
+        if snapshot_times is not None:
+            first, values = tracer_storage.sample_snapshots(trajectory, snapshot_times)
+            tracer_storage.append_tmp(outdir, 'snapshots', [idx, first], sightline, values)
+        if elapsed_times is not None:
+            first, values = tracer_storage.sample_snapshots(trajectory, times[t0].to(u.Gyr).value + elapsed_times)
+            tracer_storage.append_tmp(outdir, 'elapsed', [idx, first], sightline, values)
 
-        # save each trajectory separately, then combine at the end
-        trajectories.to_csv(outdir+'/trajectories.tmp', index=True, header=False, mode='a')
+        if save_traj:
+            # downsample the trajectory, if specified
+            step = downsample if downsample else 1
+            trajectory = {name: vals[::step] for name, vals in trajectory.items()}
+            if traj_tols is None:
+                traj_tols = tracer_storage.trajectory_tolerances()
+            tracer_storage.append_tmp(outdir, 'trajectories', [idx], sightline, tracer_storage.encode_trajectory(trajectory, traj_tols))
 
     # return the final values
     return X[-1],Y[-1],Z[-1],vX[-1],vY[-1],vZ[-1],R_offset[-1],Rproj_offset[-1],merger_redz
@@ -746,35 +1138,28 @@ def integrate_orbits(system, gal, int_method='odeint', Tint_max=60, resolution=1
 
 
 
-def transform_orbits(orb):
+def transform_orbits(orb, sightline=None):
     """Takes in orbit, transforms to cartesian (physical units), and calculates offsets/projected offsets.
 
-    By default, just returns the final values in cartesian coordinates, as well as the offset and projected offset. 
+    By default, just returns the final values in cartesian coordinates, as well as the offset and projected offset, as plain arrays in kpc and km/s. The projected offsets are for an observer along the Euler angles of sightline (see utils.projected_offsets), which are random if not specified.
     """
     # NOTE: galpy's getOrbit() spits things out in natural units no matter what you input!!!
+    Rs, vRs, vTs, Zs, vZs, Phis = orb.getOrbit().T
 
-    Rs = orb.getOrbit()[:,0]
-    vRs = orb.getOrbit()[:,1]
-    vTs = orb.getOrbit()[:,2]
-    Zs = orb.getOrbit()[:,3]
-    vZs = orb.getOrbit()[:,4]
-    Phis = orb.getOrbit()[:,5]
-
-    # convert from natural to cgs units (must be deep copy or else it changes the original orbit's instance as well)
-    Rs, vRs, vTs, Zs, vZs, Phis = utils.orbit_nat_to_phys(Rs, vRs, vTs, Zs, vZs, Phis)
-    vPhis = vTs / (Rs.to(u.km))
+    # convert from natural to physical units (new arrays, so the orbit itself is not modified)
+    Rs, Zs = Rs*GALPY_RO, Zs*GALPY_RO
+    vRs, vTs, vZs = vRs*GALPY_VO, vTs*GALPY_VO, vZs*GALPY_VO
+    Phis = Phis % (2*np.pi)
     R_offsets = np.sqrt(Rs**2 + Zs**2)
 
     # get positions and velocities in Cartesian coordinates
-    Xs,Ys,Zs,vXs,vYs,vZs = utils.cylindrical_to_cartesian(Rs, Phis, Zs, vRs, vPhis, vZs)
-
-    # randomly rotate the vectors by Euler rotations to get a mock projected offset, assuming observer is in z-hat direction
-    vecs = np.transpose([Xs,Ys,Zs])   # (Nsamples x Ndim)
-    rot_vecs = utils.euler_rot(vecs, np.ones(len(vecs))*(2*np.pi*np.random.random()), axis='X')
-    rot_vecs = utils.euler_rot(rot_vecs, np.ones(len(vecs))*(2*np.pi*np.random.random()), axis='Y')
-    rot_vecs = utils.euler_rot(rot_vecs, np.ones(len(vecs))*(2*np.pi*np.random.random()), axis='Z')
+    Xs,Ys,Zs,vXs,vYs,vZs = utils.transforms.cylindrical_to_cartesian(Rs, Phis, Zs, vRs, vTs, vZs)
 
-    Rproj_offsets = np.sqrt(rot_vecs[:,0]**2 + rot_vecs[:,1]**2) * u.kpc
+    # rotate the vectors by Euler rotations to get a mock projected offset, assuming observer is in z-hat direction
+    if sightline is None:
+        sightline = 2*np.pi*np.random.random(3)
+    vecs = np.stack([Xs,Ys,Zs], axis=-1)   # (Nsamples x Ndim)
+    Rproj_offsets = utils.projected_offsets(vecs, sightline)
 
     return Xs,Ys,Zs,vXs,vYs,vZs,R_offsets,Rproj_offsets
 
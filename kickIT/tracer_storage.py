@@ -0,0 +1,514 @@
+"""Compressed columnar HDF5 storage of tracer data.
+
+The columns of a Systems class are stored in the 'tracers' group of the output file, as one chunked and compressed dataset per column with its unit stored as a string. Tracers are appended while their orbits are integrated, so the results are saved as the run progresses, and any subset of the columns can be read back without reading the others.
+
+Saved trajectories are stored in the 'trajectories' group. Only the times and phase-space coordinates are stored, quantized to integer multiples of an absolute tolerance and delta-encoded along each trajectory, so that the stored integers are small and compress well. The offsets are recomputed when the trajectories are read, using the sightline of each tracer.
+
+Projected offsets of each tracer along several random sightlines are stored, sorted, in the 'projections' group, so that each row is the empirical CDF of the projected offset of a tracer.
+"""
+import os
+import glob
+import json
+
+import numpy as np
+import pandas as pd
+
+import astropy.units as u
+
+from . import __version__
+from . import utils
+from .lazy import lazy_import
+
+h5py = lazy_import('h5py')
+
+
+FORMAT_NAME = 'kickIT-tracers'
+FORMAT_VERSION = 1
+GROUP = 'tracers'
+
+# Number of tracers per HDF5 chunk, and the compression of the chunks
+CHUNK_ROWS = 65536
+COMPRESSION = 'gzip'
+COMPRESSION_OPTS = 4
+
+# Number of tracers buffered by add_row before they are written to the file
+BUFFER_ROWS = 10000
+
+TRAJ_GROUP = 'trajectories'
+TRAJ_COMPRESSION = 'lzf'
+# Stored trajectory columns, their units, and the default absolute tolerances they are quantized to
+TRAJ_COLUMNS = ['time', 'X', 'Y', 'Z', 'vX', 'vY', 'vZ']
+TRAJ_UNITS = {'time': 'Gyr', 'X': 'kpc', 'Y': 'kpc', 'Z': 'kpc', 'vX': 'km / s', 'vY': 'km / s', 'vZ': 'km / s'}
+TRAJ_TIME_TOL = 1e-6
+TRAJ_POS_TOL = 1e-3
+TRAJ_VEL_TOL = 1e-2
+# Converts velocities from km/s to kpc/Gyr
+KMS_TO_KPCGYR = (u.km/u.s).to(u.kpc/u.Gyr)
+
+PROJ_GROUP = 'projections'
+
+# Kinds of snapshots, which are shared cosmic times or elapsed times since the birth of each tracer, and are stored in groups of the same name
+SNAP_KINDS = {'snapshots': 'cosmic time', 'elapsed': 'elapsed time since birth'}
+# Columns recorded at the snapshot times, and the size of the blocks of snapshots they are combined in
+SNAP_COLUMNS = ['X', 'Y', 'Z', 'vX', 'vY', 'vZ']
+SNAP_BLOCK_BYTES = 2**28
+# Default grid of elapsed-time snapshots: zero, and log-spaced between these times [Gyr]
+ELAPSED_MIN = 1e-3
+ELAPSED_MAX = 14.0
+ELAPSED_NUM = 50
+
+
+class TracerWriter:
+    """Writes tracer columns to the 'tracers' group of the HDF5 file at path.
+
+    Columns are written whole with write_column, or created empty with create_columns and filled one tracer at a time with add_row, in any order of tracers. Rows that have not been filled yet are NaN (or zero for integer and boolean columns). The file is opened for each write, so that the data written so far is readable, and is left intact if the run fails.
+
+    If mode=='w', any existing tracer data in the file is replaced. If mode=='a', the columns are added to the existing tracer data, which must have nsys rows.
+    """
+    def __init__(self, path, nsys, mode='w'):
+        self.path = path
+        self.nsys = nsys
+        self._rows = []
+        self._values = []
+
+        with h5py.File(path, 'a') as f:
+            if (mode == 'w') and (GROUP in f):
+                del f[GROUP]
+            if GROUP in f:
+                group = _tracer_group(f, path)
+                if group.attrs['nsys'] != nsys:
+                    raise ValueError('Tracer data in {0:s} has {1:d} rows, but {2:d} tracers are being written!'.format(path, group.attrs['nsys'], nsys))
+            else:
+                group = f.create_group(GROUP)
+                group.attrs['format'] = FORMAT_NAME
+                group.attrs['format_version'] = FORMAT_VERSION
+                group.attrs['kickIT_version'] = __version__
+                group.attrs['nsys'] = nsys
+                group.attrs['columns'] = json.dumps([])
+                group.attrs['complete'] = False
+
+
+    def _create(self, group, name, dtype, unit):
+        """Creates an empty dataset for column name, replacing it if it exists.
+        """
+        if name in group:
+            del group[name]
+        dtype = np.dtype(dtype)
+        fillvalue = np.nan if dtype.kind == 'f' else 0
+        dset = group.create_dataset(name, shape=(self.nsys,), dtype=dtype, chunks=(max(1, min(CHUNK_ROWS, self.nsys)),), \
+                        compression=COMPRESSION, compression_opts=COMPRESSION_OPTS, shuffle=True, fillvalue=fillvalue)
+        dset.attrs['unit'] = unit
+
+        columns = json.loads(group.attrs['columns'])
+        if name not in columns:
+            group.attrs['columns'] = json.dumps(columns + [name])
+
+        return dset
+
+
+    def create_columns(self, schema):
+        """Creates empty columns, given a dictionary of their (dtype, unit) keyed by name.
+        """
+        with h5py.File(self.path, 'a') as f:
+            group = f[GROUP]
+            for name, (dtype, unit) in schema.items():
+                self._create(group, name, dtype, unit)
+
+        return
+
+
+    def write_column(self, name, values, unit, chunk_rows=CHUNK_ROWS):
+        """Writes all the rows of a column, chunk_rows at a time.
+        """
+        if np.shape(values) != (self.nsys,):
+            raise ValueError("Column '{0:s}' should have shape ({1:d},), but has shape {2:s}!".format(name, self.nsys, str(np.shape(values))))
+
+        with h5py.File(self.path, 'a') as f:
+            dset = self._create(f[GROUP], name, values.dtype, unit)
+            for start in range(0, self.nsys, chunk_rows):
+                dset[start:start+chunk_rows] = values[start:start+chunk_rows]
+
+        return
+
+
+    def add_row(self, idx, values):
+        """Buffers the values (a dictionary keyed by column name) of tracer idx, and writes the buffer once it holds BUFFER_ROWS tracers.
+        """
+        self._rows.append(idx)
+        self._values.append(values)
+        if len(self._rows) >= BUFFER_ROWS:
+            self.flush()
+
+        return
+
+
+    def flush(self):
+        """Writes the buffered tracers to the file.
+        """
+        if not self._rows:
+            return
+
+        order = np.argsort(self._rows)
+        rows = np.asarray(self._rows)[order]
+        with h5py.File(self.path, 'a') as f:
+            group = f[GROUP]
+            for name in self._values[0]:
+                group[name][rows] = np.asarray([self._values[ii][name] for ii in order])
+
+        self._rows, self._values = [], []
+
+        return
+
+
+    def close(self, complete=False):
+        """Writes the buffered tracers, and marks whether all the tracer data has been written.
+        """
+        self.flush()
+        with h5py.File(self.path, 'a') as f:
+            f[GROUP].attrs['complete'] = complete
+
+        return
+
+
+
+def _tracer_group(f, path):
+    """The tracer group of an open HDF5 file, after checking its format.
+    """
+    if (GROUP not in f) or (f[GROUP].attrs.get('format') != FORMAT_NAME):
+        raise ValueError('File {0:s} does not hold kickIT tracer data!'.format(path))
+    group = f[GROUP]
+    if group.attrs['format_version'] > FORMAT_VERSION:
+        raise ValueError('Tracer data {0:s} has format version {1:d}, but only versions up to {2:d} can be read!'.format(path, group.attrs['format_version'], FORMAT_VERSION))
+
+    return group
+
+
+def read_tracers(path, columns=None, rows=slice(None)):
+    """Reads tracer data written by TracerWriter as a DataFrame indexed by tracer, with the columns in their stored units (see read_units).
+
+    Only the requested columns (default all) and rows (a slice or sorted array of indices) are read from the file.
+    """
+    with h5py.File(path, 'r') as f:
+        group = _tracer_group(f, path)
+        names = columns if columns is not None else json.loads(group.attrs['columns'])
+        missing = [name for name in names if name not in group]
+        if missing:
+            raise NameError('Columns {0:s} are not in the tracer data of {1:s}!'.format(', '.join(missing), path))
+
+        index = np.arange(group.attrs['nsys'])[rows]
+        tracers = pd.DataFrame({name: group[name][rows] for name in names}, index=pd.Index(index, name='idx'))
+
+    return tracers
+
+
+def read_units(path):
+    """Units of the tracer columns in path, as a dictionary of strings keyed by column name.
+    """
+    with h5py.File(path, 'r') as f:
+        group = _tracer_group(f, path)
+        units = {name: group[name].attrs['unit'] for name in json.loads(group.attrs['columns'])}
+
+    return units
+
+
+
+def trajectory_tolerances(pos_tol=TRAJ_POS_TOL, vel_tol=TRAJ_VEL_TOL, time_tol=TRAJ_TIME_TOL):
+    """Absolute tolerances of the stored trajectory columns, given those of the positions [kpc], velocities [km/s], and times [Gyr].
+    """
+    tols = {'time': time_tol}
+    tols.update({name: pos_tol for name in ['X', 'Y', 'Z']})
+    tols.update({name: vel_tol for name in ['vX', 'vY', 'vZ']})
+
+    return tols
+
+
+def encode_trajectory(columns, tols):
+    """Quantizes each trajectory column (a dictionary of arrays keyed by name) to integer multiples of its tolerance, and delta-encodes it along the trajectory.
+
+    Returns a (len(TRAJ_COLUMNS) x Nsteps) array of integers. The first entry of each row is the quantized initial value, so decoding does not accumulate errors beyond tolerance/2.
+    """
+    quantized = np.asarray([np.round(np.asarray(columns[name]) / tols[name]) for name in TRAJ_COLUMNS], dtype=np.int64)
+    return np.diff(quantized, axis=1, prepend=0)
+
+
+def decode_trajectory(deltas, tols):
+    """Inverse of encode_trajectory, returning a dictionary of the trajectory columns.
+    """
+    quantized = np.cumsum(deltas, axis=1)
+    return {name: quantized[ii] * tols[name] for ii, name in enumerate(TRAJ_COLUMNS)}
+
+
+def write_projections(path, Rproj_offsets, stratified):
+    """Writes the projected offsets [kpc] of the tracers along several sightlines each (Ntracers x Nsight) to the 'projections' group of the HDF5 file at path, sorted along each row.
+    """
+    Rproj_offsets = np.sort(np.asarray(Rproj_offsets, dtype=np.float32), axis=1)
+    nsys, nsight = Rproj_offsets.shape
+    with h5py.File(path, 'a') as f:
+        if PROJ_GROUP in f:
+            del f[PROJ_GROUP]
+        group = f.create_group(PROJ_GROUP)
+        group.attrs['format'] = FORMAT_NAME
+        group.attrs['format_version'] = FORMAT_VERSION
+        group.attrs['stratified'] = stratified
+        group.create_dataset('Rproj_offset', data=Rproj_offsets, chunks=(max(1, min(CHUNK_ROWS, nsys)), nsight), \
+                        compression=COMPRESSION, compression_opts=COMPRESSION_OPTS, shuffle=True)
+        group['Rproj_offset'].attrs['unit'] = 'kpc'
+
+    return
+
+
+def read_projections(path, rows=slice(None)):
+    """Sorted projected offsets [kpc] of the tracers in rows along each of their sightlines (Ntracers x Nsight), i.e. the empirical CDF of the projected offset of each tracer.
+    """
+    with h5py.File(path, 'r') as f:
+        if (PROJ_GROUP not in f) or (f[PROJ_GROUP].attrs.get('format') != FORMAT_NAME):
+            raise ValueError('File {0:s} does not hold kickIT projected offsets!'.format(path))
+        return f[PROJ_GROUP]['Rproj_offset'][rows]
+
+
+def tmp_paths(outdir, kind):
+    """Temporary files that the workers write records of the given kind ('trajectories' or one of SNAP_KINDS) to, one per process.
+    """
+    return sorted(glob.glob(os.path.join(outdir, '{0:s}.*.tmp'.format(kind))))
+
+
+def append_tmp(outdir, kind, header, sightline, values):
+    """Appends a record (an integer header starting with the tracer index, its sightline, and an array of values) to the temporary file of this process.
+    """
+    path = os.path.join(outdir, '{0:s}.{1:d}.tmp'.format(kind, os.getpid()))
+    with open(path, 'ab') as f:
+        np.save(f, np.asarray(header, dtype=np.int64))
+        np.save(f, np.asarray(sightline, dtype=np.float64))
+        np.save(f, values)
+
+    return
+
+
+def _read_tmp(path):
+    """Iterates over the (header, sightline, values) records of a temporary file.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while f.tell() < size:
+            header = np.load(f)
+            sightline = np.load(f)
+            values = np.load(f)
+            yield header, sightline, values
+
+
+def combine_trajectories(path, outdir, tols):
+    """Combines the temporary trajectory files in outdir into the 'trajectories' group of the HDF5 file at path, and removes them.
+
+    Each column is a single chunked, compressed dataset of the concatenated trajectories. The 'index' dataset holds the tracer, first row, and number of rows of each trajectory, and the 'sightline' dataset the three Euler angles used for its projected offsets.
+    """
+    with h5py.File(path, 'a') as f:
+        if TRAJ_GROUP in f:
+            del f[TRAJ_GROUP]
+        group = f.create_group(TRAJ_GROUP)
+        group.attrs['format'] = FORMAT_NAME
+        group.attrs['format_version'] = FORMAT_VERSION
+        group.attrs['tolerances'] = json.dumps(tols)
+        group.attrs['units'] = json.dumps(TRAJ_UNITS)
+        dsets = {name: group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(CHUNK_ROWS,), \
+                        compression=TRAJ_COMPRESSION, shuffle=True) for name in TRAJ_COLUMNS}
+
+        # --- append the trajectories to the datasets about CHUNK_ROWS rows at a time
+        pending = []
+        def flush():
+            if not pending:
+                return
+            deltas = np.concatenate(pending, axis=1)
+            nrows = dsets[TRAJ_COLUMNS[0]].shape[0]
+            for ii, name in enumerate(TRAJ_COLUMNS):
+                dsets[name].resize((nrows+deltas.shape[1],))
+                dsets[name][nrows:] = deltas[ii]
+            pending.clear()
+
+        index, sightlines = [], []
+        nrows = 0
+        for tmp_path in tmp_paths(outdir, 'trajectories'):
+            for (idx,), sightline, deltas in _read_tmp(tmp_path):
+                nsteps = np.shape(deltas)[1]
+                pending.append(deltas)
+                index.append([idx, nrows, nsteps])
+                sightlines.append(sightline)
+                nrows += nsteps
+                if sum(np.shape(deltas)[1] for deltas in pending) >= CHUNK_ROWS:
+                    flush()
+            os.remove(tmp_path)
+        flush()
+
+        order = np.argsort([ii[0] for ii in index], kind='stable')
+        group.create_dataset('index', data=np.asarray(index, dtype=np.int64).reshape(-1, 3)[order])
+        group.create_dataset('sightline', data=np.asarray(sightlines, dtype=np.float64).reshape(-1, 3)[order])
+
+    return
+
+
+def read_trajectories(path, idxs=None):
+    """Reads the trajectories written by combine_trajectories as a DataFrame indexed by tracer, in the units of TRAJ_UNITS.
+
+    The offsets (R_offset and Rproj_offset, in kpc) are recomputed from the positions, using the sightline of each tracer. If idxs is specified, only the trajectories of those tracers are read.
+    """
+    with h5py.File(path, 'r') as f:
+        if (TRAJ_GROUP not in f) or (f[TRAJ_GROUP].attrs.get('format') != FORMAT_NAME):
+            raise ValueError('File {0:s} does not hold kickIT trajectories!'.format(path))
+        group = f[TRAJ_GROUP]
+        tols = json.loads(group.attrs['tolerances'])
+        index, sightlines = group['index'][()], group['sightline'][()]
+        if idxs is not None:
+            keep = np.isin(index[:,0], idxs)
+            index, sightlines = index[keep], sightlines[keep]
+
+        trajectories = []
+        for (idx, start, nsteps), sightline in zip(index, sightlines):
+            deltas = np.asarray([group[name][start:start+nsteps] for name in TRAJ_COLUMNS])
+            trajectory = pd.DataFrame(decode_trajectory(deltas, tols), index=pd.Index(np.full(nsteps, idx), name='idx'))
+            vecs = trajectory[['X', 'Y', 'Z']].values
+            trajectory['R_offset'] = np.sqrt(np.sum(vecs**2, axis=1))
+            trajectory['Rproj_offset'] = utils.projected_offsets(vecs, sightline)
+            trajectories.append(trajectory)
+
+    if not trajectories:
+        return pd.DataFrame(columns=TRAJ_COLUMNS+['R_offset', 'Rproj_offset'], index=pd.Index([], name='idx'))
+    return pd.concat(trajectories)
+
+
+
+def sample_snapshots(trajectory, times):
+    """Samples a trajectory (a dictionary of arrays keyed by TRAJ_COLUMNS) at the snapshot times [Gyr] that it covers, using cubic Hermite interpolation of the positions and velocities.
+
+    Returns the index of the first snapshot time covered, and a (len(SNAP_COLUMNS) x Ncovered) array of the sampled columns.
+    """
+    tt = trajectory['time']
+    covered = np.flatnonzero((times >= tt[0]) & (times <= tt[-1]))
+    if covered.size == 0:
+        return 0, np.zeros((len(SNAP_COLUMNS), 0))
+
+    values = []
+    for pos, vel in [('X', 'vX'), ('Y', 'vY'), ('Z', 'vZ')]:
+        values.append(utils.hermite_interp(tt, trajectory[pos], trajectory[vel]*KMS_TO_KPCGYR, times[covered]))
+    for vel in ['vX', 'vY', 'vZ']:
+        values.append(np.interp(times[covered], tt, trajectory[vel]))
+
+    return covered[0], np.asarray(values)
+
+
+def elapsed_grid(tmin=ELAPSED_MIN, tmax=ELAPSED_MAX, num=ELAPSED_NUM):
+    """Elapsed times [Gyr] for the 'elapsed' snapshots: zero (the birth of the tracer), and num times log-spaced between tmin and tmax.
+    """
+    return np.concatenate([[0.0], np.logspace(np.log10(tmin), np.log10(tmax), num)])
+
+
+def combine_snapshots(path, outdir, times, nsys, kind='snapshots'):
+    """Combines the temporary snapshot files of the given kind (see SNAP_KINDS) in outdir into the group of the same name in the HDF5 file at path, and removes them.
+
+    Each column is a (times x tracers) float32 dataset, chunked by snapshot, so that the values of every tracer at one snapshot time are read contiguously. Tracers that were not born yet, had merged, or were not integrated at a snapshot time are NaN. The 'sightline' dataset holds the Euler angles used for the projected offsets of each tracer.
+    """
+    ntimes = len(times)
+    paths = tmp_paths(outdir, kind)
+    sightlines = np.full((nsys, 3), np.nan)
+
+    with h5py.File(path, 'a') as f:
+        if kind in f:
+            del f[kind]
+        group = f.create_group(kind)
+        group.attrs['format'] = FORMAT_NAME
+        group.attrs['format_version'] = FORMAT_VERSION
+        group.attrs['axis'] = SNAP_KINDS[kind]
+        group.attrs['units'] = json.dumps({name: TRAJ_UNITS[name] for name in SNAP_COLUMNS})
+        group.create_dataset('time', data=np.asarray(times, dtype=np.float64))
+        group['time'].attrs['unit'] = TRAJ_UNITS['time']
+        dsets = {name: group.create_dataset(name, shape=(ntimes, nsys), dtype=np.float32, chunks=(1, max(1, min(CHUNK_ROWS, nsys))), \
+                        compression=TRAJ_COMPRESSION, shuffle=True, fillvalue=np.nan) for name in SNAP_COLUMNS}
+
+        # --- fill blocks of snapshots in memory, reading the temporary files once per block
+        block = max(1, SNAP_BLOCK_BYTES // (4*len(SNAP_COLUMNS)*max(1, nsys)))
+        for k0 in range(0, ntimes, block):
+            k1 = min(ntimes, k0+block)
+            values = np.full((len(SNAP_COLUMNS), k1-k0, nsys), np.nan, dtype=np.float32)
+            for tmp_path in paths:
+                for (idx, first), sightline, vals in _read_tmp(tmp_path):
+                    sightlines[idx] = sightline
+                    lo, hi = max(k0, first), min(k1, first+vals.shape[1])
+                    if hi > lo:
+                        values[:, lo-k0:hi-k0, idx] = vals[:, lo-first:hi-first]
+            for ii, name in enumerate(SNAP_COLUMNS):
+                dsets[name][k0:k1] = values[ii]
+
+        group.create_dataset('sightline', data=sightlines)
+
+    for tmp_path in paths:
+        os.remove(tmp_path)
+
+    return
+
+
+def read_snapshot_times(path, kind='snapshots'):
+    """Snapshot times [Gyr] of the given kind (see SNAP_KINDS) in the file at path.
+    """
+    with h5py.File(path, 'r') as f:
+        return _snapshot_group(f, path, kind)['time'][()]
+
+
+def _snapshot_group(f, path, kind):
+    if kind not in SNAP_KINDS:
+        raise NameError('Snapshot kind {0:s} not recognized!'.format(kind))
+    if (kind not in f) or (f[kind].attrs.get('format') != FORMAT_NAME):
+        raise ValueError('File {0:s} does not hold kickIT {1:s} snapshots!'.format(path, kind))
+    return f[kind]
+
+
+def read_snapshot(path, time, kind='snapshots'):
+    """Positions, velocities, and offsets of every tracer at the snapshot time [Gyr] closest to time, as a DataFrame indexed by tracer (in the units of TRAJ_UNITS, and kpc for the offsets). For 'elapsed' snapshots, the time is the elapsed time since the birth of each tracer.
+
+    Each column is a single contiguous read. Tracers that did not exist at that time have NaN values.
+    """
+    with h5py.File(path, 'r') as f:
+        group = _snapshot_group(f, path, kind)
+        kk = int(np.argmin(np.abs(group['time'][()] - time)))
+        snapshot = pd.DataFrame({name: group[name][kk] for name in SNAP_COLUMNS})
+        sightlines = group['sightline'][()]
+
+    snapshot.index.name = 'idx'
+    vecs = snapshot[['X', 'Y', 'Z']].values.astype(np.float64)
+    snapshot['R_offset'] = np.sqrt(np.sum(vecs**2, axis=1))
+    snapshot['Rproj_offset'] = utils.projected_offsets(vecs, sightlines)
+
+    return snapshot
+
+
+
+def read_elapsed_offsets(path, elapsed):
+    """Offsets of the tracers after the elapsed times [Gyr] since their birth (either one for all tracers, or one per tracer), interpolated between their 'elapsed' snapshots.
+
+    The positions are interpolated with cubic Hermite interpolation of the positions and velocities at the bracketing snapshots, so e.g. the offsets of the tracers for any inspiral times can be calculated after the integration. Returns a DataFrame indexed by tracer with the positions [kpc] and offsets [kpc]. Tracers whose elapsed time is past the last snapshot they reached (i.e. in the last grid interval before their merger or the sGRB, or later) are NaN. The snapshots are read CHUNK_ROWS tracers at a time.
+    """
+    with h5py.File(path, 'r') as f:
+        group = _snapshot_group(f, path, 'elapsed')
+        grid = group['time'][()]
+        sightlines = group['sightline'][()]
+        nsys = sightlines.shape[0]
+        elapsed = np.broadcast_to(np.asarray(elapsed, dtype=float), (nsys,))
+
+        positions = np.full((nsys, 3), np.nan)
+        for start in range(0, nsys, CHUNK_ROWS):
+            rows = slice(start, min(start+CHUNK_ROWS, nsys))
+            tt = elapsed[rows]
+            # --- bracketing snapshots of each tracer, and the fraction of the way between them
+            kk = np.clip(np.searchsorted(grid, tt, side='right')-1, 0, len(grid)-2)
+            dt = grid[kk+1] - grid[kk]
+            ss = (tt - grid[kk]) / dt
+            cols = np.arange(rows.stop-rows.start)
+            h00, h10, h01, h11 = utils.hermite_basis(ss)
+            for ii, (pos, vel) in enumerate([('X', 'vX'), ('Y', 'vY'), ('Z', 'vZ')]):
+                xx, vv = group[pos][:, rows], group[vel][:, rows] * KMS_TO_KPCGYR
+                positions[rows, ii] = h00*xx[kk, cols] + h10*dt*vv[kk, cols] + h01*xx[kk+1, cols] + h11*dt*vv[kk+1, cols]
+            positions[rows][(tt < grid[0]) | (tt > grid[-1])] = np.nan
+
+    offsets = pd.DataFrame(positions, columns=['X', 'Y', 'Z'])
+    offsets.index.name = 'idx'
+    offsets['R_offset'] = np.sqrt(np.sum(positions**2, axis=1))
+    offsets['Rproj_offset'] = utils.projected_offsets(positions, sightlines)
+
+    return offsets
@@ -1,11 +1,17 @@
 import numpy as np
-import pandas as pd
 import scipy as sp
-from scipy import integrate
+import scipy.interpolate  # noqa
 
 import astropy.units as u
 import astropy.constants as C
 
+from ..lazy import lazy_import
+from . import transforms
+from .transforms import rotation_matrix, euler_matrix, rotate, euler_rot, projected_offsets, isotropic_sightlines, projected_offset_samples
+
+# only used for the inspiral times, and slow to import
+integrate = lazy_import('scipy.integrate')
+
 def interp_1d(xx, yy, **kwargs):
     kwargs.setdefault('kind', 'linear')
     kwargs.setdefault('bounds_error', False)
@@ -55,23 +61,23 @@ def shell_volumes(rads, relative=True, reset_inner=True):
 
     return vol
 
-def euler_rot(vectors, angles, axis):
+def hermite_interp(tt, xx, vv, tnew):
     """
-    Performed Euler angle transformation on vector.
-
-    Takes in vectors as (Nsamples x Ndim)
+    Cubic Hermite interpolation at the (sorted) times tnew of positions xx with time derivatives vv, sampled at the sorted times tt (which may repeat).
     """
-    if axis=='X':
-        transformations = np.asarray([[[1,0,0],[0,np.cos(angle),-np.sin(angle)],[0,np.sin(angle),np.cos(angle)]] for angle in angles])
-    elif axis=='Y':
-        transformations = np.asarray([[[np.cos(angle),0,np.sin(angle)],[0,1,0],[-np.sin(angle),0,np.cos(angle)]] for angle in angles])
-    elif axis=='Z':
-        transformations = np.asarray([[[np.cos(angle),-np.sin(angle),0],[np.sin(angle),np.cos(angle),0],[0,0,1]] for angle in angles])
-    else:
-        raise ValueError("Unknown axis '{0:s}' specified in Euler transformation)".format(axis))
+    ii = np.clip(np.searchsorted(tt, tnew, side='right')-1, 0, len(tt)-2)
+    dt = tt[ii+1] - tt[ii]
+    # where the interval has zero length, take the value at its start
+    ss = np.divide(tnew - tt[ii], dt, out=np.zeros_like(tnew, dtype=float), where=(dt > 0))
+    h00, h10, h01, h11 = hermite_basis(ss)
+    return h00*xx[ii] + h10*dt*vv[ii] + h01*xx[ii+1] + h11*dt*vv[ii+1]
+
 
-    rot_vectors = np.asarray([np.dot(trans,vector).T for (trans,vector) in zip(transformations, vectors)])
-    return rot_vectors
+def hermite_basis(ss):
+    """
+    Cubic Hermite basis functions at the fractions ss of the way through an interval, for the start value, start derivative, end value, and end derivative.
+    """
+    return (1 + 2*ss)*(1 - ss)**2, ss*(1 - ss)**2, ss**2*(3 - 2*ss), ss**2*(ss - 1)
 
 
 
@@ -129,37 +135,23 @@ def inspiral_time_peters(a0,e0,m1,m2,af=0):
 def cartesian_to_cylindrical(x,y,z,vx,vy,vz):
     """
     Transforms positions and velocities from cartesian to cylindrical coordinates
-    Takes in Astropy units
+    Takes in Astropy units (see transforms.cartesian_to_cylindrical for plain arrays)
     """
+    R,Phi,Z,vR,vT,vZ = transforms.cartesian_to_cylindrical(x.to_value(u.kpc), y.to_value(u.kpc), z.to_value(u.kpc), vx.to_value(u.km/u.s), vy.to_value(u.km/u.s), vz.to_value(u.km/u.s))
+    vPhi = vT / (R*u.kpc).to_value(u.km)
 
-    R = np.sqrt(x**2 + y**2).to(u.kpc)
-    vR = ((x*vx + y*vy)/((x**2 + y**2)**(1./2))).to(u.km/u.s)
-
-    Phi = np.arctan(y/x).to(u.rad)
-    vPhi = ((x*vy - y*vx)/(x**2 + y**2)).to(1/u.s)
-
-    Z = z.to(u.kpc)
-    vZ = vz.to(u.km/u.s)
-
-    return R,Phi,Z,vR,vPhi,vZ
+    return R*u.kpc, Phi*u.rad, Z*u.kpc, vR*u.km/u.s, vPhi/u.s, vZ*u.km/u.s
 
 
 def cylindrical_to_cartesian(R,Phi,Z,vR,vPhi,vZ):
     """
     Transforms positions and velocities from cylindrical to cartesian coordinates
-    Takes in Astropy units
+    Takes in Astropy units (see transforms.cylindrical_to_cartesian for plain arrays)
     """
+    vT = (R*vPhi).to_value(u.km/u.s)
+    x,y,z,vx,vy,vz = transforms.cylindrical_to_cartesian(R.to_value(u.kpc), Phi.to_value(u.rad), Z.to_value(u.kpc), vR.to_value(u.km/u.s), vT, vZ.to_value(u.km/u.s))
 
-    x = (R*np.cos(Phi)).to(u.kpc)
-    vx = (vR*np.cos(Phi) - R*np.sin(Phi)*vPhi).to(u.km/u.s)
-
-    y = (R*np.sin(Phi)).to(u.kpc)
-    vy = (vR*np.sin(Phi) + R*np.cos(Phi)*vPhi).to(u.km/u.s)
-
-    z = Z.to(u.kpc)
-    vz = vZ.to(u.km/u.s)
-
-    return x,y,z,vx,vy,vz
+    return x*u.kpc, y*u.kpc, z*u.kpc, vx*u.km/u.s, vy*u.km/u.s, vz*u.km/u.s
 
 
 
@@ -275,7 +267,8 @@ class Outlier():
             sgrid = np.linspace(*SIGMA_GRID_RANGE, SIGMA_GRID_SIZE)
 
         # Convert standard-deviations to percentiles
-        sigma_percentiles = sp.stats.norm.cdf(sgrid)
+        from scipy.stats import norm
+        sigma_percentiles = norm.cdf(sgrid)
 
         # Use the function to stochastically sample y-values
         #    shape: (N, M) for `N` x-vals, and `M` MC samples
@@ -325,9 +318,9 @@ class Outlier():
 
 class OutlierND():
 
-    def __init__(self, xgrids, function=None, sgrid=None, ygrid=None, nmc=1e4, store=False):
-        nmc = int(nmc)
-
+    def __init__(self, xgrids, function=None, sgrid=None, ygrid=None, nmc=1e4, store=False, yvals_percs=None, rng=None):
+        """yvals_percs are the percentiles of the function at each grid point and sigma (see mc_percentiles), which are calculated using the random state rng if not provided.
+        """
         if function is None:
             function = self.function
 
@@ -337,19 +330,11 @@ class OutlierND():
             SIGMA_GRID_SIZE = 50
             sgrid = np.linspace(*SIGMA_GRID_RANGE, SIGMA_GRID_SIZE)
 
-        # Convert standard-deviations to percentiles
-        sigma_percentiles = sp.stats.norm.cdf(sgrid)
-
         # Create a meshgrid from the tuple of grids in each dimension
         mesh = np.meshgrid(*xgrids, indexing='ij')
 
-        # Use the function to stochastically sample y-values
-        #    shape: (N, M) for `N` x-vals, and `M` MC samples
-        yvals_from_xgrid = function(*mesh, samples=nmc)
-        # Calculate percentile-distributions of y-vals
-        #    shape: (L, N) for `L` standard-deviation values and `N` (input) x-values
-        yvals_percs = np.percentile(yvals_from_xgrid, 100*sigma_percentiles, axis=-1)
-        yvals_percs = np.moveaxis(yvals_percs, 0, -1)
+        if yvals_percs is None:
+            yvals_percs = self.mc_percentiles(xgrids, function, sgrid, nmc, rng=rng)
 
         # Construct grid of y-values
         if ygrid is None:
@@ -379,6 +364,32 @@ class OutlierND():
 
         return
 
+    @staticmethod
+    def mc_percentiles(xgrids, function, sgrid, nmc, rng=None):
+        """Percentiles of Monte Carlo samples of the function at each point of the grids, corresponding to each standard deviation in sgrid.
+
+        The samples are drawn using the random state rng if it is provided, and the global numpy random state otherwise. Returns an array of shape (N1, ..., Nk, L) for `L` standard-deviation values.
+        """
+        nmc = int(nmc)
+
+        # Convert standard-deviations to percentiles
+        from scipy.stats import norm
+        sigma_percentiles = norm.cdf(sgrid)
+
+        # Create a meshgrid from the tuple of grids in each dimension
+        mesh = np.meshgrid(*xgrids, indexing='ij')
+
+        # Use the function to stochastically sample y-values
+        #    shape: (N, M) for `N` x-vals, and `M` MC samples
+        kwargs = {} if rng is None else {'rng': rng}
+        yvals_from_xgrid = function(*mesh, samples=nmc, **kwargs)
+        # Calculate percentile-distributions of y-vals
+        #    shape: (L, N) for `L` standard-deviation values and `N` (input) x-values
+        yvals_percs = np.percentile(yvals_from_xgrid, 100*sigma_percentiles, axis=-1)
+        yvals_percs = np.moveaxis(yvals_percs, 0, -1)
+
+        return yvals_percs
+
     def __call__(self, *args, **kwargs):
         return self.xs_to_y(*args, **kwargs)
 
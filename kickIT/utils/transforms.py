@@ -0,0 +1,122 @@
+"""Batched, unit-free coordinate transformations.
+
+Every function takes plain arrays (in any consistent units) and broadcasts over leading axes, with vectors stored along the last axis, so that a whole population of tracers or a whole trajectory is transformed at once without per-row Python work.
+"""
+import numpy as np
+
+
+def rotation_matrix(angle, axis):
+    """
+    Matrix of the Euler rotation by angle about axis ('X', 'Y', or 'Z'). For an array of angles, returns an array of matrices (angle.shape x 3 x 3).
+    """
+    cos, sin = np.cos(angle), np.sin(angle)
+    one, zero = np.ones_like(cos), np.zeros_like(cos)
+    if axis=='X':
+        rows = [[one,zero,zero],[zero,cos,-sin],[zero,sin,cos]]
+    elif axis=='Y':
+        rows = [[cos,zero,sin],[zero,one,zero],[-sin,zero,cos]]
+    elif axis=='Z':
+        rows = [[cos,-sin,zero],[sin,cos,zero],[zero,zero,one]]
+    else:
+        raise ValueError("Unknown axis '{0:s}' specified in Euler transformation)".format(axis))
+    return np.moveaxis(np.asarray(rows), (0,1), (-2,-1))
+
+
+def euler_matrix(angles, axes='XYZ'):
+    """
+    Matrix of the composition of Euler rotations about each of axes in turn, by the corresponding angles along the last axis of angles (... x len(axes)).
+    """
+    angles = np.asarray(angles)
+    if angles.shape[-1] != len(axes):
+        raise ValueError('Need one angle for each of the axes {0:s}, but got {1:d}!'.format(axes, angles.shape[-1]))
+    matrix = rotation_matrix(angles[...,0], axes[0])
+    for ii, axis in enumerate(axes[1:], 1):
+        matrix = rotation_matrix(angles[...,ii], axis) @ matrix
+    return matrix
+
+
+def rotate(vectors, matrices):
+    """
+    Applies the rotation matrices (... x 3 x 3) to the vectors (... x 3), broadcasting over the leading axes.
+    """
+    return np.einsum('...ij,...j->...i', matrices, vectors)
+
+
+def euler_rot(vectors, angles, axis):
+    """
+    Performs the Euler rotation of each of the vectors (Nsamples x Ndim) by the corresponding angle about axis.
+    """
+    return rotate(vectors, rotation_matrix(np.asarray(angles), axis))
+
+
+def cartesian_to_cylindrical(x, y, z, vx, vy, vz):
+    """
+    Transforms positions and velocities from cartesian to cylindrical coordinates, returning R, Phi, z, vR, vT, vz, where vT = R*dPhi/dt is the tangential velocity.
+    """
+    R = np.sqrt(x**2 + y**2)
+    Phi = np.arctan2(y, x)
+    vR = (x*vx + y*vy) / R
+    vT = (x*vy - y*vx) / R
+
+    return R, Phi, z, vR, vT, vz
+
+
+def cylindrical_to_cartesian(R, Phi, z, vR, vT, vz):
+    """
+    Transforms positions and velocities from cylindrical to cartesian coordinates, where vT = R*dPhi/dt is the tangential velocity.
+    """
+    cos, sin = np.cos(Phi), np.sin(Phi)
+
+    return R*cos, R*sin, z, vR*cos - vT*sin, vR*sin + vT*cos, vz
+
+
+def spherical_to_cartesian(r, theta, phi):
+    """
+    Cartesian components of vectors of length r at polar angle theta and azimuthal angle phi.
+    """
+    sin_theta = np.sin(theta)
+
+    return r*sin_theta*np.cos(phi), r*sin_theta*np.sin(phi), r*np.cos(theta)
+
+
+def projected_offsets(vectors, sightline):
+    """
+    Offsets of the vectors (Nsamples x Ndim) projected onto the sky, for an observer in the z-hat direction after rotating the vectors about the X, Y, and Z axes (in that order) by the three angles of sightline.
+
+    sightline is either a single set of angles, or one per vector (Nsamples x 3).
+    """
+    rot_vectors = rotate(np.asarray(vectors), euler_matrix(sightline, 'XYZ'))
+    return np.sqrt(rot_vectors[...,0]**2 + rot_vectors[...,1]**2)
+
+
+def isotropic_sightlines(shape, stratified=False, poles=None):
+    """
+    Random unit vectors distributed isotropically over the sphere, as an array of the given shape of sightlines (shape x 3).
+
+    If stratified==True, the sightlines along the last axis of shape are stratified over the sphere, with one in each of the equal-area bands of cos(theta) about the z-axis, or about the vectors poles (shape[:-1] x 3) if specified. Since the projected offset of a vector only depends on the angle between it and the sightline, stratifying about the vector itself makes its projected offsets converge much faster than for independent sightlines.
+    """
+    shape = tuple(np.atleast_1d(shape))
+    mu = np.random.random(shape)
+    if stratified:
+        mu = (np.arange(shape[-1]) + mu) / shape[-1]
+    sightlines = np.stack(spherical_to_cartesian(1.0, np.arccos(2*mu - 1), 2*np.pi*np.random.random(shape)), axis=-1)
+    if poles is None:
+        return sightlines
+
+    # --- rotate the z-axis onto each pole, with an orthonormal basis about the pole
+    zhat = np.asarray(poles, dtype=float) / np.linalg.norm(poles, axis=-1, keepdims=True)
+    helper = np.where(np.abs(zhat[...,:1]) < 0.9, [1.,0.,0.], [0.,1.,0.])
+    xhat = np.cross(helper, zhat)
+    xhat /= np.linalg.norm(xhat, axis=-1, keepdims=True)
+    yhat = np.cross(zhat, xhat)
+    basis = np.stack([xhat, yhat, zhat], axis=-1)
+    return rotate(sightlines, basis[...,None,:,:])
+
+
+def projected_offset_samples(vectors, sightlines):
+    """
+    Offsets of the vectors (Nsamples x Ndim) projected onto the sky, for observers along each of the unit vectors sightlines, which are either shared by all vectors (Nsight x Ndim) or drawn for each (Nsamples x Nsight x Ndim). Returns an array (Nsamples x Nsight).
+    """
+    vectors = np.asarray(vectors)
+    along = np.einsum('nj,kj->nk' if np.ndim(sightlines) == 2 else 'nj,nkj->nk', vectors, sightlines)
+    return np.sqrt(np.maximum(np.sum(vectors**2, axis=1)[:,None] - along**2, 0))
@@ -7,16 +7,22 @@ import pdb
 import warnings
 import pickle
 
-import numpy as np
-import pandas as pd
-
-import astropy.units as u
-import astropy.constants as C
-
 from kickIT import __version__
-from kickIT import galaxy_history
-from kickIT import sample
-from kickIT import system
+from kickIT.lazy import lazy_import
+
+# --- the science modules are only loaded once they are used, so that parsing the arguments (e.g. --help or --version) is fast
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+u = lazy_import('astropy.units')
+C = lazy_import('astropy.constants')
+
+galaxy_history = lazy_import('kickIT.galaxy_history')
+sample = lazy_import('kickIT.sample')
+system = lazy_import('kickIT.system')
+interpolate = lazy_import('kickIT.interpolate')
+cache = lazy_import('kickIT.cache')
+tracer_storage = lazy_import('kickIT.tracer_storage')
+aggregates = lazy_import('kickIT.aggregates')
 
 import time
 
@@ -45,15 +51,22 @@ def parse_commandline():
     parser.add_argument('--sgrb-path', type=str, help="Path to the table with sGRB host galaxy information.")
     parser.add_argument('--samples-path', type=str, default=None, help="Path to the samples from population synthesis for generating the initial population of binaries. Default is None.")
     parser.add_argument('--interp-path', type=str, default=None, help="Path to the potential interpolation file you wish to use. Default is None.")
-    parser.add_argument('--gal-path', type=str, default=None, help="Sets path to read in previously constructed galaxy realization. Default is 'None'.")
+    parser.add_argument('--interp-dirpath', type=str, default=None, help="Path to a directory of per-timestep potential interpolations. Interpolations are only built (and saved here) when a timestep is first used, and previously built ones are reused. Default is None.")
+    parser.add_argument('--gal-path', type=str, default=None, help="Sets path to read in previously constructed galaxy realization, either pickled ('.pkl') or in the HDF5 format ('.h5' or '.hdf5'). Default is 'None'.")
+    parser.add_argument('--ensemble-member', type=int, default=None, help="If specified, --gal-path is an ensemble of galaxy realizations (see construct_galaxies.py --ensemble), and the realization with this index is used. Default is None.")
+    parser.add_argument('--table-dirpath', type=str, default=None, help="Directory in which the Monte Carlo tables of the scaling relations, which only depend on the code, are saved and reused by later runs. Default is the KICKIT_TABLE_DIRPATH environment variable; if neither is set, the tables are recalculated in every run and nothing is written.")
+    parser.add_argument('--gal-format', type=str, default='pkl', help="Format for saving the galaxy realization. 'pkl' pickles the full galaxy class, whereas 'hdf5' only stores its history and build parameters and rebuilds the potentials when they are first used, which is much smaller, faster to load, and portable across galpy and astropy versions. Default is 'pkl'.")
+    parser.add_argument('--cache-dirpath', type=str, default=None, help="Path to a cache of galaxy realizations, SFR history solutions, and potential interpolations, keyed by a hash of the host properties, galaxy and grid options, and code version. Entries are reused when they exist and created otherwise. Not used for galaxies or interpolations specified with --gal-path, --interp-path, or --interp-dirpath. Default is None.")
     parser.add_argument('--label', type=str, default=None, help="Provide user-defined label for naming galaxy and output files. Default is 'None'.")
 
     # galaxy arguments
-    parser.add_argument('--disk-profile', type=str, default='DoubleExponential', help="Profile for the galactic disk, named according to Galpy potentials. Default is 'DoubleExponential'.")
+    parser.add_argument('--disk-profile', type=str, default='DoubleExponential', help="Profile for the galactic disk, named according to Galpy potentials. 'MNExponential' approximates the double exponential disk by a sum of Miyamoto-Nagai potentials, which is much faster to integrate in and works with galpy's C integrators. Default is 'DoubleExponential'.")
     parser.add_argument('--bulge-profile', type=str, default=None, help="Profile for the galactic bulge, named according to Galpy potentials. Default is None.")
     parser.add_argument('--dm-profile', type=str, default='NFW', help="Profile for the DM, named according to Galpy potentials. Default is NFW.")
     parser.add_argument('--z-scale', type=float, default=0.05, help="Fraction of the galactic scale radius for the scale height above/below the disk. Default=0.05.")
     parser.add_argument('--differential-prof', action='store_true', help="Uses a differential stellar profile, creating a unique galpy potential at each timestep according to the updated scale radius and accumulated mass. Default=False.")
+    parser.add_argument('--collapse-shells', action='store_true', help="With --differential-prof, represents the stellar shells accumulated by each timestep by a single fit of a few Miyamoto-Nagai potentials, so the cost of evaluating the potential does not grow with time. Requires --disk-profile DoubleExponential or MNExponential. Default=False.")
+    parser.add_argument('--coarsen-tol', type=float, default=None, help="Merges consecutive timesteps whose galactic potentials differ by less than this fractional force into epochs that share a single potential, so fewer potentials need to be interpolated and integrated through. Birth times and SFR weights are unaffected. Default=None (no coarsening).")
     parser.add_argument('--smhm-relation', type=str, default='Guo', help="Chooses a stellar mass-halo mass relation. Current options are from Guo+2010 and Moster+2012. If Moster is provided, can also supply a sigma value. Default is 'Guo'.")
     parser.add_argument('--smhm-sigma', type=float, default=0.0, help="Deviation from the stellar mass-halo mass relation in Moster+2012. Can supply either positive or negative values. Default is 0.0.")
 
@@ -84,15 +97,35 @@ def parse_commandline():
     parser.add_argument('--R-mean', type=float, default=5.0, help="Mean starting distance from the galactic center, in kpc. Default is 5.0.")
 
     # integration arguments
-    parser.add_argument('--int-method', type=str, default='odeint', help="Integration method for the orbits. Possible options are 'odeint' or 'leapfrog', until we get the C implementation working. Default is 'odeint'.")
+    parser.add_argument('--int-method', type=str, default='odeint', help="Integration method for the orbits. Possible options are 'odeint' or 'leapfrog', or galpy's C integrators (e.g. 'dopr54_c') when every potential has a C implementation, such as with --disk-profile MNExponential. Default is 'odeint'.")
     parser.add_argument('--Tint-max', type=float, default=120.0, help="Amount of time to integrate before terminating, in seconds. Default is 120.0.")
     parser.add_argument('--resolution', type=int, default=1000, help="Resolution of integration, specified by the number of timesteps per redshift bin in the integration. Default is 1000.")
     parser.add_argument('--save-traj', action='store_true',help="Indicates whether to save the full trajectories. Default=False")
     parser.add_argument('--downsample', type=int, default=None, help="Downsamples the trajectory data by taking every Nth line in the trajectories dataframe. Default=None.")
+    parser.add_argument('--snapshots', type=int, default=None, help="If specified, also records the positions and velocities of every tracer at this many evenly spaced cosmic times, from the first timestep of the galaxy to the time of the sGRB. These are stored by time, so all tracers at one time can be read at once (see tracer_storage.read_snapshot). Default=None.")
+    parser.add_argument('--elapsed-snapshots', type=int, default=None, help="If specified, also records the positions and velocities of every tracer at zero and this many log-spaced elapsed times since its birth, from 1 Myr to 14 Gyr. The offsets for any inspiral time can then be interpolated from these after the run (see convolve.offsets_at_tinsp), without saving the full trajectories. Default=None.")
+    parser.add_argument('--aggregate', action='store_true', help="Accumulates histograms and quantile sketches of the projected offsets and merger redshifts, and the escaped fraction, per birth timestep and systemic-velocity bin while the tracers are integrated, and saves them to the 'aggregates' group of the output file (see kickIT.aggregates). Default=False.")
+    parser.add_argument('--aggregate-only', action='store_true', help="Like --aggregate, but does not store the results of each tracer, so that very large runs only keep the aggregates. Default=False.")
+    parser.add_argument('--sightlines', type=int, default=None, help="If specified, also projects the final position of each tracer along this many random isotropic sightlines, which are saved to the 'projections' group of the output file and used for the offsets in the aggregates. Default=None.")
+    parser.add_argument('--stratify-sightlines', action='store_true', help="With --sightlines, stratifies the sightlines of each tracer over the sphere. Default=False.")
+    parser.add_argument('--traj-pos-tol', type=float, default=1e-3, help="Absolute tolerance of the saved trajectory positions, in kpc. Positions are stored as integer multiples of this. Default is 1e-3.")
+    parser.add_argument('--traj-vel-tol', type=float, default=1e-2, help="Absolute tolerance of the saved trajectory velocities, in km/s. Velocities are stored as integer multiples of this. Default is 1e-2.")
+    parser.add_argument('--float32', action='store_true', help="Stores the derived tracer outputs (e.g. final positions, velocities, offsets, and merger redshifts) in single precision, halving their memory and the size of the output file. Default=False.")
+
+    # interpolation arguments (only used with --interp-dirpath or --cache-dirpath)
+    parser.add_argument('-rg', '--Rgrid', type=int, default=300, help="Number of gridpoints for the R-component of the interpolation model. Default is 300.")
+    parser.add_argument('-zg', '--Zgrid', type=int, default=100, help="Number of gridpoints for the Z-component of the interpolation model. Default is 100.")
+    parser.add_argument('--Rgrid-max', type=float, default=1e3, help="Maximum R value for interpolated potentials. Default is 1e3.")
+    parser.add_argument('--Zgrid-max', type=float, default=1e2, help="Maximum Z value for interpolated potentials. Default is 1e2.")
+    parser.add_argument('--pipeline', action='store_true', help="Builds the interpolations on the same pool of workers as the integrations, latest timesteps first, and integrates each tracer as soon as the interpolations it needs exist. Requires --interp-dirpath or --cache-dirpath. Default=False.")
+    parser.add_argument('--interp-cache-size', type=int, default=64, help="Maximum number of interpolated potentials held in memory at once (per process). Default is 64.")
 
 
     args = parser.parse_args()
 
+    if args.collapse_shells and (args.disk_profile not in galaxy_history.COLLAPSE_DISK_PROFILES):
+        parser.error('--collapse-shells fits the stellar shells as double exponential disks, so it requires --disk-profile {0:s}, not {1:s}'.format(' or '.join(galaxy_history.COLLAPSE_DISK_PROFILES), args.disk_profile))
+
     return args
 
 
@@ -104,32 +137,45 @@ def main(args):
     """
     start = time.time()
 
+    if args.table_dirpath is not None:
+        cache.TABLE_DIRPATH = args.table_dirpath
+
     # --- construct pertinent directories
     if not os.path.exists(args.output_dirpath):
         os.makedirs(args.output_dirpath)
 
     # --- read sgrb hostprops table as pandas dataframe, parse observed props
-    sgrb_host_properties = pd.read_csv(args.sgrb_path, delim_whitespace=True, na_values='-', converters={'GRB': lambda x: str(x)})
+    sgrb_host_properties = galaxy_history.read_sgrb_hosts(args.sgrb_path)
     gal_info = sgrb_host_properties.loc[sgrb_host_properties['GRB'] == args.grb].iloc[0]
-    obs_props = {'name':gal_info['GRB'],\
-                      'pcc':gal_info['Pcc'],\
-                      'mass_stars':10**gal_info['log(M*)']*u.Msun,\
-                      'redz':gal_info['z'],\
-                      'age_stars':gal_info['PopAge']*u.Gyr,\
-                      'rad_eff':gal_info['r_e']*u.kpc,\
-                      'rad_offset':gal_info['deltaR']*u.kpc,\
-                      'rad_offset_error':gal_info['deltaR_err']*u.kpc,\
-                      'gal_sfr':gal_info['SFR']*u.Msun/u.yr
-                      }
+    obs_props = galaxy_history.host_obs_props(gal_info)
 
 
     # --- Read in or construct galaxy class
+    gal_key = None
     if args.gal_path:
         print('Using galaxy realization living at {0:s}...\n'.format(args.gal_path))
-        gal = pickle.load(open(args.gal_path, 'rb'))
+        if args.ensemble_member is not None:
+            gal = galaxy_history.read_ensemble(args.gal_path)[args.ensemble_member]
+        else:
+            gal = galaxy_history.read_galaxy(args.gal_path)
     else:
-        print('Constructing galaxy...\n'.format(args.gal_path))
-        gal = galaxy_history.GalaxyHistory(\
+        gal = None
+        if args.cache_dirpath:
+            gal_inputs = cache.galaxy_inputs(gal_info, \
+                            disk_profile = args.disk_profile, \
+                            dm_profile = args.dm_profile, \
+                            smhm_relation = args.smhm_relation, \
+                            smhm_sigma = args.smhm_sigma, \
+                            bulge_profile = args.bulge_profile, \
+                            z_scale = args.z_scale, \
+                            differential_prof = args.differential_prof, \
+                            collapse_shells = args.collapse_shells, \
+                            coarsen_tol = args.coarsen_tol)
+            gal_key, gal = cache.load_galaxy(args.cache_dirpath, gal_inputs)
+
+        if gal is None:
+            print('Constructing galaxy...\n')
+            gal = galaxy_history.GalaxyHistory(\
                             obs_props = obs_props,\
                             disk_profile = args.disk_profile,\
                             dm_profile = args.dm_profile,\
@@ -138,10 +184,15 @@ def main(args):
                             bulge_profile = args.bulge_profile,\
                             z_scale = args.z_scale,\
                             differential_prof = args.differential_prof,\
+                            collapse_shells = args.collapse_shells,\
+                            coarsen_tol = args.coarsen_tol,\
+                            sfr_cache_dirpath = args.cache_dirpath,\
                             )
+            if args.cache_dirpath:
+                cache.save_galaxy(args.cache_dirpath, gal_inputs, gal)
 
     # --- Save gal class
-    gal.write(args.output_dirpath, args.label)
+    gal.write(args.output_dirpath, args.label, fmt=args.gal_format)
     if args.gal_only:
         return
 
@@ -156,6 +207,30 @@ def main(args):
         if len(interpolants) != len(gal.times):
             raise ValueError('The interpolation file you specified does not have the same parameters as your galaxy model! It has {0:d} timesteps whereas you galaxy has {1:d}!'.format(len(interpolants), len(gal.times)))
 
+    elif args.interp_dirpath:
+        interpolants = interpolate.InterpolantProvider(gal, args.interp_dirpath, \
+                            Rgrid = args.Rgrid, \
+                            Zgrid = args.Zgrid, \
+                            Rgrid_max = args.Rgrid_max, \
+                            Zgrid_max = args.Zgrid_max, \
+                            maxsize = args.interp_cache_size)
+        print('Using galactic potential interpolations built on demand in {0:s}...\n'.format(args.interp_dirpath))
+
+    elif gal_key is not None:
+        interp_dirpath = cache.interp_dirpath(args.cache_dirpath, \
+                            cache.interp_inputs(gal_key, \
+                            Rgrid = args.Rgrid, \
+                            Zgrid = args.Zgrid, \
+                            Rgrid_max = args.Rgrid_max, \
+                            Zgrid_max = args.Zgrid_max))
+        interpolants = interpolate.InterpolantProvider(gal, interp_dirpath, \
+                            Rgrid = args.Rgrid, \
+                            Zgrid = args.Zgrid, \
+                            Rgrid_max = args.Rgrid_max, \
+                            Zgrid_max = args.Zgrid_max, \
+                            maxsize = args.interp_cache_size)
+        print('Using cached galactic potential interpolations in {0:s}...\n'.format(interp_dirpath))
+
     else:
         if args.differential_prof==True:
             warnings.warn("If you're using differential stellar profiles, you might want to be using an interpolated potential instance to speed up the integrations!!!\n")
@@ -219,11 +294,17 @@ def main(args):
 
 
     # --- Initialize systems class
-    systems = system.Systems(sampled_parameters, sample_progenitor_props=args.sample_progenitor_props)
+    systems = system.Systems(sampled_parameters, sample_progenitor_props=args.sample_progenitor_props, float32=args.float32)
 
     # --- Calculate the instantaneous particle escape velocities and galactic velocities at birth
-    systems.escape_velocity(gal, interpolants)
-    systems.galactic_velocity(gal, interpolants, fixed_potential)
+    if args.pipeline:
+        if not isinstance(interpolants, interpolate.InterpolantProvider):
+            raise ValueError('Pipelined runs build interpolations on demand, so either --interp-dirpath or --cache-dirpath must be specified!')
+        # these are calculated by the workers once the interpolants at birth exist, and the galactic velocity is added to the post-SN velocity then
+        systems.Vcirc = np.zeros(systems.Nsys)*u.km/u.s
+    else:
+        systems.escape_velocity(gal, interpolants)
+        systems.galactic_velocity(gal, interpolants, fixed_potential)
 
     # --- If we sampled the porgenitor properties, we need to determine the impact of the SN and the inspiral time, and bring the system into the galactic frame
     if args.sample_progenitor_props:
@@ -251,10 +332,18 @@ def main(args):
                         resolution=args.resolution, \
                         save_traj=args.save_traj, \
                         downsample=args.downsample, \
+                        traj_tols = tracer_storage.trajectory_tolerances(args.traj_pos_tol, args.traj_vel_tol), \
+                        snapshot_times = np.linspace(gal.times[0], gal.times[-1], args.snapshots) if args.snapshots else None, \
+                        elapsed_times = tracer_storage.elapsed_grid(num=args.elapsed_snapshots) if args.elapsed_snapshots else None, \
+                        aggregates = aggregates.TracerAggregates(len(gal.times)) if (args.aggregate or args.aggregate_only) else None, \
+                        store_tracers = not args.aggregate_only, \
+                        nsightlines = args.sightlines, \
+                        stratify_sightlines = args.stratify_sightlines, \
                         outdir = args.output_dirpath, \
                         fixed_potential = fixed_potential, \
                         interpolants = interpolants, \
-                        label = args.label)
+                        label = args.label, \
+                        pipeline = args.pipeline)
 
 
 
@@ -0,0 +1,137 @@
+"""The tracer aggregates must merge exactly and keep the accuracy of their quantiles.
+"""
+import numpy as np
+import pytest
+
+from kickIT import aggregates
+
+
+NSTEPS = 5
+
+
+def random_block(ntracers, seed, nsight=None):
+    """Birth timesteps, systemic velocities [km/s], projected offsets [kpc], merger redshifts, and weights of a block of tracers.
+    """
+    rng = np.random.RandomState(seed)
+    t0 = rng.randint(0, NSTEPS, ntracers)
+    Vsys = rng.uniform(0, 1200, ntracers)
+    shape = ntracers if nsight is None else (ntracers, nsight)
+    offsets = 10**rng.uniform(-3.5, 5.5, shape)
+    # some tracers are disrupted by the SN, and some never merge
+    disrupted = rng.uniform(size=ntracers) < 0.1
+    offsets[disrupted] = np.nan
+    merger_redz = np.where(rng.uniform(size=ntracers) < 0.3, 0.0, rng.uniform(0, 12, ntracers))
+    weights = rng.uniform(0.5, 2, ntracers)
+    return t0, Vsys, offsets, merger_redz, weights
+
+
+def assert_equal_aggregates(a, b):
+    assert a.shape == b.shape
+    np.testing.assert_array_equal(a.vsys_edges, b.vsys_edges)
+    for name in aggregates.COUNTS:
+        np.testing.assert_allclose(a.counts[name], b.counts[name], rtol=1e-12)
+    for name in ['offsets', 'offset_sketch', 'merger_redz']:
+        np.testing.assert_array_equal(getattr(a, name).edges, getattr(b, name).edges)
+        np.testing.assert_allclose(getattr(a, name).counts, getattr(b, name).counts, rtol=1e-12)
+
+
+@pytest.mark.parametrize('nsight', [None, 4])
+def test_merged_equals_single_pass(nsight):
+    blocks = [random_block(n, seed, nsight) for seed, n in enumerate([1000, 1, 2500, 0, 700])]
+    escaped = [np.random.RandomState(seed).uniform(size=len(block[0])) < 0.2 for seed, block in enumerate(blocks)]
+
+    single = aggregates.TracerAggregates(NSTEPS)
+    for block, esc in zip(blocks, escaped):
+        single.add(*block[:4], weights=block[4])
+        single.add_escaped(block[0], block[1], esc, weights=block[4])
+
+    # e.g. one set of aggregates per worker process, merged in a different order
+    workers = [aggregates.TracerAggregates(NSTEPS) for _ in range(3)]
+    for ii, (block, esc) in enumerate(zip(blocks, escaped)):
+        workers[ii % 3].add(*block[:4], weights=block[4])
+        workers[ii % 3].add_escaped(block[0], block[1], esc, weights=block[4])
+    merged = aggregates.TracerAggregates(NSTEPS)
+    for worker in workers[::-1]:
+        merged.merge(worker)
+
+    assert_equal_aggregates(merged, single)
+    total = sum(np.sum(block[4]) for block in blocks)
+    assert np.isclose(single.count('total'), total)
+
+
+def test_merge_rejects_different_keys():
+    with pytest.raises(ValueError):
+        aggregates.TracerAggregates(NSTEPS).merge(aggregates.TracerAggregates(NSTEPS+1))
+    with pytest.raises(ValueError):
+        aggregates.TracerAggregates(NSTEPS).merge(aggregates.TracerAggregates(NSTEPS, vsys_edges=np.linspace(0, 500, 11)))
+
+
+@pytest.mark.parametrize('accuracy', [0.01, 0.05])
+def test_quantiles_within_accuracy(accuracy):
+    # lognormal offsets, whose quantiles are known exactly
+    from scipy.stats import norm
+    rng = np.random.RandomState(1)
+    mu, sigma = np.log(5.0), 1.5
+    ntracers = 200000
+    offsets = np.exp(rng.normal(mu, sigma, ntracers))
+
+    aggs = aggregates.TracerAggregates(1, sketch_accuracy=accuracy)
+    aggs.add(np.zeros(ntracers, dtype=int), np.full(ntracers, 100.0), offsets, np.zeros(ntracers))
+
+    qs = np.array([0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99])
+    sketch = aggs.offset_quantiles(qs)
+    # the sketch is accurate relative to the quantiles of the sample itself
+    empirical = np.sort(offsets)[np.ceil(qs*ntracers).astype(int)-1]
+    assert np.all(np.abs(sketch - empirical) <= accuracy*empirical)
+    # which converge to those of the distribution
+    exact = np.exp(mu + sigma*norm.ppf(qs))
+    assert np.all(np.abs(sketch - exact) <= (accuracy + 0.02)*exact)
+
+
+def test_fractions_and_selection():
+    aggs = aggregates.TracerAggregates(2, vsys_edges=[0, 100, 200])
+    t0 = np.array([0, 0, 1, 1])
+    Vsys = np.array([50, 150, 50, 250])
+    aggs.add(t0, Vsys, [1.0, np.nan, 10.0, 100.0], [0.5, 0.0, 0.0, 2.0])
+    aggs.add_escaped(t0, Vsys, [False, True, False, True])
+
+    assert aggs.count('total') == 4
+    assert aggs.count('disrupted') == 1
+    assert aggs.count('merged') == 2
+    assert aggs.fraction('escaped') == 0.5
+    # vbin 0 is the underflow bin, so the first bin of Vsys is vbin 1
+    assert aggs.count('total', t0=1, vbin=1) == 1
+    assert aggs.count('total', t0=1, vbin=3) == 1
+    assert np.isnan(aggs.fraction('escaped', t0=0, vbin=3))
+    counts, edges = aggs.histogram('offsets', t0=1)
+    assert counts.sum() == 2
+    with pytest.raises(NameError):
+        aggs.histogram('Vsys')
+
+
+def test_write_read_round_trip(tmp_path):
+    aggs = aggregates.TracerAggregates(NSTEPS, sketch_accuracy=0.02)
+    block = random_block(3000, 0, 3)
+    aggs.add(*block[:4], weights=block[4])
+    aggs.add_escaped(block[0], block[1], block[1] > 600)
+
+    path = str(tmp_path / 'output.hdf5')
+    aggs.write(path)
+    # writing again replaces the aggregates
+    aggs.write(path)
+    read = aggregates.read_aggregates(path)
+
+    assert_equal_aggregates(read, aggs)
+    assert read.sketch_accuracy == aggs.sketch_accuracy
+    np.testing.assert_array_equal(read.offset_quantiles([0.1, 0.5, 0.9]), aggs.offset_quantiles([0.1, 0.5, 0.9]))
+
+    # and the aggregates read from separate runs merge like the originals
+    np.testing.assert_allclose(read.merge(aggs).counts['total'], 2*aggs.counts['total'])
+
+
+def test_read_without_aggregates(tmp_path):
+    import h5py
+    path = str(tmp_path / 'empty.hdf5')
+    h5py.File(path, 'w').close()
+    with pytest.raises(ValueError):
+        aggregates.read_aggregates(path)
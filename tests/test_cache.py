@@ -0,0 +1,37 @@
+"""Tables of the scaling relations are only cached on disk when a directory is set.
+"""
+import os
+
+import numpy as np
+
+from kickIT import cache
+
+
+def build_counter(calls):
+    def build():
+        calls.append(1)
+        return np.arange(5.0)
+    return build
+
+
+def test_no_table_dirpath_writes_nothing(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, 'TABLE_DIRPATH', None)
+    monkeypatch.chdir(tmp_path)
+    calls = []
+    for _ in range(2):
+        np.testing.assert_array_equal(cache.cached_table('test', {'a': 1}, build_counter(calls)), np.arange(5.0))
+    # recalculated every time, and nothing is written
+    assert len(calls) == 2
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_table_round_trip(monkeypatch, tmp_path):
+    monkeypatch.setattr(cache, 'TABLE_DIRPATH', str(tmp_path / 'tables'))
+    calls = []
+    for _ in range(2):
+        np.testing.assert_array_equal(cache.cached_table('test', {'a': 1}, build_counter(calls)), np.arange(5.0))
+    assert len(calls) == 1
+    # different inputs are a different table
+    cache.cached_table('test', {'a': 2}, build_counter(calls))
+    assert len(calls) == 2
+    assert len(os.listdir(str(tmp_path / 'tables'))) == 2
@@ -0,0 +1,16 @@
+"""Collapsing the stellar shells is only defined for double exponential disks with a scale height.
+"""
+import astropy.units as u
+import pytest
+
+from kickIT import galaxy_history
+
+
+OBS_PROPS = {'name': '050709', 'mass_stars': 10**9.1*u.Msun, 'age_stars': 0.8*u.Gyr, 'redz': 0.161, 'gal_sfr': 0.1*u.Msun/u.yr, 'rad_eff': 1.75*u.kpc}
+
+
+@pytest.mark.parametrize('disk_profile, z_scale', [('RazorThinExponential', 0.05), ('DoubleExponential', None), ('MNExponential', None)])
+def test_rejects_unsupported_disks(disk_profile, z_scale):
+    # rejected before any of the (slow) histories are calculated
+    with pytest.raises(ValueError):
+        galaxy_history.GalaxyHistory(OBS_PROPS, disk_profile, 'NFW', z_scale=z_scale, differential_prof=True, collapse_shells=True)
@@ -0,0 +1,83 @@
+"""The cached cosmology interpolators must give the same results as building them on every call.
+"""
+import pickle
+
+import numpy as np
+import pytest
+
+from kickIT.lazy import lazy_import
+from kickIT.galaxy_history import cosmology
+
+
+CONVERSIONS = [
+    # method, grid of its input, grid of its output, and the astropy method from redshift to its input (in cgs)
+    ('tage_to_z', 'age', 'z', 'age'),
+    ('tlbk_to_z', 'lbk', 'z', 'lookback_time'),
+    ('dcom_to_z', 'dcom', 'z', 'comoving_distance'),
+    ('dlum_to_z', 'dlum', 'z', 'luminosity_distance'),
+    ]
+
+
+@pytest.fixture(scope='module')
+def cosmo():
+    return cosmology.Cosmology()
+
+
+@pytest.fixture(scope='module')
+def redz():
+    # the range of the galaxy histories (see galaxy_history.MAX_REDZ)
+    return np.concatenate([[0.0], np.geomspace(1e-3, 10, 200)])
+
+
+@pytest.mark.parametrize('method, xname, yname, astropy_method', CONVERSIONS)
+def test_cached_matches_uncached(cosmo, redz, method, xname, yname, astropy_method):
+    values = getattr(cosmo, astropy_method)(redz).cgs.value
+    uncached = cosmo._interp(values, getattr(cosmo, '_grid_'+xname), getattr(cosmo, '_grid_'+yname), getattr(cosmo, '_sort_'+xname))
+
+    np.testing.assert_array_equal(getattr(cosmo, method)(values), uncached)
+    # and again, now from the cache, one value at a time
+    np.testing.assert_array_equal([getattr(cosmo, method)(val) for val in values[::20]], uncached[::20])
+
+
+@pytest.mark.parametrize('method, xname, yname, astropy_method', CONVERSIONS)
+def test_inverts_astropy(cosmo, redz, method, xname, yname, astropy_method):
+    values = getattr(cosmo, astropy_method)(redz).cgs.value
+    np.testing.assert_allclose(getattr(cosmo, method)(values), redz, rtol=1e-4, atol=1e-7)
+
+
+def test_distances_match_astropy(cosmo, redz):
+    np.testing.assert_allclose(cosmo._z_to_dcom(redz), cosmo.comoving_distance(redz).cgs.value, rtol=1e-4)
+    np.testing.assert_allclose(cosmo._z_to_dlum(redz), cosmo.luminosity_distance(redz).cgs.value, rtol=1e-4)
+
+
+def test_unpickle_without_cache(cosmo, redz):
+    ages = cosmo.age(redz).cgs.value
+    expected = cosmo.tage_to_z(ages)
+
+    # as pickled before the interpolators were cached
+    old = pickle.loads(pickle.dumps(cosmo))
+    del old.__dict__['_interps']
+    old = pickle.loads(pickle.dumps(old))
+    assert '_interps' not in old.__dict__
+
+    np.testing.assert_array_equal(old.tage_to_z(ages), expected)
+    assert ('age', 'z') in old.__dict__['_interps']
+
+
+def test_lazy_module_resolves_to_module():
+    lazy = lazy_import('kickIT.galaxy_history.cosmology')
+    assert lazy.Cosmology is cosmology.Cosmology
+    assert 'Cosmology' in dir(lazy)
+    # objects built through a lazy module pickle as those of the module itself
+    assert type(pickle.loads(pickle.dumps(lazy.Cosmology()))) is cosmology.Cosmology
+    with pytest.raises(AttributeError):
+        lazy.not_an_attribute
+
+
+def test_lazy_module_sets_on_module(monkeypatch):
+    from kickIT import cache
+    monkeypatch.setattr(cache, 'TABLE_DIRPATH', cache.TABLE_DIRPATH)
+    lazy = lazy_import('kickIT.cache')
+    lazy.TABLE_DIRPATH = '/nonexistent'
+    assert cache.TABLE_DIRPATH == '/nonexistent'
+    assert 'TABLE_DIRPATH' not in vars(lazy)
@@ -0,0 +1,67 @@
+"""The plain-float engine must reproduce the mass histories and profiles of the astropy-unit implementation it replaced.
+
+data/engine_050709.npz holds the histories and profiles of the host of GRB 050709 (on a coarse radial grid), as calculated by GalaxyHistory before the engine was introduced.
+"""
+import os
+
+import numpy as np
+import astropy.units as u
+import pytest
+
+from kickIT import galaxy_history
+
+
+REFERENCE_PATH = os.path.join(os.path.dirname(__file__), 'data', 'engine_050709.npz')
+
+OBS_PROPS = {'name': '050709', 'mass_stars': 10**9.1*u.Msun, 'age_stars': 0.8*u.Gyr, 'redz': 0.161, 'gal_sfr': 0.1*u.Msun/u.yr, 'rad_eff': 1.75*u.kpc}
+
+# Quantities compared, and their units in the reference file
+UNITS = {
+    'times': u.Gyr,
+    'sfr': u.Msun/u.yr,
+    'mass_stars': u.Msun,
+    'mass_gas': u.Msun,
+    'mass_sfr_prof': u.Msun,
+    'mass_stars_prof': u.Msun,
+    'mass_gas_prof': u.Msun,
+    'Rscale_baryons': u.kpc,
+    }
+
+
+@pytest.fixture(scope='module')
+def reference():
+    with np.load(REFERENCE_PATH) as f:
+        return {key: f[key] for key in f.files}
+
+
+@pytest.fixture(scope='module')
+def gal(reference):
+    """GalaxyHistory with only its mass histories and profiles calculated, on the radii of the reference.
+    """
+    gal = galaxy_history.GalaxyHistory.__new__(galaxy_history.GalaxyHistory)
+    gal.obs_props = OBS_PROPS
+    gal.dm_profile = 'NFW'
+    gal.smhm_relation = 'Guo'
+    gal.smhm_sigma = 0.0
+    gal.STAR_AGE_RTOL = galaxy_history.STAR_AGE_RTOL
+    gal.time_beg = gal.cosmo.age(galaxy_history.REDZ_BEG)
+    gal.time_end = gal.cosmo.age(OBS_PROPS['redz'])
+    gal.time_dur = gal.time_end - gal.time_beg
+    gal.rads = reference['rads']*u.kpc
+
+    gal.calc_total_masses_vs_time()
+    gal.calc_mass_profiles_vs_time()
+    return gal
+
+
+@pytest.mark.parametrize('name', list(UNITS))
+def test_matches_reference(gal, reference, name):
+    values = getattr(gal, name).to(UNITS[name]).value
+    assert values.shape == reference[name].shape
+    np.testing.assert_allclose(values, reference[name], rtol=1e-10, atol=1e-12*np.max(np.abs(reference[name])))
+
+
+def test_profiles_sum_to_totals(gal):
+    # the stars formed up to each timestep are all within the outermost radius of the profiles
+    formed = np.any(gal.mass_sfr_prof.value > 0, axis=1)
+    np.testing.assert_allclose(np.sum(gal.mass_gas_prof.value[formed], axis=1), gal.mass_gas.to(u.Msun).value[formed], rtol=1e-2)
@@ -0,0 +1,92 @@
+"""The InterpolantProvider must map timesteps to their epochs, evict the least recently used interpolants, and not pickle its in-memory cache.
+"""
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from kickIT import cache, interpolate
+
+
+class FakeGalaxy:
+    """Only what the provider uses of a gal class.
+    """
+    def __init__(self, nsteps, potential_epochs=None):
+        self.times = np.linspace(1, 13, nsteps)
+        self.redz = np.linspace(5, 0, nsteps)
+        self.full_potentials_natural = [['potential {0:d}'.format(step)] for step in range(nsteps)]
+        if potential_epochs is not None:
+            self.potential_epochs = np.asarray(potential_epochs)
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    """Timesteps built by the provider, whose interpolants are stand-ins for those of galpy.
+    """
+    built = []
+    def interp_func(potentials, rgrid, zgrid, ro=None, vo=None):
+        built.append(int(potentials[0].split()[1]))
+        return {'potentials': potentials}
+    monkeypatch.setattr(interpolate, 'interp_func', interp_func)
+    monkeypatch.setattr(interpolate, 'VERBOSE', False)
+    return built
+
+
+def test_lru_eviction(tmp_path, builds):
+    provider = interpolate.InterpolantProvider(FakeGalaxy(6), str(tmp_path), maxsize=2)
+    assert provider[0] == {'potentials': ['potential 0']}
+    provider[1]
+    provider[0]
+    # step 1 is now the least recently used, so it is evicted first
+    provider[2]
+    assert list(provider._cache) == [0, 2]
+    assert builds == [0, 1, 2]
+
+    # evicted interpolants are loaded from disk rather than built again
+    provider[1]
+    assert list(provider._cache) == [2, 1]
+    assert builds == [0, 1, 2]
+    assert sorted(os.listdir(str(tmp_path))) == ['grid.json', 'interp_0000.pkl', 'interp_0001.pkl', 'interp_0002.pkl']
+
+
+def test_epoch_mapping(tmp_path, builds):
+    gal = FakeGalaxy(6, potential_epochs=[0, 0, 2, 2, 2, 5])
+    provider = interpolate.InterpolantProvider(gal, str(tmp_path))
+    assert [provider.epoch(step) for step in range(6)] == [0, 0, 2, 2, 2, 5]
+    # negative timesteps count from the end, as for a list
+    assert provider.epoch(-2) == 2
+
+    # every timestep of an epoch shares the interpolant of its first timestep
+    assert provider[4] is provider[2]
+    assert provider[1] is provider[0]
+    assert provider[-1] == {'potentials': ['potential 5']}
+    assert builds == [2, 0, 5]
+    assert list(provider._cache) == [2, 0, 5]
+
+
+def test_pickle_clears_cache(tmp_path, builds):
+    provider = interpolate.InterpolantProvider(FakeGalaxy(3), str(tmp_path))
+    provider[0]
+    provider[1]
+
+    copy = pickle.loads(pickle.dumps(provider))
+    assert len(copy._cache) == 0
+    assert len(provider._cache) == 2
+    # the copy loads what the original built
+    assert copy[1] == provider[1]
+    assert builds == [0, 1]
+
+
+def test_rejects_different_grid(tmp_path, builds):
+    interpolate.InterpolantProvider(FakeGalaxy(3), str(tmp_path), Rgrid=100)
+    with pytest.raises(ValueError):
+        interpolate.InterpolantProvider(FakeGalaxy(3), str(tmp_path), Rgrid=200)
+
+
+def test_cache_entries_versioned():
+    # interpolants built before the grid became flat in ln(R) are never looked up
+    inputs = cache.interp_inputs('galaxy', 300, 100, 1e3, 1e2)
+    assert inputs['interp_version'] == cache.INTERP_VERSION
+    old = {key: value for key, value in inputs.items() if key != 'interp_version'}
+    assert cache.input_hash(old) != cache.input_hash(inputs)
@@ -0,0 +1,62 @@
+"""The refined search of calc_sfr_params must choose the same cell as the search over the full grid.
+"""
+import numpy as np
+import astropy.units as u
+import pytest
+
+from kickIT import galaxy_history
+
+
+# log10 stellar mass [Msun], stellar age [Gyr], redshift, and SFR [Msun/yr] of small test hosts
+HOSTS = [
+    (9.0, 0.3, 0.1, 0.01),
+    (10.0, 1.0, 0.5, 1.0),
+    (10.0, 6.0, 0.1, 0.01),
+    (11.0, 3.0, 1.0, 1.0),
+    ]
+
+
+def make_host(logm, age, redz, sfr, rtol=galaxy_history.STAR_AGE_RTOL):
+    """GalaxyHistory with only the observed properties set, which is all calc_sfr_params needs.
+    """
+    gal = galaxy_history.GalaxyHistory.__new__(galaxy_history.GalaxyHistory)
+    gal.obs_props = {'name': 'test', 'mass_stars': 10**logm*u.Msun, 'age_stars': age*u.Gyr, 'redz': redz, 'gal_sfr': sfr*u.Msun/u.yr}
+    gal.STAR_AGE_RTOL = rtol
+    return gal
+
+
+@pytest.mark.parametrize('host', HOSTS)
+def test_refine_matches_grid(host):
+    gal = make_host(*host)
+    tq_grid, sig_grid, age_grid, err_grid = gal.calc_sfr_params(method='grid')
+    tq_refine, sig_refine, age_refine, err_refine = gal.calc_sfr_params(method='refine')
+
+    assert (tq_refine, sig_refine) == (tq_grid, sig_grid)
+    assert age_refine == age_grid
+    assert err_refine < gal.STAR_AGE_RTOL
+
+
+def test_refine_without_cell_in_tolerance(monkeypatch):
+    # the average times cross the target, but no cell of the grid is this close to it
+    gal = make_host(10.0, 1.0, 0.5, 1.0, rtol=1e-6)
+    with pytest.raises(ValueError) as grid_err:
+        gal.calc_sfr_params(method='grid')
+
+    evaluated = []
+    calc_sfr_times = galaxy_history.GalaxyHistory.calc_sfr_times
+    def counting(self, quench, sigma, times):
+        evaluated.append(np.size(quench))
+        return calc_sfr_times(self, quench, sigma, times)
+    monkeypatch.setattr(galaxy_history.GalaxyHistory, 'calc_sfr_times', counting)
+
+    with pytest.raises(ValueError) as refine_err:
+        gal.calc_sfr_params(method='refine')
+
+    assert str(refine_err.value) == str(grid_err.value)
+    # without a cell within tolerance, nothing can be ruled out, so the full grid is evaluated exactly once
+    assert sum(evaluated) == 100*100
+
+
+def test_unknown_method():
+    with pytest.raises(NameError):
+        make_host(*HOSTS[0]).calc_sfr_params(method='anneal')
@@ -0,0 +1,47 @@
+"""Quick command-line calls and importing kickIT must not import the heavy dependencies (see kickIT.lazy).
+"""
+import os
+import sys
+import subprocess
+
+import pytest
+
+
+REPO_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['galpy', 'astropy', 'pandas', 'h5py', 'scipy', 'matplotlib']
+
+# Runs a script (or nothing) in a fresh interpreter, then prints which of the heavy modules were imported
+CHECK = """
+import sys, runpy
+script, args = {script!r}, {args!r}
+if script is None:
+    import kickIT
+else:
+    sys.argv = [script] + args
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit:
+        pass
+print('heavy:' + ','.join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def heavy_imports(script=None, args=()):
+    if script is not None:
+        script = os.path.join(REPO_DIRPATH, script)
+    code = CHECK.format(script=script, args=list(args), heavy=HEAVY_MODULES)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_DIRPATH, os.environ.get('PYTHONPATH', '')]))
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIRPATH, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    line = [line for line in result.stdout.splitlines() if line.startswith('heavy:')][-1]
+    return [name for name in line[len('heavy:'):].split(',') if name]
+
+
+@pytest.mark.parametrize('script, args', [
+    (None, []),
+    ('run.py', ['--help']),
+    ('run.py', ['--version']),
+    ('construct_galaxies.py', ['--help']),
+    ])
+def test_no_heavy_imports(script, args):
+    assert heavy_imports(script, args) == []
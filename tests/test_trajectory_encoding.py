@@ -0,0 +1,68 @@
+"""Round trips of the quantized, delta-encoded trajectories.
+"""
+import numpy as np
+import pytest
+
+from kickIT import tracer_storage
+
+
+def random_trajectory(nsteps, seed=0):
+    rng = np.random.RandomState(seed)
+    columns = {'time': np.sort(rng.uniform(0, 13.8, nsteps))}
+    # orbits wander over many scales, so include far-out positions and large velocities
+    columns.update({name: np.cumsum(rng.normal(0, 10, nsteps)) * 10**rng.uniform(-2, 3) for name in ['X', 'Y', 'Z']})
+    columns.update({name: rng.normal(0, 300, nsteps) for name in ['vX', 'vY', 'vZ']})
+    return columns
+
+
+@pytest.mark.parametrize('nsteps', [0, 1, 2, 1000])
+@pytest.mark.parametrize('tols', [tracer_storage.trajectory_tolerances(), tracer_storage.trajectory_tolerances(pos_tol=1e-6, vel_tol=1e-5, time_tol=1e-9)])
+def test_round_trip_within_tolerance(nsteps, tols):
+    columns = random_trajectory(nsteps)
+    deltas = tracer_storage.encode_trajectory(columns, tols)
+
+    assert deltas.dtype == np.int64
+    assert deltas.shape == (len(tracer_storage.TRAJ_COLUMNS), nsteps)
+
+    decoded = tracer_storage.decode_trajectory(deltas, tols)
+    assert list(decoded) == tracer_storage.TRAJ_COLUMNS
+    for name in tracer_storage.TRAJ_COLUMNS:
+        assert decoded[name].dtype == np.float64
+        assert decoded[name].shape == (nsteps,)
+        # rounding to the nearest multiple, up to the floating-point error of the values themselves
+        bound = 0.5*tols[name] + 4*np.finfo(float).eps*np.abs(columns[name])
+        assert np.all(np.abs(decoded[name] - columns[name]) <= bound)
+
+
+def test_errors_do_not_accumulate():
+    # a long trajectory of values between multiples of the tolerance, whose deltas would drift if the errors accumulated
+    tols = tracer_storage.trajectory_tolerances()
+    nsteps = 100000
+    columns = {name: np.full(nsteps, 0.3*tols[name]) + np.arange(nsteps)*1.4*tols[name] for name in tracer_storage.TRAJ_COLUMNS}
+    decoded = tracer_storage.decode_trajectory(tracer_storage.encode_trajectory(columns, tols), tols)
+    for name in tracer_storage.TRAJ_COLUMNS:
+        assert np.max(np.abs(decoded[name] - columns[name])) <= 0.5*tols[name]*(1 + 1e-6)
+
+
+def test_file_round_trip(tmp_path):
+    tols = tracer_storage.trajectory_tolerances()
+    trajectories = {0: random_trajectory(500, seed=1), 1: random_trajectory(1, seed=2), 2: random_trajectory(0, seed=3), 3: random_trajectory(70000, seed=4)}
+    sightlines = {idx: np.random.RandomState(idx).uniform(0, 2*np.pi, 3) for idx in trajectories}
+    # written out of order, as the workers finish
+    for idx in [3, 1, 0, 2]:
+        tracer_storage.append_tmp(str(tmp_path), 'trajectories', [idx], sightlines[idx], tracer_storage.encode_trajectory(trajectories[idx], tols))
+
+    path = str(tmp_path / 'output.hdf5')
+    tracer_storage.combine_trajectories(path, str(tmp_path), tols)
+    assert tracer_storage.tmp_paths(str(tmp_path), 'trajectories') == []
+
+    read = tracer_storage.read_trajectories(path)
+    for idx, columns in trajectories.items():
+        nsteps = len(columns['time'])
+        trajectory = read.loc[read.index == idx]
+        assert len(trajectory) == nsteps
+        for name in tracer_storage.TRAJ_COLUMNS:
+            assert np.all(np.abs(trajectory[name].values - columns[name]) <= 0.5*tols[name] + 4*np.finfo(float).eps*np.abs(columns[name]))
+
+    subset = tracer_storage.read_trajectories(path, idxs=[1])
+    assert np.all(subset.index == 1) and (len(subset) == 1)
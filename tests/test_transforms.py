@@ -0,0 +1,197 @@
+"""The batched transforms must agree with the astropy-unit implementations they replaced.
+
+The baseline_* functions are the previous implementations from kickIT.utils, kept here as the reference.
+"""
+import numpy as np
+import astropy.units as u
+import pytest
+
+from kickIT import utils
+from kickIT.utils import transforms
+
+
+def baseline_euler_rot(vectors, angles, axis):
+    if axis=='X':
+        transformations = np.asarray([[[1,0,0],[0,np.cos(angle),-np.sin(angle)],[0,np.sin(angle),np.cos(angle)]] for angle in angles])
+    elif axis=='Y':
+        transformations = np.asarray([[[np.cos(angle),0,np.sin(angle)],[0,1,0],[-np.sin(angle),0,np.cos(angle)]] for angle in angles])
+    elif axis=='Z':
+        transformations = np.asarray([[[np.cos(angle),-np.sin(angle),0],[np.sin(angle),np.cos(angle),0],[0,0,1]] for angle in angles])
+    else:
+        raise ValueError("Unknown axis '{0:s}' specified in Euler transformation)".format(axis))
+
+    rot_vectors = np.asarray([np.dot(trans,vector).T for (trans,vector) in zip(transformations, vectors)])
+    return rot_vectors
+
+
+def baseline_cartesian_to_cylindrical(x,y,z,vx,vy,vz):
+    R = np.sqrt(x**2 + y**2).to(u.kpc)
+    vR = ((x*vx + y*vy)/((x**2 + y**2)**(1./2))).to(u.km/u.s)
+
+    Phi = np.arctan(y/x).to(u.rad)
+    vPhi = ((x*vy - y*vx)/(x**2 + y**2)).to(1/u.s)
+
+    Z = z.to(u.kpc)
+    vZ = vz.to(u.km/u.s)
+
+    return R,Phi,Z,vR,vPhi,vZ
+
+
+def baseline_cylindrical_to_cartesian(R,Phi,Z,vR,vPhi,vZ):
+    x = (R*np.cos(Phi)).to(u.kpc)
+    vx = (vR*np.cos(Phi) - R*np.sin(Phi)*vPhi).to(u.km/u.s)
+
+    y = (R*np.sin(Phi)).to(u.kpc)
+    vy = (vR*np.sin(Phi) + R*np.cos(Phi)*vPhi).to(u.km/u.s)
+
+    z = Z.to(u.kpc)
+    vz = vZ.to(u.km/u.s)
+
+    return x,y,z,vx,vy,vz
+
+
+def random_phase_space(num, seed=0):
+    """Positions [kpc] and velocities [km/s] of num points, including the axes and every quadrant.
+    """
+    rng = np.random.RandomState(seed)
+    pos = rng.normal(0, 10, (num, 3))
+    vel = rng.normal(0, 200, (num, 3))
+    # on the axes, where arctan(y/x) and arctan2 are most likely to differ
+    pos[:4,:2] = [[5, 0], [-5, 0], [0, 5], [0, -5]]
+    return pos, vel
+
+
+@pytest.mark.parametrize('axis', ['X', 'Y', 'Z'])
+def test_euler_rot(axis):
+    rng = np.random.RandomState(1)
+    vectors, angles = rng.normal(size=(100, 3)), rng.uniform(-2*np.pi, 2*np.pi, 100)
+    np.testing.assert_allclose(transforms.euler_rot(vectors, angles, axis), baseline_euler_rot(vectors, angles, axis), rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(utils.euler_rot(vectors, angles, axis), baseline_euler_rot(vectors, angles, axis), rtol=1e-12, atol=1e-12)
+
+
+def test_unknown_axis():
+    with pytest.raises(ValueError):
+        transforms.rotation_matrix(0.5, 'W')
+    with pytest.raises(ValueError):
+        transforms.euler_matrix([0.1, 0.2], axes='XYZ')
+
+
+def test_euler_matrix_composes_rotations():
+    rng = np.random.RandomState(2)
+    vectors, angles = rng.normal(size=(50, 3)), rng.uniform(0, 2*np.pi, (50, 3))
+    expected = vectors
+    for ii, axis in enumerate('XYZ'):
+        expected = baseline_euler_rot(expected, angles[:,ii], axis)
+
+    np.testing.assert_allclose(transforms.rotate(vectors, transforms.euler_matrix(angles, 'XYZ')), expected, rtol=1e-12, atol=1e-12)
+    # as used for the systemic velocities, which are rotated about Z and then Y
+    expected = baseline_euler_rot(baseline_euler_rot(vectors, angles[:,0], 'Z'), angles[:,1], 'Y')
+    np.testing.assert_allclose(transforms.rotate(vectors, transforms.euler_matrix(angles[:,:2], 'ZY')), expected, rtol=1e-12, atol=1e-12)
+
+
+def test_projected_offsets():
+    # the previous projection rotated every position of a trajectory by the same three angles
+    rng = np.random.RandomState(3)
+    vectors, sightline = rng.normal(0, 10, (200, 3)), rng.uniform(0, 2*np.pi, 3)
+    rot_vecs = vectors
+    for angle, axis in zip(sightline, 'XYZ'):
+        rot_vecs = baseline_euler_rot(rot_vecs, np.ones(len(vectors))*angle, axis)
+    expected = np.sqrt(rot_vecs[:,0]**2 + rot_vecs[:,1]**2)
+
+    np.testing.assert_allclose(transforms.projected_offsets(vectors, sightline), expected, rtol=1e-12)
+    np.testing.assert_allclose(transforms.projected_offsets(vectors, np.tile(sightline, (len(vectors), 1))), expected, rtol=1e-12)
+
+
+def test_cartesian_to_cylindrical():
+    pos, vel = random_phase_space(200)
+    R, Phi, Z, vR, vT, vZ = transforms.cartesian_to_cylindrical(*pos.T, *vel.T)
+    bR, bPhi, bZ, bvR, bvPhi, bvZ = baseline_cartesian_to_cylindrical(*(pos.T*u.kpc), *(vel.T*u.km/u.s))
+
+    np.testing.assert_allclose(R, bR.value, rtol=1e-12)
+    np.testing.assert_allclose(Z, bZ.value, rtol=1e-12)
+    np.testing.assert_allclose(vR, bvR.value, rtol=1e-12, atol=1e-10)
+    np.testing.assert_allclose(vZ, bvZ.value, rtol=1e-12)
+    # the tangential velocity replaces the angular velocity vPhi = vT/R
+    np.testing.assert_allclose(vT, (bvPhi*bR).to_value(u.km/u.s), rtol=1e-12, atol=1e-10)
+
+    # the previous arctan(y/x) only agreed for x >= 0, and was off by pi in the left half-plane
+    left = pos[:,0] < 0
+    np.testing.assert_allclose(Phi[~left], bPhi.value[~left], rtol=1e-12, atol=1e-15)
+    np.testing.assert_allclose(np.cos(Phi[left] - bPhi.value[left]), -1.0)
+    # whereas arctan2 recovers the quadrant
+    np.testing.assert_allclose(R*np.cos(Phi), pos[:,0], atol=1e-12)
+    np.testing.assert_allclose(R*np.sin(Phi), pos[:,1], atol=1e-12)
+    np.testing.assert_allclose(Phi[:4], [0, np.pi, np.pi/2, -np.pi/2])
+
+
+def test_cylindrical_to_cartesian():
+    pos, vel = random_phase_space(200, seed=1)
+    R, Phi, Z, vR, vT, vZ = transforms.cartesian_to_cylindrical(*pos.T, *vel.T)
+
+    # the new signature takes the tangential velocity, the previous one the angular velocity vT/R
+    vPhi = (vT*u.km/u.s) / (R*u.kpc)
+    expected = baseline_cylindrical_to_cartesian(R*u.kpc, Phi*u.rad, Z*u.kpc, vR*u.km/u.s, vPhi, vZ*u.km/u.s)
+    cartesian = transforms.cylindrical_to_cartesian(R, Phi, Z, vR, vT, vZ)
+    for new, old in zip(cartesian, expected):
+        np.testing.assert_allclose(new, old.value, rtol=1e-12, atol=1e-10)
+    # and both recover the original positions and velocities
+    np.testing.assert_allclose(np.transpose(cartesian[:3]), pos, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(np.transpose(cartesian[3:]), vel, rtol=1e-12, atol=1e-10)
+
+
+def test_unit_wrappers_keep_their_signatures():
+    pos, vel = random_phase_space(50, seed=2)
+    right = pos[:,0] > 0
+    pos, vel = pos[right]*u.kpc, vel[right]*u.km/u.s
+    cylindrical = utils.cartesian_to_cylindrical(*pos.T, *vel.T)
+    for new, old in zip(cylindrical, baseline_cartesian_to_cylindrical(*pos.T, *vel.T)):
+        assert new.unit.is_equivalent(old.unit)
+        np.testing.assert_allclose(new.to_value(old.unit), old.value, rtol=1e-12, atol=1e-10)
+
+    for new, old in zip(utils.cylindrical_to_cartesian(*cylindrical), baseline_cylindrical_to_cartesian(*cylindrical)):
+        np.testing.assert_allclose(new.to_value(old.unit), old.value, rtol=1e-12, atol=1e-10)
+
+
+@pytest.mark.parametrize('pole', [[0, 0, 1], [0, 0, -1], [1, 0, 0], [-1, 0, 0], [0, 1, 0], [0.6, 0, 0.8], [1e-12, 0, 1]])
+def test_stratified_sightlines_about_poles(pole):
+    np.random.seed(4)
+    nsight = 8
+    poles = np.tile(pole, (10, 1))*3.0
+    sightlines = transforms.isotropic_sightlines((10, nsight), stratified=True, poles=poles)
+
+    assert sightlines.shape == (10, nsight, 3)
+    assert np.all(np.isfinite(sightlines))
+    np.testing.assert_allclose(np.linalg.norm(sightlines, axis=-1), 1.0)
+    # one sightline in each equal-area band of the angle from the pole
+    cos = np.einsum('nkj,nj->nk', sightlines, poles/np.linalg.norm(poles, axis=-1, keepdims=True))
+    lo, hi = 2*np.arange(nsight)/nsight - 1, 2*(np.arange(nsight)+1)/nsight - 1
+    assert np.all((cos >= lo - 1e-12) & (cos <= hi + 1e-12))
+
+
+def test_isotropic_sightlines():
+    np.random.seed(5)
+    sightlines = transforms.isotropic_sightlines(200000)
+    np.testing.assert_allclose(np.linalg.norm(sightlines, axis=-1), 1.0)
+    # isotropic: no preferred direction, and each component uniform in [-1, 1]
+    np.testing.assert_allclose(np.mean(sightlines, axis=0), 0.0, atol=0.01)
+    np.testing.assert_allclose(np.mean(sightlines**2, axis=0), 1/3, atol=0.01)
+
+
+def test_projected_offset_samples():
+    rng = np.random.RandomState(6)
+    vectors = rng.normal(0, 10, (30, 3))
+    np.random.seed(6)
+    shared = transforms.isotropic_sightlines(5)
+    per_vector = transforms.isotropic_sightlines((30, 5), stratified=True, poles=vectors)
+
+    for sightlines in [shared, per_vector]:
+        offsets = transforms.projected_offset_samples(vectors, sightlines)
+        assert offsets.shape == (30, 5)
+        lines = np.broadcast_to(sightlines, (30, 5, 3))
+        # distance of each vector from the line of sight through the origin
+        expected = np.linalg.norm(np.cross(vectors[:,None,:], lines), axis=-1)
+        np.testing.assert_allclose(offsets, expected, rtol=1e-8, atol=1e-10)
+
+    # a vector along the line of sight has no projected offset
+    along = transforms.projected_offset_samples(np.array([[0, 0, 2.0]]), np.array([[0, 0, 1.0]]))
+    assert along[0,0] == 0